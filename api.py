@@ -0,0 +1,152 @@
+"""Read-only JSON API for fetching many employees or projects in one request.
+
+    GET /api/employees?ids=123456789,333445555&fields=full_name,department_name
+    GET /api/projects?ids=1,2,30&fields=pname,headcount,assignments
+    POST either one with a JSON body: {"ids": [...], "fields": [...]}
+
+Each entity type is read with one `= ANY(%s)` query on its primary key, so a
+request costs the same one round trip whether it asks for one key or
+API_BATCH_MAX of them. Results come back in request order, one per requested
+key (duplicates included); a key that does not exist gives {"<key>": ...,
+"found": false}. `fields` limits each result to the named fields; the key is
+always included.
+"""
+import datetime
+import decimal
+import psycopg
+from flask import Blueprint, request, g, jsonify
+from utilities import get_db, env_int, read_only
+from versions import conditional
+from batch import QueryBatch
+import queries
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+# Most keys one request may ask for
+API_BATCH_MAX = env_int('API_BATCH_MAX', 500)
+
+EMPLOYEE_FIELDS = ('ssn', 'fname', 'minit', 'lname', 'full_name', 'address', 'sex', 'salary', 'super_ssn', 'dno',
+                   'department_name', 'bdate', 'empdate', 'num_dependents', 'num_projects', 'total_hours')
+PROJECT_FIELDS = ('pnumber', 'pname', 'plocation', 'dnum', 'department_name', 'headcount', 'total_hours',
+                  'assignments')
+
+
+class BadRequest(Exception):
+    """A malformed batch request; the message is returned to the caller with a 400."""
+
+
+@bp.before_request
+def require_login():
+    # An API caller gets a status code instead of the login page
+    if g.get('user') is None:
+        return jsonify(error='Log in first (POST /auth/login).'), 401
+
+
+@bp.errorhandler(BadRequest)
+def bad_request(e):
+    return jsonify(error=str(e)), 400
+
+
+def _json_value(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def _full_name(row):
+    return f"{row['fname']} {row['minit'] or ''} {row['lname']}".replace('  ', ' ').strip()
+
+
+def read_request(allowed_fields, convert=str):
+    """Return (keys, fields) from the query string or a JSON body.
+
+    Keys are `ids` (comma-separated, or repeated) or {"ids": [...]}, each passed
+    through `convert`; fields likewise, defaulting to all of `allowed_fields`.
+    Raises BadRequest if anything is missing, malformed or not allowed.
+    """
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            raise BadRequest('The JSON body must be an object.')
+        raw_ids, raw_fields = body.get('ids') or [], body.get('fields')
+        if not isinstance(raw_ids, list) or not (raw_fields is None or isinstance(raw_fields, list)):
+            raise BadRequest('"ids" and "fields" must be lists.')
+    else:
+        raw_ids = [i for arg in request.args.getlist('ids') for i in arg.split(',') if i.strip()]
+        raw_fields = [f for arg in request.args.getlist('fields') for f in arg.split(',') if f.strip()] or None
+
+    if not raw_ids:
+        raise BadRequest('Give the keys to fetch as "ids".')
+    if len(raw_ids) > API_BATCH_MAX:
+        raise BadRequest(f'At most {API_BATCH_MAX} ids per request; got {len(raw_ids)}.')
+    try:
+        keys = [convert(str(i).strip()) for i in raw_ids]
+    except ValueError:
+        raise BadRequest('Every id must be a number.' if convert is int else 'Malformed id.')
+
+    fields = [str(f).strip() for f in raw_fields] if raw_fields else list(allowed_fields)
+    unknown = [f for f in fields if f not in allowed_fields]
+    if unknown:
+        raise BadRequest(f"Unknown field(s) {', '.join(unknown)}; choose from {', '.join(allowed_fields)}.")
+    return keys, fields
+
+
+def in_request_order(keys, key_name, found, fields):
+    """One result per requested key, in order: the found row's `fields`, or a not-found marker."""
+    results = []
+    for key in keys:
+        row = found.get(key)
+        if row is None:
+            results.append({key_name: key, 'found': False})
+        else:
+            result = {key_name: key, 'found': True}
+            result.update((f, row[f]) for f in fields if f != key_name)
+            results.append(result)
+    return results
+
+
+@bp.route('/employees', methods=('GET', 'POST'))
+@read_only
+@conditional('employee', 'department', 'works_on', 'dependent')
+def employees():
+    """Employees by SSN (admin only: the records include salaries)."""
+    if g.user.get('role') != 'admin':
+        return jsonify(error='Only admins may read employee records.'), 403
+    ssns, fields = read_request(EMPLOYEE_FIELDS)
+
+    conn = get_db()
+    with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
+        queries.execute(cur, 'employees_by_ssn', (list(set(ssns)),))
+        rows = cur.fetchall()
+    found = {}
+    for row in rows:
+        row = {k: _json_value(v) for k, v in row.items()}
+        row['full_name'] = _full_name(row)
+        found[row['ssn']] = row
+    return jsonify(fields=fields, results=in_request_order(ssns, 'ssn', found, fields))
+
+
+@bp.route('/projects', methods=('GET', 'POST'))
+@read_only
+@conditional('project', 'department', 'works_on', 'employee')
+def projects():
+    """Projects by number. The `assignments` field adds each project's assigned employees."""
+    pnos, fields = read_request(PROJECT_FIELDS, int)
+
+    # Projects and, if asked for, their assignments in one round trip
+    batch = QueryBatch(get_db())
+    project_rows = queries.add(batch, 'projects_by_number', (list(set(pnos)),), psycopg.rows.dict_row)
+    if 'assignments' in fields:
+        assignment_rows = queries.add(batch, 'assignments_by_project', (list(set(pnos)),), psycopg.rows.dict_row)
+    batch.run()
+
+    found = {}
+    for row in project_rows.value:
+        found[row['pnumber']] = dict({k: _json_value(v) for k, v in row.items()}, assignments=[])
+    if 'assignments' in fields:
+        for row in assignment_rows.value:
+            found[row['pno']]['assignments'].append(
+                {'ssn': row['ssn'], 'full_name': _full_name(row), 'hours': _json_value(row['hours'])})
+    return jsonify(fields=fields, results=in_request_order(pnos, 'pnumber', found, fields))
@@ -1,28 +1,30 @@
 from flask import Flask, jsonify, url_for, render_template
 import os
-import auth, home, projects, managers, employees
-from utilities import get_db_connection
+import auth, home, projects, managers, employees, search, api
+import export_jobs
+import rollups
+import datagen
+import bench
+import plans
+import passwords
+import utilities
+import instrument
+import resultcache
+from utilities import get_db, get_pool_stats, get_replica_stats
+import async_db
+from cache import cache_stats
+from queries import query_stats
+from passwords import get_hashing_stats
+from export_jobs import get_job_stats
 try:
     import psycopg
 except Exception:
     psycopg = None
 
-app = Flask(__name__)
-app.config.from_mapping(
-    SECRET_KEY='dev',
-)
-app.register_blueprint(auth.bp)
-app.register_blueprint(projects.bp)
-app.register_blueprint(home.bp)
-app.register_blueprint(managers.bp)
-app.register_blueprint(employees.bp)
 
-
-@app.errorhandler(404)
 def page_not_found(e):
     return render_template('errors/404.html'), 404
 
-@app.route('/health-db')
 def health_db():
     """A simple route that checks the database connection and runs a test query.
 
@@ -30,21 +32,58 @@ def health_db():
     table doesn't exist, it falls back to `SELECT 1` to verify connectivity.
     """
     try:
-        conn = get_db_connection()
+        conn = get_db()
         with conn.cursor() as cur:
             try:
                 # try a complex query first, assuming employee table exists
                 cur.execute('SELECT COUNT(*) FROM employee')
-                cnt = cur.fetchone()[0]
-                return jsonify(status='ok', message='connected', employee_count=cnt)
+                result = dict(status='ok', message='connected', employee_count=cur.fetchone()[0])
             except Exception:
                 # fallback to a simple query to verify connection, ignoring table absence
+                conn.rollback()
                 cur.execute('SELECT 1')
                 _ = cur.fetchone()[0]
-                return jsonify(status='ok', message='connected (no employee table)')
+                result = dict(status='ok', message='connected (no employee table)')
+        code = 200
     except Exception as e:
-        return jsonify(status='error', message=str(e)), 500
+        result, code = dict(status='error', message=str(e)), 500
+    stats = dict(pool=get_pool_stats(), replicas=get_replica_stats(), async_pool=async_db.get_pool_stats(),
+                 caches=cache_stats(), queries=query_stats(), hashing=get_hashing_stats(),
+                 export_jobs=get_job_stats())
+    return jsonify(**result, **stats), code
+
+def create_app():
+    """Build the Flask app: configuration, hooks, blueprints and CLI commands.
+
+    `flask --app app ...` finds this factory by name; serve.py and asgi.py
+    call it to get the app they serve.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(
+        SECRET_KEY='dev',
+        # DB_MODE=async runs a page's independent queries concurrently (see async_db.py)
+        DB_ASYNC=os.environ.get('DB_MODE', 'sync').lower() == 'async',
+    )
+    utilities.init_app(app)
+    instrument.init_app(app)
+    resultcache.init_app(app)
+    app.register_blueprint(auth.bp)
+    app.register_blueprint(projects.bp)
+    app.register_blueprint(home.bp)
+    app.register_blueprint(managers.bp)
+    app.register_blueprint(employees.bp)
+    app.register_blueprint(search.bp)
+    app.register_blueprint(api.bp)
+    app.register_blueprint(export_jobs.bp)
+    app.register_error_handler(404, page_not_found)
+    app.add_url_rule('/health-db', view_func=health_db)
+    app.cli.add_command(rollups.rollups_cli)
+    app.cli.add_command(datagen.datagen_command)
+    app.cli.add_command(bench.bench_command)
+    app.cli.add_command(plans.plans_cli)
+    app.cli.add_command(passwords.passwords_cli)
+    return app
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,13 @@
+"""ASGI entry point, for serving the app with an ASGI server such as uvicorn:
+
+    DB_MODE=async uvicorn asgi:application --workers 4
+
+The views are synchronous: asgiref runs each request in a worker thread,
+which blocks on its queries just as it would under gunicorn. DB_MODE=async
+shortens that wait by running a page's independent queries at the same time
+(see async_db.py); it does not free the thread while they run.
+"""
+from asgiref.wsgi import WsgiToAsgi
+from app import create_app
+
+application = WsgiToAsgi(create_app())
@@ -0,0 +1,145 @@
+"""Concurrent read queries for the async database mode (DB_MODE=async).
+
+The views stay ordinary (synchronous) Flask views, but a page's independent
+queries are handed to an asyncio event loop that runs in a background thread
+and owns an AsyncConnectionPool. The loop sends all of them at once, each on
+its own connection, so the page waits for the slowest query instead of the
+sum. The request's thread still blocks while it waits.
+
+The async pool is sized on its own, and the request may also hold a
+connection from the main pool (see utilities.get_db), so a process can have
+up to DB_POOL_MAX_SIZE + DB_ASYNC_POOL_MAX_SIZE connections open:
+
+    DB_ASYNC_POOL_MIN_SIZE  connections kept open (default 1)
+    DB_ASYNC_POOL_MAX_SIZE  upper bound on open connections (default 4)
+
+The queries go to the server the request's own connection came from: a
+replica for a @read_only view (see utilities.read_only), the primary
+otherwise or while the session is sticking to the primary after a write.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import namedtuple
+from flask import g, has_app_context
+from utilities import get_database_url, env_int, env_float
+import batch
+try:
+    import psycopg
+    from psycopg_pool import AsyncConnectionPool
+except Exception:
+    AsyncConnectionPool = None
+
+logger = logging.getLogger(__name__)
+
+# One read query: SQL text, parameters and an optional psycopg row factory.
+Query = namedtuple('Query', ['sql', 'params', 'row_factory'], defaults=(None, None))
+
+_loop = None
+_pool = None
+# Replica pool name (utilities.get_replica_pools) -> async pool on the same replica
+_replica_pools = {}
+_lock = threading.Lock()
+
+
+async def _configure_replica(conn):
+    # Read-only, like the replica connections in utilities
+    await conn.set_read_only(True)
+
+
+async def _open_pool(conninfo=None, name="app-async", configure=None, timeout=None):
+    pool = AsyncConnectionPool(
+        conninfo or get_database_url(),
+        min_size=env_int("DB_ASYNC_POOL_MIN_SIZE", 1),
+        max_size=env_int("DB_ASYNC_POOL_MAX_SIZE", 4),
+        max_idle=env_float("DB_POOL_MAX_IDLE", 300.0),
+        timeout=timeout or env_float("DB_POOL_TIMEOUT", 10.0),
+        check=AsyncConnectionPool.check_connection,
+        configure=configure,
+        name=name,
+        open=False,
+    )
+    await pool.open()
+    return pool
+
+
+def _ensure_started():
+    """Start the event-loop thread and open the async pool on first use."""
+    global _loop, _pool
+    if _pool is not None:
+        return
+    if AsyncConnectionPool is None:
+        raise ValueError("psycopg_pool is not installed; install requirements.txt")
+    with _lock:
+        if _pool is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='db-async-loop', daemon=True).start()
+            _pool = asyncio.run_coroutine_threadsafe(_open_pool(), loop).result()
+            _loop = loop
+
+
+def _request_pool():
+    """The async pool on the server the request's connection (if any) came from."""
+    conn = g.get('db') if has_app_context() else None
+    if conn is None or not conn.pool.name.startswith('replica-'):
+        return _pool
+    name = conn.pool.name
+    with _lock:
+        if name not in _replica_pools:
+            # A replica that doesn't answer fails fast, as in utilities._replica_conn
+            _replica_pools[name] = asyncio.run_coroutine_threadsafe(
+                _open_pool(conn.pool.conninfo, f"{name}-async", _configure_replica,
+                           env_float("DB_REPLICA_TIMEOUT", 1.0)), _loop).result()
+        return _replica_pools[name]
+
+
+async def _fetch(pool, query):
+    # Returns (rows, seconds), the time from sending the query to having its rows
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=query.row_factory) as cur:
+            start = time.perf_counter()
+            await cur.execute(query.sql, query.params)
+            rows = await cur.fetchall()
+            return rows, time.perf_counter() - start
+
+
+async def _fetch_all(pool, queries):
+    return await asyncio.gather(*(_fetch(pool, q) for q in queries))
+
+
+def gather(*queries):
+    """Run independent read queries concurrently and return their rows, in order.
+
+    Each query gets its own pooled connection, so they must not depend on
+    each other or on uncommitted changes made by the request's connection.
+    """
+    _ensure_started()
+    pool = _request_pool()
+    try:
+        results = asyncio.run_coroutine_threadsafe(_fetch_all(pool, queries), _loop).result()
+    except psycopg.OperationalError:
+        if pool is _pool:
+            raise
+        logger.warning("Replica pool %s is unavailable; using the primary", pool.name)
+        results = asyncio.run_coroutine_threadsafe(_fetch_all(_pool, queries), _loop).result()
+    if batch.statement_hook is not None:
+        # Reported from the request's thread, so they land on its flask.g. The
+        # request's own connection is on the same server, for EXPLAIN.
+        conn = g.get('db') if has_app_context() else None
+        for query, (rows, seconds) in zip(queries, results):
+            batch.statement_hook(conn, query.sql, query.params, seconds, len(rows), 1, False)
+    return [rows for rows, _ in results]
+
+
+def warm_up(timeout=10.0):
+    """Start the loop and wait until the async pool has its first connections."""
+    _ensure_started()
+    asyncio.run_coroutine_threadsafe(_pool.wait(timeout), _loop).result()
+
+
+def get_pool_stats():
+    """Return the async pool's counters, or None if it has not been created yet."""
+    if _pool is None:
+        return None
+    return _pool.get_stats()
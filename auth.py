@@ -1,10 +1,30 @@
 from flask import Blueprint, request, render_template, flash, redirect, url_for, session, g, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
+from passwords import hash_password, verify_password, needs_rehash, HashingBusy
 import os
-from utilities import get_db_connection
+from utilities import get_db, get_db_connection, borrow_db
+from cache import TTLCache
+from batch import QueryBatch
+import queries
 import home
+import logging
+import threading
+import time
 import psycopg
 
+logger = logging.getLogger(__name__)
+
+# Per-process cache of logged-in users (id -> {id, username, role}) so that a
+# steady-state request does not query app_user. Entries expire after
+# USER_CACHE_TTL seconds and are dropped as soon as the database reports that
+# the account changed (see _listen_for_user_changes).
+user_cache = TTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 60)),
+    name='users',
+)
+_listener_started = False
+_listener_lock = threading.Lock()
+
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
@@ -24,24 +44,28 @@ def register():
 
         if error is None:
             try:
-                conn = get_db_connection()
+                password_hash = hash_password(password)    # in the hashing pool; see passwords.py
+            except HashingBusy:
+                return _busy('auth/register.html')
+            conn = get_db()
+            try:
                 with conn.cursor() as cur:
                     cur.execute(
                         "INSERT INTO app_user (username, password_hash, role) VALUES (%s, %s, %s)",
-                        (username, generate_password_hash(password), role)
+                        (username, password_hash, role)
                     )
                 conn.commit() # Commit on the connection
             except conn.IntegrityError as e:
+                conn.rollback()
                 error = f"Username is already taken."
             except Exception as e:
+                conn.rollback()
                 error = str(e)
                 flash(error)
 
             else:
                 flash("Registration successful! Please log in.")
                 return redirect(url_for("auth.login"))
-            finally:
-                conn.close()
 
         flash(error)
 
@@ -54,7 +78,7 @@ def login():
         password = request.form['password']
         error = None
         try:
-            conn = get_db_connection()
+            conn = get_db()
             with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
                 cur.execute('SELECT * FROM app_user WHERE username = %s', (username,))
                 user = cur.fetchone()
@@ -65,11 +89,17 @@ def login():
 
         if user is None:
             error = "Incorrect username or the user is not registered with the system."
-        elif not check_password_hash(user['password_hash'], password):
-            error = "Incorrect password."
+        else:
+            try:
+                if not verify_password(user['password_hash'], password):
+                    error = "Incorrect password."
+            except HashingBusy:
+                return _busy('auth/login.html')
 
         if error is None:
             print("login success")
+            if needs_rehash(user['password_hash']):
+                _upgrade_hash(user['id'], password)
             # Login successful
             session.clear()
             session['user_id'] = user['id']
@@ -78,17 +108,88 @@ def login():
         flash(error)
     return render_template('auth/login.html')
 
+def _busy(template):
+    # The hashing pool is full; tell the client to come back rather than queue up
+    flash("The server is busy; please try again in a moment.")
+    return render_template(template), 503, {'Retry-After': '1'}
+
+
+def _upgrade_hash(user_id, password):
+    """Re-hash a just-verified password with the configured method and cost.
+
+    Skipped (and retried at the next login) if the hashing pool is busy or
+    the update fails; the old hash keeps working meanwhile.
+    """
+    conn = get_db()
+    try:
+        new_hash = hash_password(password)
+        with conn.cursor() as cur:
+            cur.execute("UPDATE app_user SET password_hash = %s WHERE id = %s", (new_hash, user_id))
+        conn.commit()
+    except HashingBusy:
+        pass
+    except Exception:
+        conn.rollback()
+        logger.exception('Could not upgrade the password hash of user %s', user_id)
+
+
+def _listen_for_user_changes():
+    """Invalidate cached users when app_user rows are updated or deleted.
+
+    Runs in a daemon thread on its own connection. The app_user_changed trigger
+    in team_setup.sql sends the user id on the `app_user_changed` channel. If
+    the connection drops, notifications may have been missed, so the whole
+    cache is cleared before reconnecting.
+    """
+    while True:
+        try:
+            with get_db_connection() as conn:
+                conn.autocommit = True
+                conn.execute('LISTEN app_user_changed')
+                # Changes made before LISTEN took effect were not announced
+                user_cache.clear()
+                for notify in conn.notifies():
+                    user_cache.invalidate(int(notify.payload))
+        except Exception:
+            logger.exception('User change listener failed; retrying')
+        user_cache.clear()
+        time.sleep(5)
+
+
+def _start_user_listener():
+    global _listener_started
+    with _listener_lock:
+        if not _listener_started:
+            _listener_started = True
+            threading.Thread(target=_listen_for_user_changes, name='user-cache-listener', daemon=True).start()
+
+
 # Following function makes sure we get the user_id for the logged in user at every request in the application
 @bp.before_app_request
 def load_logged_in_user():
     curr_user_id = session.get('user_id')
     if curr_user_id is None:
         g.user = None
-    else:
-        conn = get_db_connection()
-        with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
-            cur.execute('SELECT * FROM app_user WHERE id = %s', (curr_user_id,))
-            g.user = cur.fetchone()
+        return
+
+    _start_user_listener()
+    user = user_cache.get(curr_user_id)
+    if user is None:
+        # Read before the query: if a change notification arrives while the
+        # row is loading, the row may be stale and is not cached
+        generation = user_cache.generation
+        # Always from the primary, even for a @read_only view: a lagging
+        # replica could hand back a role that was just changed, and the row
+        # is cached and used for permission checks on writes.
+        with borrow_db() as conn:
+            batch = QueryBatch(conn)
+            row = queries.add(batch, 'app_user', (curr_user_id,), psycopg.rows.dict_row)
+            batch.run()
+        user = row.first()
+        if user is not None:
+            user_cache.set(curr_user_id, user, generation=generation)
+    # Hand each request its own copy so a view can't modify the cached entry.
+    g.user = dict(user) if user is not None else None
 
 @bp.route('/logout', methods=('GET', 'POST'))
 def logout():
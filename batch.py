@@ -0,0 +1,222 @@
+"""Send several statements to the database in one network round trip.
+
+A QueryBatch queues statements on one connection and runs them together in
+psycopg's pipeline mode, so a view that needs three independent result sets
+waits for the network once instead of three times:
+
+    batch = QueryBatch(conn)
+    proj = batch.add("SELECT Pname FROM Project WHERE Pnumber = %s", (pno,))
+    assigned = batch.add(ASSIGNED_SQL, (pno,))
+    batch.run()
+    proj.first(), assigned.value
+
+The statements must not need each other's results. If one of them fails,
+run() raises its error and the statements after it are skipped.
+
+The module also counts round trips per request: connections from the pool
+use RoundTripCursor/RoundTripConnection, which add to g.db_round_trips, and
+utilities.init_app() reports the total in the X-DB-Round-Trips header when
+DB_DEBUG is on.
+
+Pool connections also report every statement to `statement_hook` when it is
+set (instrument.py sets it when DB_INSTRUMENT is on), including those run on
+named (server-side) cursors. While it is None, the only cost is that check.
+"""
+import time
+from flask import g, has_app_context
+import psycopg
+
+# Called as statement_hook(conn, sql, params, seconds, rows, batch_size, many)
+# after each statement. Statements in a batch share one round trip, so each of
+# them is reported with the whole batch's time and batch_size > 1. For
+# executemany, `many` is True and `params` is the list of parameter sets.
+statement_hook = None
+
+
+def count_round_trip(n=1):
+    """Add `n` to the current request's round-trip count (no-op outside a request)."""
+    if has_app_context():
+        g.db_round_trips = g.get('db_round_trips', 0) + n
+
+
+class RoundTripCursor(psycopg.Cursor):
+    """Cursor that counts each execute as one round trip, except inside a batch."""
+
+    def execute(self, query, params=None, **kwargs):
+        if getattr(self.connection, 'batching', False):
+            return super().execute(query, params, **kwargs)
+        count_round_trip()
+        if statement_hook is None:
+            return super().execute(query, params, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            statement_hook(self.connection, query, params, time.perf_counter() - start, self.rowcount, 1, False)
+
+    def executemany(self, query, params_seq, **kwargs):
+        # psycopg pipelines executemany itself, so the whole call is one trip.
+        if getattr(self.connection, 'batching', False):
+            return super().executemany(query, params_seq, **kwargs)
+        count_round_trip()
+        if statement_hook is None:
+            return super().executemany(query, params_seq, **kwargs)
+        params_seq = list(params_seq)
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            statement_hook(self.connection, query, params_seq, time.perf_counter() - start, self.rowcount, 1, True)
+
+
+class RoundTripServerCursor(psycopg.ServerCursor):
+    """Named cursor that reports its statement to statement_hook when it is closed.
+
+    Its rows are fetched as the caller iterates, so the statement is reported
+    once, at close(), with the time spent declaring the cursor and fetching
+    from it (not the time the caller spent between fetches) and the number of
+    rows read.
+    """
+
+    _statement = None
+    _seconds = 0.0
+
+    def execute(self, query, params=None, **kwargs):
+        count_round_trip()
+        if statement_hook is None:
+            return super().execute(query, params, **kwargs)
+        self._statement = (query, params)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            self._seconds += time.perf_counter() - start
+
+    def __next__(self):
+        if self._statement is None:
+            return super().__next__()
+        start = time.perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            self._seconds += time.perf_counter() - start
+
+    def close(self):
+        statement, self._statement = self._statement, None
+        rows = self.rownumber
+        super().close()
+        if statement is not None and statement_hook is not None:
+            statement_hook(self.connection, statement[0], statement[1], self._seconds, rows, 1, False)
+
+
+class RoundTripConnection(psycopg.Connection):
+    """Connection that counts commit and rollback as round trips.
+
+    A commit also sets g.db_committed, which utilities uses to keep the
+    session on the primary for a while (read-your-writes).
+    """
+
+    batching = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server_cursor_factory = RoundTripServerCursor
+
+    def commit(self):
+        if not self.batching and self.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+            count_round_trip()
+        super().commit()
+        if has_app_context():
+            g.db_committed = True
+
+    def rollback(self):
+        if not self.batching and self.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+            count_round_trip()
+        super().rollback()
+
+
+class BatchResult:
+    """The rows of one queued statement, available once the batch has run."""
+
+    def __init__(self, then=None):
+        self._then = then
+        self._done = False
+        self._value = None
+
+    def _set(self, rows):
+        self._value = self._then(rows) if self._then is not None else rows
+        self._done = True
+
+    @property
+    def value(self):
+        """The fetched rows (or what `then` made of them)."""
+        if not self._done:
+            raise RuntimeError("the batch has not been run yet")
+        return self._value
+
+    def first(self):
+        """The first row, or None if there were no rows."""
+        return self.value[0] if self.value else None
+
+
+def resolved(value):
+    """Return a BatchResult that already holds `value` (e.g. a cached list)."""
+    result = BatchResult()
+    result._value = value
+    result._done = True
+    return result
+
+
+class QueryBatch:
+    """Statements queued on one connection, sent together by run()."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._queued = []
+
+    def add(self, sql, params=None, row_factory=None, then=None, prepare=None):
+        """Queue a statement and return the BatchResult its rows will go to.
+
+        `then`, if given, is applied to the fetched rows and its return value
+        becomes the result's value. `prepare` is passed on to execute().
+        """
+        result = BatchResult(then)
+        self._queued.append((sql, params, row_factory, prepare, result))
+        return result
+
+    def run(self, commit=False):
+        """Send every queued statement (and a COMMIT, if asked) and fetch the results."""
+        queued, self._queued = self._queued, []
+        if not queued and not commit:
+            return
+        conn = self.conn
+        if not psycopg.Pipeline.is_supported():
+            # libpq older than 14: same results, one round trip per statement
+            for sql, params, row_factory, prepare, result in queued:
+                with conn.cursor(row_factory=row_factory) as cur:
+                    cur.execute(sql, params, prepare=prepare)
+                    result._set(cur.fetchall() if cur.description is not None else [])
+            if commit:
+                conn.commit()
+            return
+
+        cursors = []
+        conn.batching = True
+        start = time.perf_counter()
+        try:
+            with conn.pipeline():
+                for sql, params, row_factory, prepare, result in queued:
+                    cur = conn.cursor(row_factory=row_factory)
+                    cur.execute(sql, params, prepare=prepare)
+                    cursors.append((cur, result))
+                if commit:
+                    conn.commit()
+        finally:
+            elapsed = time.perf_counter() - start
+            conn.batching = False
+            count_round_trip()
+        for (cur, result), (sql, params, *_) in zip(cursors, queued):
+            result._set(cur.fetchall() if cur.description is not None else [])
+            if statement_hook is not None:
+                statement_hook(conn, sql, params, elapsed, cur.rowcount, len(queued), False)
+            cur.close()
@@ -0,0 +1,266 @@
+"""Route-level load benchmark.
+
+    flask --app app bench --username admin --password secret
+    flask --app app bench --url http://127.0.0.1:5000 --concurrency 8 --compare bench-results/old.json
+
+Drives every blueprint page, the JSON API and both exports, either
+in-process through the Flask test client (the default) or against a running
+server (--url), and reports throughput and p50/p95/p99 latency per route.
+Each run is saved as a JSON file under bench-results/ so runs can be
+compared with --compare.
+The account must exist and should be an admin so the admin-only pages are
+included.
+"""
+import http.cookiejar
+import json
+import os
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timezone
+import click
+from flask import current_app
+from utilities import get_db_connection
+
+RESULTS_DIR = 'bench-results'
+
+
+def default_routes(conn):
+    """Return [(name, path)] covering every blueprint page, the JSON API and both exports.
+
+    Detail pages use an existing project and employee picked from the data.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT MIN(Pnumber) FROM Project")
+        pno = cur.fetchone()[0]
+        cur.execute("SELECT MIN(Ssn) FROM Employee")
+        ssn = cur.fetchone()[0]
+        cur.execute("SELECT MIN(Dnumber) FROM Department")
+        dno = cur.fetchone()[0]
+        # A batch of keys for the JSON API, as a client page would ask for
+        cur.execute("SELECT string_agg(Ssn, ',') FROM (SELECT Ssn FROM Employee ORDER BY Ssn LIMIT 20) e")
+        ssns = cur.fetchone()[0] or ''
+        cur.execute("SELECT string_agg(Pnumber::text, ',') FROM (SELECT Pnumber FROM Project ORDER BY Pnumber LIMIT 20) p")
+        pnos = cur.fetchone()[0] or ''
+    return [
+        ('home', '/'),
+        ('home_by_hours', '/?sort_by=total_hours&order=desc'),
+        ('home_filtered', f'/?dept={dno}&q=smith'),
+        ('home_no_count', '/?count=0'),
+        ('projects', '/projects/'),
+        ('projects_by_headcount', '/projects/?sort_by=headcount&order=desc'),
+        ('project_detail', f'/projects/{pno}'),
+        ('managers', '/managers/'),
+        ('employees', '/employees/'),
+        ('employee_edit_form', f'/employees/{ssn}/edit'),
+        ('employee_add_form', '/employees/add'),
+        ('employee_import_form', '/employees/import'),
+        ('search', '/search/employees?q=smi'),
+        ('employee_lookup', '/employees/lookup?q=smi'),
+        ('employee_lookup_dept', f'/employees/lookup?dept={dno}'),
+        ('export_home_csv', '/export'),
+        ('export_home_ndjson', '/export?format=ndjson'),
+        ('export_projects_csv', '/projects/export'),
+        ('export_projects_json', '/projects/export?format=json'),
+        ('api_employees', f'/api/employees?ids={ssns}'),
+        ('api_employees_fields', f'/api/employees?ids={ssns}&fields=full_name,department_name'),
+        ('api_projects', f'/api/projects?ids={pnos}'),
+        ('health_db', '/health-db'),
+    ]
+
+
+class TestClientDriver:
+    """Sends requests in-process through the Flask test client."""
+
+    def __init__(self, app, username, password):
+        self.app, self.username, self.password = app, username, password
+
+    def session(self):
+        client = self.app.test_client()
+        response = client.post('/auth/login', data={'username': self.username, 'password': self.password})
+        if response.status_code != 302:
+            raise click.ClickException(f"login as {self.username!r} failed")
+
+        def get(path):
+            response = client.get(path)
+            size = sum(len(chunk) for chunk in response.response)    # drain streamed bodies
+            response.close()
+            return response.status_code, size
+        return get
+
+
+class HttpDriver:
+    """Sends requests to a running server, one cookie-keeping opener per thread."""
+
+    def __init__(self, base_url, username, password):
+        self.base_url, self.username, self.password = base_url.rstrip('/'), username, password
+
+    def session(self):
+        class NoRedirect(urllib.request.HTTPRedirectHandler):
+            def redirect_request(self, *args, **kwargs):
+                return None
+        opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+        data = urllib.parse.urlencode({'username': self.username, 'password': self.password}).encode()
+        try:
+            opener.open(self.base_url + '/auth/login', data)
+        except urllib.error.HTTPError as e:
+            if e.code != 302:
+                raise click.ClickException(f"login as {self.username!r} failed: HTTP {e.code}")
+
+        def get(path):
+            try:
+                with opener.open(self.base_url + path) as response:
+                    return response.status, len(response.read())
+            except urllib.error.HTTPError as e:
+                return e.code, len(e.read())
+        return get
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def run_route(driver, path, requests, concurrency, warmup):
+    """Run `requests` GETs of `path` over `concurrency` threads; return the route's stats."""
+    sessions = [driver.session() for _ in range(concurrency)]
+    for _ in range(warmup):
+        sessions[0](path)
+    latencies = []
+    errors = []
+    sizes = []
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker(get):
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            status, size = get(path)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed * 1000)
+                sizes.append(size)
+                if status >= 400:
+                    errors.append(status)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(get,)) for get in sessions]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'path': path,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else None,
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else None,
+        'p50_ms': round(percentile(latencies, 50), 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95), 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99), 3) if latencies else None,
+        'max_ms': round(latencies[-1], 3) if latencies else None,
+        'mean_bytes': round(sum(sizes) / len(sizes)) if sizes else None,
+    }
+
+
+def table_sizes(conn):
+    """Approximate row counts of the company tables (from planner statistics)."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT relname, reltuples::bigint FROM pg_class WHERE relname = ANY(%s) ORDER BY relname",
+                    (['department', 'employee', 'project', 'works_on', 'dependent'],))
+        return dict(cur.fetchall())
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _compare(current, previous):
+    click.echo(f"\n{'route':<24} {'p50 ms':>16} {'p95 ms':>16} {'req/s':>16}")
+    for name, stats in current['routes'].items():
+        old = previous['routes'].get(name)
+        if not old:
+            continue
+        cells = []
+        for key in ('p50_ms', 'p95_ms', 'throughput_rps'):
+            if stats[key] is None or not old[key]:
+                cells.append(f"{'-':>16}")
+                continue
+            change = (stats[key] - old[key]) / old[key] * 100
+            cells.append(f"{stats[key]:>8.1f} {change:+6.1f}%")
+        click.echo(f"{name:<24} " + ' '.join(cells))
+
+
+@click.command('bench')
+@click.option('--username', default=lambda: os.environ.get('BENCH_USERNAME', 'admin'), show_default='admin',
+              help='Account to log in as (env BENCH_USERNAME).')
+@click.option('--password', default=lambda: os.environ.get('BENCH_PASSWORD'),
+              help='Its password (env BENCH_PASSWORD).')
+@click.option('--url', default=None, help='Benchmark a running server instead of the in-process test client.')
+@click.option('--requests', 'requests_per_route', default=100, show_default=True, help='Requests per route.')
+@click.option('--concurrency', default=1, show_default=True, help='Concurrent clients.')
+@click.option('--warmup', default=5, show_default=True, help='Unmeasured requests per route first.')
+@click.option('--route', 'only', multiple=True, help='Only run these routes (by name); repeatable.')
+@click.option('--output', default=None, help=f'Result file (default {RESULTS_DIR}/<timestamp>.json).')
+@click.option('--compare', 'compare_with', default=None, type=click.Path(exists=True),
+              help='Earlier result file to compare against.')
+def bench_command(username, password, url, requests_per_route, concurrency, warmup, only, output, compare_with):
+    """Measure throughput and latency percentiles of every route."""
+    if not password:
+        raise click.UsageError("give --password or set BENCH_PASSWORD")
+    with get_db_connection() as conn:
+        routes = default_routes(conn)
+        sizes = table_sizes(conn)
+    if only:
+        unknown = set(only) - {name for name, _ in routes}
+        if unknown:
+            raise click.BadParameter(f"unknown route(s): {', '.join(sorted(unknown))}")
+        routes = [(name, path) for name, path in routes if name in only]
+
+    driver = HttpDriver(url, username, password) if url else \
+        TestClientDriver(current_app._get_current_object(), username, password)
+    started = datetime.now(timezone.utc)
+    results = {}
+    click.echo(f"{'route':<24} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for name, path in routes:
+        stats = results[name] = run_route(driver, path, requests_per_route, concurrency, warmup)
+        click.echo(f"{name:<24} {stats['throughput_rps']:>9} {stats['p50_ms']:>9} {stats['p95_ms']:>9} "
+                   f"{stats['p99_ms']:>9} {stats['errors']:>7}")
+
+    run = {
+        'started_at': started.isoformat(),
+        'commit': _git_commit(),
+        'target': url or 'test-client',
+        'requests_per_route': requests_per_route,
+        'concurrency': concurrency,
+        'table_rows': sizes,
+        'routes': results,
+    }
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, started.strftime('%Y%m%dT%H%M%SZ') + '.json')
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2)
+    click.echo(f"\nsaved {output}")
+
+    if compare_with:
+        with open(compare_with) as f:
+            _compare(run, json.load(f))
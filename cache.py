@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Every TTLCache created in this process, for cache_stats().
+_caches = []
+
+
+class TTLCache:
+    """A small thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    Used for per-process caches of data that is read on most requests but
+    changes rarely. Hit/miss counters are kept so they can be reported.
+
+    With `maxbytes`, entries are also evicted (least recently used first)
+    once the sizes passed to set() add up to more than that.
+
+    `generation` goes up on every invalidate() and clear(). A caller that
+    loads a value reads it first and passes it to set(), so a value loaded
+    before an invalidation that raced with the load is not stored.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0, name=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        _caches.append(self)
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default` if missing or expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, size=0, generation=None):
+        """Store `value` under `key`, evicting the least recently used entries if full.
+
+        `size` is the value's size in bytes, counted against `maxbytes`; a
+        value larger than `maxbytes` on its own is not stored. Neither is one
+        whose `generation` (read before loading it) is no longer current.
+        """
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._drop(key)
+            self._data[key] = (expires, value, size)
+            self._bytes += size
+            while len(self._data) > self.maxsize or (self.maxbytes is not None and self._bytes > self.maxbytes):
+                self._drop(next(iter(self._data)))
+
+    def _drop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def invalidate(self, key):
+        """Drop `key` from the cache if present."""
+        with self._lock:
+            self.generation += 1
+            self._drop(key)
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return the cache's counters as a dict."""
+        with self._lock:
+            stats = {
+                'name': self.name,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+            if self.maxbytes is not None:
+                stats.update(bytes=self._bytes, maxbytes=self.maxbytes)
+            return stats
+
+
+def cache_stats():
+    """Return the counters of every cache in this process."""
+    return [c.stats() for c in _caches]
@@ -0,0 +1,182 @@
+"""Grow the company data set to a realistic size for development and benchmarks.
+
+    flask --app app datagen --employees 1000000 --assignments 10000000
+
+New departments, projects, employees, assignments and dependents are added
+after the existing keys with COPY, in one transaction. As pg_restore does,
+the foreign keys of the loaded tables are dropped for the load and added
+back at the end, which validates every row in one pass per constraint
+instead of one lookup per row; if any row violated one, the whole load rolls
+back. CHECK and NOT NULL constraints stay in place. The summary-table
+triggers (user triggers) are switched off while loading, and the summary
+tables are rebuilt from the base tables at the end (see rollups.py).
+"""
+import random
+import time
+from datetime import date, timedelta
+import click
+from psycopg import sql
+from utilities import get_db_connection
+import rollups
+
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'William',
+               'Elizabeth', 'David', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah',
+               'Ahmad', 'Alicia', 'Franklin', 'Jennifer', 'Ramesh', 'Joyce', 'Priya', 'Wei', 'Fatima', 'Omar']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez',
+              'Martinez', 'Wong', 'Zelaya', 'Wallace', 'Narayan', 'English', 'Jabbar', 'Borg', 'Nguyen',
+              'Patel', 'Kim', 'Chen', 'Okafor', 'Silva', 'Novak', 'Haddad', 'Larsen', 'Moreau', 'Tanaka']
+STREETS = ['Fondren', 'Voss', 'Castle', 'Berry', 'Rice', 'Stone', 'Dallas', 'Fire Oak', 'Main', 'Elm']
+CITIES = ['Houston TX', 'Spring TX', 'Humble TX', 'Bellaire TX', 'Sugarland TX', 'Austin TX']
+RELATIONSHIPS = ['Spouse', 'Son', 'Daughter']
+PROJECT_WORDS = ['Product', 'Reorganization', 'Computerization', 'Newbenefits', 'Migration', 'Audit',
+                 'Outreach', 'Platform', 'Analytics', 'Logistics']
+
+# Tables loaded with COPY; their foreign keys and user triggers are off during the load
+LOADED_TABLES = ['Department', 'Dept_Location', 'Project', 'Employee', 'Works_On', 'Dependent']
+
+
+def _next_int_key(cur, table, column):
+    cur.execute(f"SELECT COALESCE(MAX({column}), 0) + 1 FROM {table}")
+    return cur.fetchone()[0]
+
+
+def _next_ssn(cur):
+    cur.execute("SELECT COALESCE(MAX(Ssn::bigint), 0) + 1 FROM Employee WHERE Ssn ~ '^[0-9]{9}$'")
+    return max(cur.fetchone()[0], 100000000)
+
+
+def _random_date(rng, start_year, end_year):
+    start = date(start_year, 1, 1)
+    return start + timedelta(days=rng.randrange((date(end_year, 1, 1) - start).days))
+
+
+def _copy(cur, table, columns, rows):
+    count = 0
+    with cur.copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN") as copy:
+        for row in rows:
+            copy.write_row(row)
+            count += 1
+    return count
+
+
+def _load(cur, rng, added, departments, projects, employees, assignments, dependents,
+          first_dno, first_pno, first_ssn, echo):
+    """COPY the new rows in with the foreign keys dropped and user triggers off, then restore them."""
+    cur.execute(
+        "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE contype = 'f' AND conrelid = ANY(%s::regclass[])", (LOADED_TABLES,))
+    foreign_keys = cur.fetchall()
+    for table, name, _ in foreign_keys:
+        cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(sql.SQL(table), sql.Identifier(name)))
+    for table in LOADED_TABLES:
+        cur.execute(f"ALTER TABLE {table} DISABLE TRIGGER USER")
+
+    def timed(table, columns, rows):
+        start = time.perf_counter()
+        added[table] = _copy(cur, table, columns, rows)
+        echo(f"{table}: {added[table]} rows in {time.perf_counter() - start:.1f}s")
+
+    dnos = range(first_dno, first_dno + departments)
+    pnos = range(first_pno, first_pno + projects)
+    ssns = [f"{n:09d}" for n in range(first_ssn, first_ssn + employees)]
+    # The first employee of each new department manages it and supervises the rest.
+    managers = {dno: ssns[i] for i, dno in enumerate(dnos) if i < len(ssns)}
+
+    timed('Department', ['Dname', 'Dnumber', 'Mgr_ssn'],
+          ((f"Department {dno}", dno, managers.get(dno)) for dno in dnos))
+    timed('Dept_Location', ['Dnumber', 'Dlocation'],
+          ((dno, rng.choice(CITIES)[:-3]) for dno in dnos))
+    timed('Project', ['Pname', 'Pnumber', 'Plocation', 'Dnum'],
+          ((f"{rng.choice(PROJECT_WORDS)} {pno}"[:30], pno, rng.choice(CITIES)[:-3], rng.choice(dnos))
+           for pno in pnos))
+
+    def employee_rows():
+        for i, ssn in enumerate(ssns):
+            dno = dnos[i % departments]
+            manager = managers[dno]
+            yield (rng.choice(FIRST_NAMES), chr(65 + rng.randrange(26)), rng.choice(LAST_NAMES), ssn,
+                   f"{rng.randrange(100, 9999)} {rng.choice(STREETS)}, {rng.choice(CITIES)}",
+                   rng.choice('MF'), rng.randrange(25000, 150000, 500),
+                   None if manager == ssn else manager, dno,
+                   _random_date(rng, 1955, 2003), _random_date(rng, 2000, 2025))
+    timed('Employee', ['Fname', 'Minit', 'Lname', 'Ssn', 'Address', 'Sex', 'Salary', 'Super_ssn', 'Dno',
+                       'BDate', 'EmpDate'], employee_rows())
+
+    def works_on_rows():
+        # Spread the assignments evenly; each employee's projects are distinct.
+        per_employee, extra = divmod(assignments, employees) if employees else (0, 0)
+        for i, ssn in enumerate(ssns):
+            for pno in rng.sample(pnos, per_employee + (i < extra)):
+                yield ssn, pno, rng.randrange(0, 400) / 10
+    timed('Works_On', ['Essn', 'Pno', 'Hours'], works_on_rows())
+
+    def dependent_rows():
+        per_employee, extra = divmod(dependents, employees) if employees else (0, 0)
+        for i, ssn in enumerate(ssns):
+            for k in range(per_employee + (i < extra)):
+                relationship = 'Spouse' if k == 0 else rng.choice(RELATIONSHIPS[1:])
+                yield (ssn, f"{rng.choice(FIRST_NAMES)} {k + 1}", rng.choice('MF'),
+                       _random_date(rng, 1950, 2024), relationship)
+    timed('Dependent', ['Essn', 'Dependent_name', 'Sex', 'Bdate', 'Relationship'], dependent_rows())
+
+    for table in LOADED_TABLES:
+        cur.execute(f"ALTER TABLE {table} ENABLE TRIGGER USER")
+    start = time.perf_counter()
+    for table, name, definition in foreign_keys:
+        cur.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+            sql.SQL(table), sql.Identifier(name), sql.SQL(definition)))
+    echo(f"{len(foreign_keys)} foreign keys validated in {time.perf_counter() - start:.1f}s")
+
+
+def generate(conn, departments, projects, employees, assignments, dependents, seed=0, echo=print):
+    """Add the given numbers of rows to each table and commit; returns {table: rows added}."""
+    if min(departments, projects, employees, assignments, dependents) < 0:
+        raise click.UsageError("row counts can't be negative")
+    if (projects or employees) and not departments:
+        raise click.UsageError("new projects and employees need at least one new department")
+    if assignments > employees * projects:
+        raise click.UsageError("more assignments than (employee, project) pairs")
+    if dependents and not employees:
+        raise click.UsageError("new dependents need at least one new employee")
+    rng = random.Random(seed)
+    added = {}
+    with conn.cursor() as cur:
+        first_dno = _next_int_key(cur, 'Department', 'Dnumber')
+        first_pno = _next_int_key(cur, 'Project', 'Pnumber')
+        first_ssn = _next_ssn(cur)
+        if first_ssn + employees > 999999999:
+            raise click.UsageError(f"not enough 9-digit SSNs left for {employees} more employees")
+        try:
+            _load(cur, rng, added, departments, projects, employees, assignments, dependents,
+                  first_dno, first_pno, first_ssn, echo)
+        except BaseException:
+            # The DDL is part of the load's transaction, so rolling back puts the
+            # foreign keys and triggers back as well as dropping the new rows.
+            conn.rollback()
+            raise
+    conn.commit()
+
+    for name in rollups.ROLLUPS:
+        start = time.perf_counter()
+        rollups.rebuild(conn, name)
+        echo(f"{name}: rebuilt in {time.perf_counter() - start:.1f}s")
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        for table in LOADED_TABLES:
+            cur.execute(f"ANALYZE {table}")
+    return added
+
+
+@click.command('datagen')
+@click.option('--departments', default=100, show_default=True, help='Departments to add.')
+@click.option('--projects', default=1000, show_default=True, help='Projects to add.')
+@click.option('--employees', default=100000, show_default=True, help='Employees to add.')
+@click.option('--assignments', default=1000000, show_default=True, help='Works_On rows to add.')
+@click.option('--dependents', default=100000, show_default=True, help='Dependents to add.')
+@click.option('--seed', default=0, show_default=True, help='Random seed, for repeatable data sets.')
+def datagen_command(departments, projects, employees, assignments, dependents, seed):
+    """Add synthetic rows to every company table using COPY."""
+    start = time.perf_counter()
+    with get_db_connection() as conn:
+        generate(conn, departments, projects, employees, assignments, dependents, seed, echo=click.echo)
+    click.echo(f"done in {time.perf_counter() - start:.1f}s")
@@ -1,7 +1,20 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, g
-from utilities import get_db_connection
+from flask import Blueprint, render_template, request, redirect, url_for, flash, g, jsonify, send_file
+from utilities import get_db, read_only
+from versions import conditional
+import resultcache
+import queries
+from pagination import Keyset, Page, get_per_page
+from exports import write_export
+from export_jobs import EXPORT_SPOOL_DIR, EXPORT_SPOOL_MAX_AGE
 import psycopg
 import logging
+import csv
+import glob
+import io
+import os
+import re
+import secrets
+import time
 
 # Module logger for server-side error logging. 
 logger = logging.getLogger(__name__)
@@ -26,25 +39,36 @@ def require_admin_role():
         return redirect(url_for('home.home'))
 
 @bp.route('/')
+@read_only
+@conditional('employee')
 def list_employees():
-    """Return the employees list page."""
-    conn = get_db_connection()
-    rows = []
+    """Return one page of the employees list.
+
+    Query parameters: `per_page`, `cursor` (from the Next/Previous links) and
+    `count=0` to skip counting all employees.
+    """
+    per_page = get_per_page(request.args)
+    with_count = request.args.get('count', '1') != '0'
+    keyset = Keyset('name', queries.EMPLOYEE_LIST_KEYS, request.args.get('cursor'), per_page)
+    _, params = keyset.where()
+
+    conn = get_db()
+    page = Page([], None, None)
+    total = None
     try:
         with conn.cursor() as cur:
-            # Select commonly displayed fields and order by last name, first name.
-            cur.execute(
-                "SELECT Ssn, Fname, Minit, Lname, Address, Sex, Salary, Super_ssn, Dno"
-                " FROM Employee ORDER BY Lname, Fname"
-            )
-            rows = cur.fetchall()
+            # Select commonly displayed fields for one page.
+            queries.execute(cur, 'employee_page', params + [keyset.limit], cursor=keyset.direction)
+            page = keyset.page(cur.fetchall())
+            if with_count:
+                queries.execute(cur, 'employee_count')
+                total = cur.fetchone()[0]
     except Exception as e:
         # Log the full exception server-side for debugging and show a
         # user-friendly message in the UI.
         logger.exception('Error fetching employee list')
         flash('An error occurred while loading employees. Please try again later.')
-    finally:
-        conn.close()
+    rows = page.items
 
     # Map SQL row tuples to dictionaries. Makes things easier to work with in templates.
     # The full_name field normalizes missing middle initials.
@@ -63,7 +87,98 @@ def list_employees():
 
     # Render the list template. Template will handle role-based UI (e.g.
     # showing Add/Delete buttons to admins only) by inspecting `g.user`.
-    return render_template('employees.html', employees=employees)
+    return render_template('employees.html', employees=employees, per_page=per_page, total=total,
+                           next_cursor=page.next_cursor, prev_cursor=page.prev_cursor)
+
+
+# Page size of the employee picker's lookup
+LOOKUP_DEFAULT_LIMIT = 20
+LOOKUP_MAX_LIMIT = 100
+
+
+def _prefix_range(prefix):
+    """Return (low, high) such that low <= s < high exactly when s starts with `prefix` (byte order)."""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+@bp.route('/lookup')
+@read_only
+@conditional('employee', 'department', 'works_on')
+def lookup_employees():
+    """One page of employees for the type-ahead picker, as JSON.
+
+    Query parameters:
+        q                digits: SSN prefix; otherwise a prefix of "Lastname Firstname"
+                         (case-insensitive; "smith, jo" and "smith jo" are the same)
+        dept             only employees of this department
+        exclude_project  leave out employees already assigned to this project
+        cursor           `next_cursor` of the previous page
+        limit            page size (default 20, at most 100)
+
+    Every combination is served from an index (idx_employee_sort_name,
+    idx_employee_dept_sort_name or the Employee primary key), so a page costs
+    the same however many employees there are.
+    """
+    q = ' '.join((request.args.get('q') or '').replace(',', ' ').lower().split())
+    dept = request.args.get('dept', type=int)
+    exclude_project = request.args.get('exclude_project', type=int)
+    limit = max(1, min(request.args.get('limit', LOOKUP_DEFAULT_LIMIT, type=int), LOOKUP_MAX_LIMIT))
+    by = 'ssn' if q.isdigit() else 'name'
+    keyset = Keyset(f"lookup-{by}", queries.employee_lookup_keys(by), request.args.get('cursor'), limit)
+
+    # Parameters in the order the query's variant expects them (see queries.py)
+    params = []
+    if dept is not None:
+        params.append(dept)
+    if by == 'ssn':
+        # SSNs are 9 digits: a prefix covers every SSN between it padded with 0s and with 9s
+        params.extend([q[:9].ljust(9, '0'), q[:9].ljust(9, '9')])
+    elif q:
+        params.extend(_prefix_range(q))
+    if exclude_project is not None:
+        params.append(exclude_project)
+    _, cursor_params = keyset.where()
+    params += cursor_params + [keyset.limit]
+
+    conn = get_db()
+    with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
+        queries.execute(cur, 'employee_lookup', params, by=by, q=bool(q), dept=dept is not None,
+                        exclude=exclude_project is not None, cursor=keyset.direction)
+        page = keyset.page(cur.fetchall())
+
+    results = [
+        {
+            'ssn': r['ssn'],
+            'full_name': f"{r['fname']} {r['minit'] or ''} {r['lname']}".replace('  ', ' ').strip(),
+            'department_name': r['department_name'],
+        }
+        for r in page.items
+    ]
+    return jsonify(q=q, results=results, next_cursor=page.next_cursor)
+
+
+def split_full_name(full_name):
+    """Split a single "First [Middle ...] Last" string into (fname, minit, lname).
+
+    The first token is the first name and the last token is the last name.
+    The middle initial is the first character of the second token when there
+    are three or more tokens, otherwise ''. Raises ValueError if there are
+    fewer than two tokens.
+    """
+    parts = full_name.strip().split()
+    if len(parts) < 2:
+        raise ValueError('Full Name must include at least first and last name.')
+    fname = parts[0]
+    lname = parts[-1]
+    if len(parts) == 3:
+        # Use the middle token as middle initial (single char preferred)
+        mid = parts[1]
+        minit = mid[0] if mid else ''
+    else:
+        # If there are more than 3 tokens, just take the second token
+        # as the middle initial (best-effort).
+        minit = parts[1][0] if len(parts) > 2 and parts[1] else ''
+    return fname, minit, lname
 
 
 @bp.route('/add', methods=('GET', 'POST'))
@@ -109,20 +224,11 @@ def add_employee():
         # treated as middle initial (first character). If parsing fails we
         # surface a clear error to the user.
         if not (fname and lname) and full_name:
-            parts = full_name.strip().split()
-            if len(parts) < 2:
-                flash('Full Name must include at least first and last name.')
+            try:
+                fname, minit, lname = split_full_name(full_name)
+            except ValueError as e:
+                flash(str(e))
                 return redirect(url_for('.add_employee'))
-            fname = parts[0]
-            lname = parts[-1]
-            if len(parts) == 3:
-                # Use the middle token as middle initial (single char preferred)
-                mid = parts[1]
-                minit = mid[0] if mid else ''
-            else:
-                # If there are more than 3 tokens, just take the second token
-                # as the middle initial (best-effort).
-                minit = parts[1][0] if len(parts) > 2 and parts[1] else ''
 
         # Validate numeric fields with clear error messages so users know what to fix
         try:
@@ -138,40 +244,38 @@ def add_employee():
             flash('Department number (Dno) must be an integer.')
             return redirect(url_for('.add_employee'))
 
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cur:
-                try:
-                    cur.execute(
-                        "INSERT INTO Employee (Fname, Minit, Lname, Ssn, Address, Sex, Salary, Super_ssn, Dno, BDate, EmpDate) "
-                        "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
-                        (fname, minit, lname, ssn, address, sex, salary, super_ssn, dno, bdate, empdate)
-                    )
-                    conn.commit()
-                    flash('Employee added')
-                    return redirect(url_for('.list_employees'))
-                except Exception as e:
-                    # Log the full exception server-side for diagnostics.
-                    logger.exception('Error inserting new employee')
-                    # Database error handling
-                    # show friendlier, actionable messages to the user.
-                    msg = str(e)
-                    sqlstate = getattr(e, 'sqlstate', None)
-                    if sqlstate == '23505':
-                        # unique violation (SSN already exists)
-                        flash('SSN already exists. Choose a different SSN.')
-                    elif sqlstate == '23503':
-                        # foreign key violation: department or supervisor not found
-                        flash('Foreign key error: check that Department (Dno) and Supervisor SSN exist.')
-                    elif sqlstate == '22P02':
-                        # invalid_text_representation (e.g. converting a string to int)
-                        flash('Invalid input format: check numeric/date fields.')
-                    else:
-                        # Fallback to a generic message while avoiding raw DB text
-                        flash('An error occurred while adding the employee. Please check your input and try again.')
-                    return redirect(url_for('.add_employee'))
-        finally:
-            conn.close()
+        conn = get_db()
+        with conn.cursor() as cur:
+            try:
+                cur.execute(
+                    "INSERT INTO Employee (Fname, Minit, Lname, Ssn, Address, Sex, Salary, Super_ssn, Dno, BDate, EmpDate) "
+                    "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+                    (fname, minit, lname, ssn, address, sex, salary, super_ssn, dno, bdate, empdate)
+                )
+                conn.commit()
+                resultcache.invalidate()
+                flash('Employee added')
+                return redirect(url_for('.list_employees'))
+            except Exception as e:
+                # Log the full exception server-side for diagnostics.
+                logger.exception('Error inserting new employee')
+                # Database error handling
+                # show friendlier, actionable messages to the user.
+                msg = str(e)
+                sqlstate = getattr(e, 'sqlstate', None)
+                if sqlstate == '23505':
+                    # unique violation (SSN already exists)
+                    flash('SSN already exists. Choose a different SSN.')
+                elif sqlstate == '23503':
+                    # foreign key violation: department or supervisor not found
+                    flash('Foreign key error: check that Department (Dno) and Supervisor SSN exist.')
+                elif sqlstate == '22P02':
+                    # invalid_text_representation (e.g. converting a string to int)
+                    flash('Invalid input format: check numeric/date fields.')
+                else:
+                    # Fallback to a generic message while avoiding raw DB text
+                    flash('An error occurred while adding the employee. Please check your input and try again.')
+                return redirect(url_for('.add_employee'))
 
     # GET: render an empty form for creating a new employee. The template uses
     # `employee is None` to decide whether to show the Add form.
@@ -186,63 +290,61 @@ def edit_employee(ssn):
     POST: update the editable fields (Address, Salary, Dno). Only users with
     `role == 'admin'` are allowed to perform the POST.
     """
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            # Fetch the existing employee record by primary key (Ssn)
-            cur.execute(
-                "SELECT Ssn, Fname, Minit, Lname, Address, Sex, Salary, Super_ssn, Dno"
-                " FROM Employee WHERE Ssn = %s",
-                (ssn,)
-            )
-            row = cur.fetchone()
-            if row is None:
-                # If the requested SSN does not exist, return a 404 response.
-                return "Employee not found", 404
-
-            if request.method == 'POST':
-                # Server-side RBAC: ensure only admins may modify employee data.
-                if g.get('user') is None or g.get('user').get('role') != 'admin':
-                    flash('You do not have permission to edit employees.')
-                    return redirect(url_for('.list_employees'))
-
-                # Pull only the editable fields from the submitted form
-                address = request.form.get('address') or ''
-                salary = request.form.get('salary') or 0
-                dno = request.form.get('dno')
-                try:
-                    cur.execute(
-                        "UPDATE Employee SET Address = %s, Salary = %s, Dno = %s WHERE Ssn = %s",
-                        (address, salary, dno, ssn)
-                    )
-                    conn.commit()
-                    flash('Employee updated')
-                    return redirect(url_for('.list_employees'))
-                except Exception as e:
-                    # Log full exception details and show a friendly message.
-                    logger.exception('Error updating employee %s', ssn)
-                    flash('An error occurred while updating the employee. Please try again.')
-                    return redirect(url_for('.edit_employee', ssn=ssn))
-
-            # Build a dictionary representing the employee to pass to the
-            # template. The form will render fields in a read-only or editable
-            # manner depending on whether it's Add vs Edit.
-            # Include `full_name` so the edit form can render a single
-            # read-only Full Name input (keeps UI consistent with the list page).
-            employee = {
-                'ssn': row[0],
-                'fname': row[1],
-                'minit': row[2],
-                'lname': row[3],
-                'full_name': f"{row[1]} {row[2] or ''} {row[3]}".replace('  ', ' '),
-                'address': row[4],
-                'sex': row[5],
-                'salary': row[6],
-                'super_ssn': row[7],
-                'dno': row[8]
-            }
-    finally:
-        conn.close()
+    conn = get_db()
+    with conn.cursor() as cur:
+        # Fetch the existing employee record by primary key (Ssn)
+        cur.execute(
+            "SELECT Ssn, Fname, Minit, Lname, Address, Sex, Salary, Super_ssn, Dno"
+            " FROM Employee WHERE Ssn = %s",
+            (ssn,)
+        )
+        row = cur.fetchone()
+        if row is None:
+            # If the requested SSN does not exist, return a 404 response.
+            return "Employee not found", 404
+
+        if request.method == 'POST':
+            # Server-side RBAC: ensure only admins may modify employee data.
+            if g.get('user') is None or g.get('user').get('role') != 'admin':
+                flash('You do not have permission to edit employees.')
+                return redirect(url_for('.list_employees'))
+
+            # Pull only the editable fields from the submitted form
+            address = request.form.get('address') or ''
+            salary = request.form.get('salary') or 0
+            dno = request.form.get('dno')
+            try:
+                cur.execute(
+                    "UPDATE Employee SET Address = %s, Salary = %s, Dno = %s WHERE Ssn = %s",
+                    (address, salary, dno, ssn)
+                )
+                conn.commit()
+                resultcache.invalidate()
+                flash('Employee updated')
+                return redirect(url_for('.list_employees'))
+            except Exception as e:
+                # Log full exception details and show a friendly message.
+                logger.exception('Error updating employee %s', ssn)
+                flash('An error occurred while updating the employee. Please try again.')
+                return redirect(url_for('.edit_employee', ssn=ssn))
+
+        # Build a dictionary representing the employee to pass to the
+        # template. The form will render fields in a read-only or editable
+        # manner depending on whether it's Add vs Edit.
+        # Include `full_name` so the edit form can render a single
+        # read-only Full Name input (keeps UI consistent with the list page).
+        employee = {
+            'ssn': row[0],
+            'fname': row[1],
+            'minit': row[2],
+            'lname': row[3],
+            'full_name': f"{row[1]} {row[2] or ''} {row[3]}".replace('  ', ' '),
+            'address': row[4],
+            'sex': row[5],
+            'salary': row[6],
+            'super_ssn': row[7],
+            'dno': row[8]
+        }
 
     return render_template('employee_form.html', action='Edit', employee=employee)
 
@@ -255,26 +357,214 @@ def delete_employee(ssn):
         flash('You do not have permission to delete employees.')
         return redirect(url_for('.list_employees'))
 
-    conn = get_db_connection()
+    conn = get_db()
+    with conn.cursor() as cur:
+        try:
+            # Safe, parameterized DELETE.
+            cur.execute('DELETE FROM Employee WHERE Ssn = %s', (ssn,))
+            conn.commit()
+            resultcache.invalidate()
+            flash('Employee deleted')
+        except Exception as e:
+            # Log details and give a friendly error message on delete
+            logger.exception('Error deleting employee %s', ssn)
+            # Try to detect a PostgreSQL foreign-key constraint error to
+            # provide a clearer message to the user.
+            sqlstate = getattr(e, 'sqlstate', None)
+            if sqlstate == '23503':
+                # 23503 == foreign_key_violation
+                flash('Cannot delete employee: They are still assigned to projects, have dependents listed, or are a manager/supervisor.')
+            else:
+                flash('An error occurred while deleting the employee. Please try again.')
+
+    return redirect(url_for('.list_employees'))
+
+
+# Columns of the temporary staging table used by import_employees(). Every
+# value is loaded as text so that bad input can be reported per row instead
+# of failing the COPY.
+IMPORT_COLUMNS = ['line', 'ssn', 'fname', 'minit', 'lname', 'address', 'sex',
+                  'salary', 'super_ssn', 'dno', 'bdate', 'empdate', 'error']
+
+# Set-wise checks run against the staging table, in order. Each marks the rows
+# that match (and have no earlier error) with its message. Values are checked
+# with regular expressions before they are cast (inside CASE, which PostgreSQL
+# evaluates in order), so a bad value is reported instead of failing the
+# UPDATE on any server version.
+NUMBER_PATTERN = "'^[+-]?([0-9]+([.][0-9]*)?|[.][0-9]+)$'"
+DATE_PATTERN = "'^[0-9]{4}-(0[1-9]|1[0-2])-(0[1-9]|[12][0-9]|3[01])$'"
+
+
+def _not_a_date(column):
+    # YYYY-MM-DD, and a day that exists in that month
+    return (f"{column} IS NOT NULL AND CASE WHEN {column} ~ {DATE_PATTERN} AND substr({column}, 1, 4) <> '0000' "
+            f"THEN substr({column}, 9, 2)::int > extract(day from make_date(substr({column}, 1, 4)::int, "
+            f"substr({column}, 6, 2)::int, 1) + interval '1 month - 1 day') ELSE true END")
+
+
+IMPORT_CHECKS = [
+    ("ssn IS NULL", "Missing SSN"),
+    ("dno IS NULL", "Missing Department (Dno)"),
+    ("ssn !~ '^[0-9]{9}$'", "SSN must be exactly 9 digits"),
+    ("length(fname) > 20 OR length(lname) > 30", "Name is too long (first name max 20, last name max 30 characters)"),
+    ("length(address) > 50", "Address is too long (max 50 characters)"),
+    ("sex IS NOT NULL AND length(sex) > 1", "Sex must be a single character"),
+    (f"salary IS NOT NULL AND CASE WHEN salary ~ {NUMBER_PATTERN} "
+     "THEN NOT ROUND(salary::numeric) BETWEEN -2147483648 AND 2147483647 ELSE true END",
+     "Salary must be a number (e.g. 45000 or 45000.00)."),
+    ("dno !~ '^[+-]?[0-9]{1,9}$'", "Department number (Dno) must be an integer."),
+    (_not_a_date('bdate'), "Birth date (bdate) must be a date (YYYY-MM-DD)."),
+    (_not_a_date('empdate'), "Employment date (empdate) must be a date (YYYY-MM-DD)."),
+    ("super_ssn IS NOT NULL AND super_ssn !~ '^[0-9]{9}$'", "Supervisor SSN must be exactly 9 digits"),
+    ("line > (SELECT MIN(o.line) FROM employee_import o WHERE o.ssn = employee_import.ssn)",
+     "Duplicate SSN in file (only its first line is used)"),
+    ("EXISTS (SELECT 1 FROM Employee e WHERE e.Ssn = employee_import.ssn)", "SSN already exists."),
+    ("NOT EXISTS (SELECT 1 FROM Department d WHERE d.Dnumber = employee_import.dno::int)",
+     "Department (Dno) does not exist."),
+]
+
+# A supervisor may be an existing employee or another valid row of the same
+# file. Repeated until no more rows change, since rejecting a row can orphan
+# the rows it supervises.
+IMPORT_SUPERVISOR_CHECK = (
+    "UPDATE employee_import SET error = 'Supervisor SSN does not exist.' "
+    "WHERE error IS NULL AND super_ssn IS NOT NULL "
+    "AND NOT EXISTS (SELECT 1 FROM Employee e WHERE e.Ssn = employee_import.super_ssn) "
+    "AND NOT EXISTS (SELECT 1 FROM employee_import s WHERE s.ssn = employee_import.super_ssn AND s.error IS NULL)"
+)
+
+
+def _import_rows(upload):
+    """Yield one staging-table tuple per data line of the uploaded CSV.
+
+    Headers are matched case-insensitively. Names may be given as
+    fname/minit/lname or as full_name, which is split with the same rules as
+    the Add Employee form. Blank values become NULL.
+    """
+    text = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    reader = csv.DictReader(text)
+    if reader.fieldnames:
+        reader.fieldnames = [(name or '').strip().lower() for name in reader.fieldnames]
+    for record in reader:
+        value = lambda key: ((record.get(key) or '').strip() or None)
+        fname, minit, lname = value('fname'), value('minit') or '', value('lname')
+        full_name = value('full_name')
+        error = None
+        if not (fname and lname):
+            if full_name:
+                try:
+                    fname, minit, lname = split_full_name(full_name)
+                except ValueError as e:
+                    error = str(e)
+            else:
+                error = 'Missing First name and Last name (or provide Full Name)'
+        yield (reader.line_num, value('ssn'), fname, minit[:1], lname, value('address'), value('sex'),
+               value('salary'), value('super_ssn'), value('dno'), value('bdate'), value('empdate'), error)
+
+
+# Reports of rejected import rows are kept with the background exports (see
+# export_jobs.py) so any worker on this host can serve them, and for as long.
+_REPORT_ID = re.compile(r'^[0-9a-f]{24}$')
+
+
+def _import_report_path(report):
+    return os.path.join(EXPORT_SPOOL_DIR, f'import-errors-{report}.csv')
+
+
+def _save_import_report(rejected):
+    """Write the rejected rows to a CSV file and return its id for import_report()."""
+    os.makedirs(EXPORT_SPOOL_DIR, exist_ok=True)
+    now = time.time()
+    for path in glob.glob(_import_report_path('*')):
+        try:
+            if now - os.path.getmtime(path) > EXPORT_SPOOL_MAX_AGE:
+                os.remove(path)
+        except OSError:
+            pass
+    report = secrets.token_hex(12)
+    with open(_import_report_path(report), 'w', encoding='utf-8', newline='') as f:
+        write_export(f, [('line', 'Line'), ('ssn', 'SSN'), ('error', 'Error')], rejected)
+    return report
+
+
+@bp.route('/import', methods=('GET', 'POST'))
+def import_employees():
+    """Bulk-add employees from an uploaded CSV file.
+
+    The file is streamed into a temporary staging table with COPY, every row
+    is validated with a handful of set-wise UPDATEs (see IMPORT_CHECKS), and
+    the valid rows are inserted with a single INSERT ... SELECT, all in one
+    transaction. If any rows were rejected the user comes back to this page
+    with the counts and a link to a CSV report of them (line, ssn, error);
+    otherwise they are sent back to the list.
+    """
+    if request.method == 'GET':
+        report = request.args.get('report', '')
+        report_url = url_for('.import_report', report=report) if _REPORT_ID.match(report) else None
+        return render_template('employee_import.html', report_url=report_url)
+
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        flash('Choose a CSV file to import.')
+        return redirect(url_for('.import_employees'))
+
+    conn = get_db()
     try:
         with conn.cursor() as cur:
-            try:
-                # Safe, parameterized DELETE.
-                cur.execute('DELETE FROM Employee WHERE Ssn = %s', (ssn,))
-                conn.commit()
-                flash('Employee deleted')
-            except Exception as e:
-                # Log details and give a friendly error message on delete
-                logger.exception('Error deleting employee %s', ssn)
-                # Try to detect a PostgreSQL foreign-key constraint error to
-                # provide a clearer message to the user.
-                sqlstate = getattr(e, 'sqlstate', None)
-                if sqlstate == '23503':
-                    # 23503 == foreign_key_violation
-                    flash('Cannot delete employee: They are still assigned to projects, have dependents listed, or are a manager/supervisor.')
-                else:
-                    flash('An error occurred while deleting the employee. Please try again.')
-    finally:
-        conn.close()
+            cur.execute(
+                "CREATE TEMP TABLE employee_import ("
+                + ", ".join(f"{col} {'INT' if col == 'line' else 'TEXT'}" for col in IMPORT_COLUMNS)
+                + ") ON COMMIT DROP"
+            )
+            with cur.copy(f"COPY employee_import ({', '.join(IMPORT_COLUMNS)}) FROM STDIN") as copy:
+                for row in _import_rows(upload):
+                    copy.write_row(row)
 
-    return redirect(url_for('.list_employees'))
+            for condition, message in IMPORT_CHECKS:
+                cur.execute(
+                    f"UPDATE employee_import SET error = %s WHERE error IS NULL AND ({condition})",
+                    (message,)
+                )
+            cur.execute(IMPORT_SUPERVISOR_CHECK)
+            while cur.rowcount:
+                cur.execute(IMPORT_SUPERVISOR_CHECK)
+
+            # Same defaults as the Add Employee form for optional fields
+            cur.execute(
+                "INSERT INTO Employee (Fname, Minit, Lname, Ssn, Address, Sex, Salary, Super_ssn, Dno, BDate, EmpDate) "
+                "SELECT fname, COALESCE(minit, ''), lname, ssn, COALESCE(address, ''), COALESCE(sex, 'M'), "
+                "ROUND(COALESCE(salary, '0')::numeric)::int, super_ssn, dno::int, bdate::date, empdate::date "
+                "FROM employee_import WHERE error IS NULL ORDER BY line"
+            )
+            imported = cur.rowcount
+            cur.execute("SELECT line, ssn, error FROM employee_import WHERE error IS NOT NULL ORDER BY line")
+            rejected = cur.fetchall()
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.exception('Error importing employees')
+        if isinstance(e, (UnicodeDecodeError, csv.Error)):
+            flash('Could not read the file; upload a UTF-8 CSV with a header row.')
+        else:
+            flash('An error occurred while importing employees; nothing was imported.')
+        return redirect(url_for('.import_employees'))
+
+    if imported:
+        resultcache.invalidate()
+    if not rejected:
+        flash(f'Imported {imported} employee(s).')
+        return redirect(url_for('.list_employees'))
+
+    # The valid rows were imported; the page links to a report of the others.
+    flash(f'Imported {imported} employee(s); {len(rejected)} row(s) were rejected.')
+    return redirect(url_for('.import_employees', report=_save_import_report(rejected)))
+
+
+@bp.route('/import/report/<report>')
+def import_report(report):
+    """Download the rejected rows (line, ssn, error) of an earlier import."""
+    path = _import_report_path(report) if _REPORT_ID.match(report) else None
+    if path is None or not os.path.exists(path):
+        flash('That import report has expired.')
+        return redirect(url_for('.import_employees'))
+    return send_file(path, mimetype='text/csv', as_attachment=True, download_name='employee_import_errors.csv')
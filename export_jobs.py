@@ -0,0 +1,315 @@
+"""Background export jobs, for exports too large to build inside a request.
+
+    GET /export?background=1&format=csv        -> 202 {"id": ..., "state": "queued", ...}
+    GET /exports/<id>                          -> the job's status and progress
+    GET /exports/<id>/download                 -> the finished file
+
+A job runs in a small per-process thread pool, on its own pooled connection
+(a replica's, if there is one), and streams its rows into a file in the spool
+directory. Each job has a status file next to its output, so any worker
+process on this host can report on it or serve it.
+
+The job id is derived from the export, its format and options and the
+data_version of the tables it reads (see versions.py). Asking for an export
+that is already queued, running or finished returns the existing job; once
+one of the tables changes, the same request starts a new one.
+
+    EXPORT_SPOOL_DIR        where files are written (default: <tmp>/company-exports)
+    EXPORT_JOB_WORKERS      jobs run at once per process (default 2)
+    EXPORT_JOB_QUEUE        jobs waiting or running per process before new ones get a 503 (default 8)
+    EXPORT_SPOOL_MAX_AGE    seconds a finished file is kept after it was written or last downloaded (default 86400)
+    EXPORT_SPOOL_MAX_BYTES  total size of finished files; the least recently used go first (default 1 GiB)
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, g, jsonify, send_file, url_for
+from exports import FETCH_SIZE, FORMATS, write_export
+from utilities import borrow_db, get_db, env_int, env_float
+from versions import get_versions
+import queries
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('export_jobs', __name__, url_prefix='/exports')
+
+EXPORT_SPOOL_DIR = os.environ.get('EXPORT_SPOOL_DIR') or os.path.join(tempfile.gettempdir(), 'company-exports')
+EXPORT_JOB_WORKERS = env_int('EXPORT_JOB_WORKERS', 2)
+EXPORT_JOB_QUEUE = env_int('EXPORT_JOB_QUEUE', 8)
+EXPORT_SPOOL_MAX_AGE = env_float('EXPORT_SPOOL_MAX_AGE', 24 * 3600.0)
+EXPORT_SPOOL_MAX_BYTES = env_int('EXPORT_SPOOL_MAX_BYTES', 1024 * 1024 * 1024)
+
+# An export that can run in the background. query(**options) returns the
+# named query to run as (name, params, variant), and row() turns each of its
+# rows into the tuple of `fields` values, as for export_response().
+ExportKind = namedtuple('ExportKind', ['basename', 'fields', 'tables', 'query', 'row'])
+
+KINDS = {}
+
+_JOB_ID = re.compile(r'^[0-9a-f]{24}$')
+
+# Created on first use, like the connection pool
+_executor = None
+_lock = threading.Lock()
+_pending = set()
+_rejected = 0
+
+
+class QueueFull(Exception):
+    """Raised when this process already has EXPORT_JOB_QUEUE jobs waiting or running."""
+
+
+def register(kind, basename, fields, tables, query, row):
+    """Make an export available to submit() under the name `kind`."""
+    KINDS[kind] = ExportKind(basename, fields, tables, query, row)
+
+
+def _path(job_id, suffix):
+    return os.path.join(EXPORT_SPOOL_DIR, job_id + suffix)
+
+
+def _output_path(status):
+    return _path(status['id'], '.' + FORMATS[status['format']][1])
+
+
+def read_status(job_id):
+    """Return a job's status dict, or None if there is no such job (or it was evicted)."""
+    try:
+        with open(_path(job_id, '.status.json')) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if status['state'] in ('queued', 'running') and not _owner_alive(status['pid']):
+        status.update(state='failed', error='the process running this export exited')
+    return status
+
+
+def _write_status(status):
+    # Write and rename, so readers never see half a file
+    tmp = _path(status['id'], f".status.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp, _path(status['id'], '.status.json'))
+
+
+def _claim(status):
+    """Create the job's status file; False if another request got there first."""
+    try:
+        fd = os.open(_path(status['id'], '.status.json'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump(status, f)
+    return True
+
+
+def _owner_alive(pid):
+    if pid == os.getpid() or os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(EXPORT_JOB_WORKERS, thread_name_prefix='export-job')
+    return _executor
+
+
+def _job_id(kind, fmt, options, versions):
+    spec = json.dumps([kind, fmt, options, versions], sort_keys=True, default=str)
+    return hashlib.sha1(spec.encode()).hexdigest()[:24]
+
+
+def submit(kind, fmt, options):
+    """Return the status of the background job for this export, starting it if needed.
+
+    `options` are the keyword arguments for the kind's query(); they must be
+    JSON-serializable. Raises QueueFull if this process has no room for
+    another job.
+    """
+    global _rejected
+    export = KINDS[kind]
+    # @conditional has usually read the versions already for this request
+    versions = g.get('data_versions') or {}
+    if any(t not in versions for t in export.tables):
+        versions = get_versions(get_db(), export.tables)
+    job_id = _job_id(kind, fmt, options, [versions.get(t, (None,))[0] for t in export.tables])
+    os.makedirs(EXPORT_SPOOL_DIR, exist_ok=True)
+
+    while True:
+        status = read_status(job_id)
+        if status is not None:
+            if status['state'] in ('queued', 'running') or os.path.exists(_output_path(status)):
+                return status
+            # It failed (or its file is gone): run it again
+            _remove(job_id)
+        with _lock:
+            if len(_pending) >= EXPORT_JOB_QUEUE:
+                _rejected += 1
+                raise QueueFull(f"{len(_pending)} exports already queued")
+            status = {'id': job_id, 'kind': kind, 'format': fmt, 'options': options, 'state': 'queued',
+                      'pid': os.getpid(), 'rows': 0, 'bytes': 0, 'error': None,
+                      'created': time.time(), 'started': None, 'finished': None}
+            if not _claim(status):
+                continue
+            _pending.add(job_id)
+        _get_executor().submit(_run, dict(status))
+        evict()
+        return status
+
+
+def _run(status):
+    export = KINDS[status['kind']]
+    part = _path(status['id'], f".{os.getpid()}.part")
+    status.update(state='running', started=time.time())
+    _write_status(status)
+    try:
+        name, params, variant = export.query(**status['options'])
+        with borrow_db(read_only=True) as conn, open(part, 'w', encoding='utf-8', newline='') as f:
+            with conn.cursor(name=f"export_job_{status['id']}") as cur:
+                cur.itersize = FETCH_SIZE
+                cur.execute(queries.sql(name, **variant), params)
+
+                def rows():
+                    for row in cur:
+                        yield export.row(row)
+                        status['rows'] += 1
+                        # Record progress once per fetched batch
+                        if status['rows'] % FETCH_SIZE == 0:
+                            status['bytes'] = f.tell()
+                            _write_status(status)
+
+                write_export(f, export.fields, rows(), status['format'])
+            status['bytes'] = f.tell()
+        os.replace(part, _output_path(status))
+        status.update(state='done', finished=time.time())
+    except Exception as e:
+        logger.exception("Export %s failed", status['id'])
+        status.update(state='failed', error=str(e), finished=time.time())
+        if os.path.exists(part):
+            os.remove(part)
+    finally:
+        with _lock:
+            _pending.discard(status['id'])
+    _write_status(status)
+    evict()
+
+
+def _remove(job_id):
+    for path in glob.glob(_path(job_id, '.*')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def evict():
+    """Delete finished and failed jobs older than EXPORT_SPOOL_MAX_AGE, then the least
+    recently used finished files until they fit in EXPORT_SPOOL_MAX_BYTES."""
+    now = time.time()
+    finished = []
+    for status_path in glob.glob(os.path.join(EXPORT_SPOOL_DIR, '*.status.json')):
+        status = read_status(os.path.basename(status_path)[:-len('.status.json')])
+        if status is None or status['state'] in ('queued', 'running'):
+            continue
+        try:
+            # Downloads touch the file, so this is the last time it was used
+            used, size = os.path.getmtime(_output_path(status)), os.path.getsize(_output_path(status))
+        except OSError:
+            used, size = status['finished'] or status['created'], 0
+        if now - used > EXPORT_SPOOL_MAX_AGE:
+            _remove(status['id'])
+        else:
+            finished.append((used, size, status['id']))
+    total = sum(size for _, size, _ in finished)
+    for used, size, job_id in sorted(finished):
+        if total <= EXPORT_SPOOL_MAX_BYTES:
+            break
+        _remove(job_id)
+        total -= size
+
+
+def get_job_stats():
+    """Return this process's job pool settings and counters."""
+    with _lock:
+        return {'workers': EXPORT_JOB_WORKERS, 'queue': EXPORT_JOB_QUEUE, 'pending': len(_pending),
+                'rejected': _rejected, 'spool': EXPORT_SPOOL_DIR}
+
+
+def status_response(status, code=200):
+    """The JSON for a job's status, with its status and download URLs."""
+    body = {k: status[k] for k in ('id', 'kind', 'format', 'options', 'state', 'rows', 'bytes', 'error',
+                                   'created', 'started', 'finished')}
+    body['status_url'] = url_for('export_jobs.job_status', job_id=status['id'])
+    if status['state'] == 'done':
+        body['download_url'] = url_for('export_jobs.download', job_id=status['id'])
+    response = jsonify(body)
+    response.status_code = code
+    return response
+
+
+def submit_response(kind, fmt, options):
+    """submit() for a view: 202 with the job's status, or 503 if the queue is full."""
+    try:
+        status = submit(kind, fmt, options)
+    except QueueFull:
+        response = jsonify(error='Too many exports are running; try again shortly.')
+        response.status_code = 503
+        response.headers['Retry-After'] = '10'
+        return response
+    response = status_response(status, 202)
+    response.headers['Location'] = url_for('export_jobs.job_status', job_id=status['id'])
+    return response
+
+
+@bp.before_request
+def require_login():
+    if g.get('user') is None:
+        return jsonify(error='Log in first.'), 401
+
+
+def _find(job_id):
+    status = read_status(job_id) if _JOB_ID.match(job_id) else None
+    if status is None:
+        return None, (jsonify(error='No such export (it may have expired).'), 404)
+    return status, None
+
+
+@bp.route('/<job_id>')
+def job_status(job_id):
+    """A background export's state and progress (rows and bytes written so far)."""
+    status, error = _find(job_id)
+    return error or status_response(status)
+
+
+@bp.route('/<job_id>/download')
+def download(job_id):
+    """The finished file of a background export."""
+    status, error = _find(job_id)
+    if error:
+        return error
+    path = _output_path(status)
+    if status['state'] != 'done' or not os.path.exists(path):
+        return jsonify(error=f"The export is {status['state']}, not ready to download.", state=status['state']), 409
+    # Mark it used, so eviction by size keeps the files people still fetch
+    os.utime(path)
+    content_type, ext = FORMATS[status['format']]
+    return send_file(path, mimetype=content_type, as_attachment=True,
+                     download_name=f"{KINDS[status['kind']].basename}.{ext}")
@@ -0,0 +1,164 @@
+import csv
+import io
+import json
+from flask import Response, abort
+from utilities import detach_db, release_db
+
+# Rows fetched from the server-side cursor per network round trip.
+FETCH_SIZE = 2000
+# Flush the CSV buffer to the client once it grows past this many characters.
+CHUNK_SIZE = 64 * 1024
+
+
+class ServerRows:
+    """Iterator over a named (server-side) cursor that owns its connection.
+
+    Rows are pulled FETCH_SIZE at a time as the iterator is consumed, so
+    memory use does not depend on the size of the result. close() (called
+    when the rows run out, or by the response when the client goes away)
+    closes the cursor and gives the connection back to the pool.
+    """
+
+    def __init__(self, conn, cur):
+        self._conn = conn
+        self._cur = cur
+        self._iter = iter(cur)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._conn is None:
+            raise StopIteration
+        try:
+            return next(self._iter)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                self._cur.close()
+            finally:
+                release_db(conn)
+
+
+def iter_query(name, sql, params=None):
+    """Run `sql` on a named server-side cursor and return its rows as ServerRows.
+
+    The query is started here, so SQL errors surface before the response
+    begins. The request's connection is detached from the request, since the
+    rows are read after the view has returned.
+    """
+    conn = detach_db()
+    try:
+        cur = conn.cursor(name=name)
+        cur.itersize = FETCH_SIZE
+        cur.execute(sql, params)
+    except Exception:
+        release_db(conn)
+        raise
+    return ServerRows(conn, cur)
+
+
+# format name -> (Content-Type, file extension)
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'json': ('application/json', 'json'),
+}
+
+_json = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def get_export_format(args):
+    """Read `format` from the request args (default csv); 400 if it is not supported."""
+    fmt = (args.get('format') or 'csv').lower()
+    if fmt not in FORMATS:
+        abort(400, description=f"Unsupported export format {fmt!r}; use one of: {', '.join(FORMATS)}")
+    return fmt
+
+
+def _chunked(pieces):
+    """Join an iterable of strings into chunks of about CHUNK_SIZE characters."""
+    buf = []
+    size = 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    yield ''.join(buf)
+
+
+def csv_chunks(fields, rows):
+    """Yield CSV text: a header line of the fields' titles, then one line per row."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([title for _, title in fields])
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def _json_objects(fields, rows):
+    """Yield each row as a JSON object string, keyed by the fields' keys.
+
+    The `{"key":` prefixes are encoded once up front and zipped with each row's
+    values, so no per-row dict is built. Values keep their types: numbers stay
+    numbers and NULL stays null.
+    """
+    prefixes = [('{' if i == 0 else ',') + _json.encode(key) + ':' for i, (key, _) in enumerate(fields)]
+    encode = _json.encode
+    for row in rows:
+        yield ''.join([prefix + encode(value) for prefix, value in zip(prefixes, row)]) + '}'
+
+
+def ndjson_chunks(fields, rows):
+    """Yield newline-delimited JSON: one complete object per line."""
+    return _chunked(obj + '\n' for obj in _json_objects(fields, rows))
+
+
+def json_chunks(fields, rows):
+    """Yield a single JSON array of objects."""
+    def pieces():
+        yield '['
+        first = True
+        for obj in _json_objects(fields, rows):
+            yield obj if first else ',\n' + obj
+            first = False
+        yield ']\n'
+    return _chunked(pieces())
+
+
+_WRITERS = {'csv': csv_chunks, 'ndjson': ndjson_chunks, 'json': json_chunks}
+
+
+def export_response(basename, fields, rows, fmt='csv', source=None):
+    """Return an attachment response written out as `rows` are produced.
+
+    `fields` is a list of (json key, csv title) pairs and each row is a tuple
+    of values in the same order. `source` is the ServerRows the rows come
+    from; it is closed when the response is closed, even if streaming never
+    started.
+    """
+    content_type, ext = FORMATS[fmt]
+    headers = {'Content-Type': content_type, 'Content-Disposition': f'attachment; filename="{basename}.{ext}"'}
+    response = Response(_WRITERS[fmt](fields, rows), headers=headers)
+    if source is not None:
+        response.call_on_close(source.close)
+    return response
+
+
+def write_export(f, fields, rows, fmt='csv'):
+    """Write what export_response() would send to the text file `f` (opened with newline='')."""
+    for chunk in _WRITERS[fmt](fields, rows):
+        f.write(chunk)
@@ -1,14 +1,28 @@
 # home.py
-from flask import Blueprint, url_for, g, render_template, request, Response, flash, redirect
-from utilities import get_db_connection
+from flask import Blueprint, url_for, g, render_template, request, flash, redirect, current_app
+from utilities import get_db, read_only
+from versions import conditional
+import refdata
+from refdata import queue_departments
+from batch import QueryBatch
+import async_db
+from async_db import Query
+from exports import export_response, get_export_format
+import export_jobs
+from search import name_pattern
+from pagination import Keyset, get_per_page
+import queries
+import resultcache
+from queries import overview_sort_keys
 import psycopg
-import io
-import csv
 
 bp = Blueprint("home", __name__) # Blueprint lets us split program into components, with home used for the url_for('home.home') 
 # __name__ tells Flask where it comes from
 
+
 @bp.route("/", endpoint="home")
+@read_only
+@conditional("employee", "department", "works_on", "dependent")
 def home():
     """
     A2. Home – Employee Overview
@@ -68,73 +82,70 @@ def home():
     if order not in ("asc", "desc"):
         order = "asc"
 
+    per_page = get_per_page(request.args)                      # Rows per page
+    with_count = request.args.get("count", "1") != "0"         # count=0 skips the total row count
+
     # Can't let user input determine the search --> Whitelist OrderBy
-    if sort_by == "total_hours":
-        sort_expr = f"total_hours {order.upper()}, e.lname ASC, e.fname ASC" # Sort by hours then last name then first name
-    else:
-        
+    if sort_by != "total_hours":
         sort_by = "name" # default: sort by name
-        sort_expr = f"e.lname {order.upper()}, e.fname {order.upper()}, e.minit {order.upper()}" # Sort by last name, then first name, then minit
-
-    # Build the WHERE clause
-    where_clauses = []
-    params = []
-
-    # user picked department in hte dropdown
-    if dept is not None:
-        where_clauses.append("e.dno = %s")
-        params.append(dept)
-
-    # user typed something in the search box
-    if q:
-        where_clauses.append(
-            "LOWER(e.fname || ' ' || COALESCE(e.minit, '') || ' ' || e.lname) LIKE %s"
-        )
-        params.append(f"%{q.lower()}%")
-
-    # join clauses if applicable
-    where_sql = ""
-    if where_clauses:
-        where_sql = "WHERE " + " AND ".join(where_clauses)
-
-    # corresponds to main A2 requirements
-    sql = f"""
-        SELECT
-            e.ssn,
-            e.fname,
-            e.minit,
-            e.lname,
-            d.dname AS department_name,
-            COALESCE(COUNT(DISTINCT dep.dependent_name), 0) AS num_dependents,
-            COALESCE(COUNT(DISTINCT w.pno), 0)              AS num_projects,
-            COALESCE(SUM(w.hours), 0)                       AS total_hours
-        FROM employee e
-        LEFT JOIN department d ON e.dno = d.dnumber
-        LEFT JOIN dependent dep ON e.ssn = dep.essn
-        LEFT JOIN works_on w   ON e.ssn = w.essn
-        {where_sql}
-        GROUP BY e.ssn, e.fname, e.minit, e.lname, d.dname
-        ORDER BY {sort_expr}
-    """
+    keyset = Keyset(f"{sort_by}-{order}", overview_sort_keys(sort_by, order),
+                    request.args.get("cursor"), per_page)
+
+    # Parameters for the filters the user picked. The SQL for each combination
+    # of filters and sort is a fixed variant in queries.py.
+    filters = dict(dept=dept is not None, q=bool(q))
+    filter_params = []
+    if dept is not None:                                       # user picked department in the dropdown
+        filter_params.append(dept)
+    if q:                                                      # user typed something in the search box
+        filter_params.append(name_pattern(q))
+
+    # Start after/before the cursor row instead of using OFFSET
+    _, cursor_params = keyset.where()
+    params = filter_params + cursor_params + [keyset.limit]
+    page_variant = dict(filters, sort_by=sort_by, order=order, cursor=keyset.direction)
 
     employees = []
     departments = []
-
-    conn = get_db_connection()
-    try:
-        # Use dict_row for nicer access in template
-        with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
-            # Employee overview
-            cur.execute(sql, params)
-            employees = cur.fetchall()
-
-            # Department list for dropdown
-            cur.execute(
-                "SELECT dnumber, dname FROM department ORDER BY dname"
-            )
-            departments = cur.fetchall()
-    finally:
-        conn.close()
+    total = None
+
+    conn = get_db()
+    if current_app.config.get("DB_ASYNC"):
+        # Async mode: the page, the count and the department list (whichever
+        # aren't cached; see resultcache.py and refdata.py) run at the same time
+        lookups = [("overview_page", params, page_variant)]
+        # Total matching employees, unless the caller turned it off
+        if with_count:
+            lookups.append(("overview_count", filter_params, filters))
+        results = [resultcache.lookup(conn, name, p, **variant) for name, p, variant in lookups]
+        misses = [i for i, (_, rows) in enumerate(results) if rows is resultcache.MISSING]
+        pending = [Query(queries.sql(lookups[i][0], **lookups[i][2]), lookups[i][1], psycopg.rows.dict_row)
+                   for i in misses]
+        dept_key, departments = refdata.lookup_departments()
+        if departments is None:
+            pending.append(Query(queries.sql('department_names'), None, psycopg.rows.dict_row))
+        fetched = async_db.gather(*pending)
+        for i, rows in zip(misses, fetched):
+            results[i] = (results[i][0], resultcache.store(results[i][0], rows))
+        if departments is None:
+            departments = refdata.store(dept_key, fetched[-1])
+        page = keyset.page(results[0][1])
+        if with_count:
+            total = results[1][1][0]["n"]
+    else:
+        # Page, count and department list in one round trip, leaving out
+        # whatever is cached. Use dict_row for nicer access in template
+        batch = QueryBatch(conn)
+        page_rows = resultcache.add(batch, "overview_page", params, psycopg.rows.dict_row, **page_variant)
+        if with_count:
+            count = resultcache.add(batch, "overview_count", filter_params, psycopg.rows.dict_row, **filters)
+        dept_rows = queue_departments(batch)
+        batch.run()
+        page = keyset.page(page_rows.value)
+        if with_count:
+            total = count.first()["n"]
+        departments = dept_rows.value
+    employees = page.items
 
     return render_template(
         "home.html",
@@ -150,20 +161,64 @@ def home():
         q=q,
         sort_by=sort_by,
         order=order,
+        per_page=per_page,
+        total=total,
+        next_cursor=page.next_cursor,
+        prev_cursor=page.prev_cursor,
     )
 
 
+# (JSON key, CSV column title) for each exported column, in row order
+EXPORT_FIELDS = [
+    ("full_name", "Full Name"),
+    ("department", "Department"),
+    ("dependents", "Dependents"),
+    ("projects", "Projects"),
+    ("total_hours", "Total Hours"),
+]
+
+
+def export_query(dept, q, sort_by, order):
+    """Return the overview export's named query as (name, params, variant)."""
+    params = []
+    if dept is not None:
+        params.append(dept)
+    if q:
+        params.append(name_pattern(q))
+    return "overview_export", params, dict(sort_by=sort_by, order=order, dept=dept is not None, q=bool(q))
+
+
+def export_row(r):
+    """Turn an overview_export row into the EXPORT_FIELDS values."""
+    return (f"{r[1]} {r[2] or ''} {r[3]}".replace('  ', ' ').strip(), r[4], r[5], r[6], float(r[7]))
+
+
+export_jobs.register("overview", "employee_overview", EXPORT_FIELDS,
+                     ("employee", "department", "works_on", "dependent"), export_query, export_row)
+
+
 @bp.route("/export")
+@read_only
+@conditional("employee", "department", "works_on", "dependent")
 def export_home_data():
     """
     Exports the current filtered and sorted employee overview as a CSV file.
     This function re-uses the exact same query logic from the home() view.
+    The file is streamed as rows arrive rather than built in memory first.
+
+    `format=ndjson` or `format=json` return the same rows as JSON, with
+    numbers kept as numbers and a missing department as null.
+
+    `background=1` builds the file in a background job instead and returns
+    the job's status (see export_jobs.py).
     """
     user = getattr(g, "user", None)
     if user is None:
         flash("You must be logged in to export data.")
         return redirect(url_for("auth.login"))
 
+    fmt = get_export_format(request.args)
+
     # Re-use all filter and sort logic from the home() function
     dept = request.args.get("dept", type=int)
     q = (request.args.get("q") or "").strip()
@@ -173,61 +228,17 @@ def export_home_data():
     if order not in ("asc", "desc"):
         order = "asc"
 
-    if sort_by == "total_hours":
-        sort_expr = f"total_hours {order.upper()}, e.lname ASC, e.fname ASC"
-    else:
+    if sort_by != "total_hours":
         sort_by = "name"
-        sort_expr = f"e.lname {order.upper()}, e.fname {order.upper()}, e.minit {order.upper()}"
 
-    where_clauses = []
-    params = []
-    if dept is not None:
-        where_clauses.append("e.dno = %s")
-        params.append(dept)
-    if q:
-        where_clauses.append(
-            "LOWER(e.fname || ' ' || COALESCE(e.minit, '') || ' ' || e.lname) LIKE %s"
-        )
-        params.append(f"%{q.lower()}%")
-
-    where_sql = ""
-    if where_clauses:
-        where_sql = "WHERE " + " AND ".join(where_clauses)
-
-    sql = f"""
-        SELECT
-            e.fname, e.minit, e.lname,
-            d.dname AS department_name,
-            COALESCE(COUNT(DISTINCT dep.dependent_name), 0) AS num_dependents,
-            COALESCE(COUNT(DISTINCT w.pno), 0) AS num_projects,
-            COALESCE(SUM(w.hours), 0) AS total_hours
-        FROM employee e
-        LEFT JOIN department d ON e.dno = d.dnumber
-        LEFT JOIN dependent dep ON e.ssn = dep.essn
-        LEFT JOIN works_on w ON e.ssn = w.essn
-        {where_sql}
-        GROUP BY e.ssn, e.fname, e.minit, e.lname, d.dname
-        ORDER BY {sort_expr}
-    """
-
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, params)
-            rows = cur.fetchall()
-    finally:
-        conn.close()
-
-    # Build CSV in memory using the csv module
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Full Name', 'Department', 'Dependents', 'Projects', 'Total Hours'])
-    for r in rows:
-        full_name = f"{r[0]} {r[1] or ''} {r[2]}".replace('  ', ' ').strip()
-        writer.writerow([full_name, r[3], r[4], r[5], float(r[6])])
-
-    csv_data = output.getvalue()
-    output.close()
-
-    headers = {'Content-Type': 'text/csv', 'Content-Disposition': 'attachment; filename="employee_overview.csv"'}
-    return Response(csv_data, headers=headers)
\ No newline at end of file
+    options = {"dept": dept, "q": q, "sort_by": sort_by, "order": order}
+    if request.args.get("background"):
+        # Too big to wait for: build the file in a background job (see export_jobs.py)
+        return export_jobs.submit_response("overview", fmt, options)
+
+    # Stream the rows from a server-side cursor straight into the output, so
+    # memory stays flat and the first bytes go out before the last row is read.
+    name, params, variant = export_query(**options)
+    rows = queries.stream("export_home", name, params, **variant)
+    out_rows = (export_row(r) for r in rows)
+    return export_response("employee_overview", EXPORT_FIELDS, out_rows, fmt, source=rows)
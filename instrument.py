@@ -0,0 +1,129 @@
+"""Per-request SQL instrumentation and the slow-query log.
+
+Turned on with DB_INSTRUMENT=1. Every statement run on a pooled connection is
+then recorded on flask.g with its normalized SQL, parameter count, time, rows
+and endpoint, and each response gets a Server-Timing header with the
+request's total database time. Statements slower than SLOW_QUERY_MS are
+logged as one JSON object per line to the `instrument` logger, and a
+SLOW_QUERY_EXPLAIN_RATE fraction of slow SELECTs also log their
+EXPLAIN (ANALYZE, BUFFERS) plan.
+
+The queries async_db.gather() runs concurrently are recorded too, each with
+its own time. A streamed export's named cursor is reported when it is closed,
+after the response has been sent (or by a background export job), so it only
+reaches the slow-query log, not the request's Server-Timing.
+
+When DB_INSTRUMENT is off, batch.statement_hook stays None and nothing here
+runs.
+"""
+import json
+import logging
+import os
+import random
+import re
+from functools import lru_cache
+from flask import g, request, has_app_context, has_request_context
+import psycopg
+import batch
+from utilities import env_float
+
+logger = logging.getLogger(__name__)
+
+# Log statements slower than this many milliseconds
+SLOW_QUERY_MS = env_float('SLOW_QUERY_MS', 200.0)
+# Fraction (0..1) of slow SELECTs whose plan is captured with EXPLAIN ANALYZE
+SLOW_QUERY_EXPLAIN_RATE = env_float('SLOW_QUERY_EXPLAIN_RATE', 0.0)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_SPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """Collapse whitespace and replace literal strings and numbers with `?`.
+
+    Statements that differ only in their literals normalize to the same text,
+    so they can be grouped.
+    """
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+def _sql_text(conn, query):
+    if isinstance(query, str):
+        return query
+    if isinstance(query, bytes):
+        return query.decode()
+    return query.as_string(conn)    # psycopg.sql.Composable
+
+
+def _param_count(params, many):
+    if not params:
+        return 0
+    if many:
+        return sum(len(p) for p in params)
+    return len(params)
+
+
+def _explain(conn, sql, params):
+    # Runs the statement again, so only SELECTs, and inside a savepoint so a
+    # failure can't break the request's transaction. A plain psycopg cursor
+    # keeps it out of the statement hook.
+    try:
+        with conn.transaction():
+            with psycopg.Cursor(conn) as cur:
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+                return cur.fetchone()[0]
+    except psycopg.Error as e:
+        return f"EXPLAIN failed: {e}"
+
+
+def record_statement(conn, query, params, seconds, rows, batch_size, many):
+    """batch.statement_hook: record one statement and log it if it was slow.
+
+    Outside an app context (a streamed export finishing, a background job)
+    there is no request to record it on, so it is only logged if slow.
+    """
+    # The pool checks a connection before handing it out with an empty statement
+    sql = normalize_sql(_sql_text(conn, query)) or '(connection check)'
+    entry = {
+        'sql': sql,
+        'params': _param_count(params, many),
+        'ms': round(seconds * 1000, 3),
+        'rows': rows,
+        'batch': batch_size,
+        'endpoint': request.endpoint if has_request_context() else None,
+    }
+    if has_app_context():
+        g.setdefault('db_statements', []).append(entry)
+    if entry['ms'] < SLOW_QUERY_MS:
+        return
+    record = dict(entry, event='slow_query')
+    if (conn is not None and not many and sql.upper().startswith('SELECT')
+            and SLOW_QUERY_EXPLAIN_RATE > 0 and random.random() < SLOW_QUERY_EXPLAIN_RATE):
+        record['plan'] = _explain(conn, _sql_text(conn, query), params)
+    logger.warning(json.dumps(record, default=str))
+
+
+def db_time_ms():
+    """Total database time of the current request, counting each batch once."""
+    return sum(s['ms'] / s['batch'] for s in g.get('db_statements', ()))
+
+
+def add_server_timing(response):
+    """Add the request's database time and statement count as a Server-Timing entry."""
+    statements = g.get('db_statements', ())
+    entry = f'db;dur={db_time_ms():.1f};desc="{len(statements)} statements"'
+    existing = response.headers.get('Server-Timing')
+    response.headers['Server-Timing'] = f"{existing}, {entry}" if existing else entry
+    return response
+
+
+def init_app(app):
+    """Install the statement hook and Server-Timing header if DB_INSTRUMENT is on."""
+    app.config.setdefault('DB_INSTRUMENT', os.environ.get('DB_INSTRUMENT', '') not in ('', '0'))
+    if app.config['DB_INSTRUMENT']:
+        batch.statement_hook = record_statement
+        app.after_request(add_server_timing)
@@ -0,0 +1,175 @@
+import base64
+import decimal
+import json
+from collections import namedtuple
+
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 500
+
+# One ORDER BY term: the SQL expression, whether it sorts descending, the
+# key (dict key or tuple index) that reads its value back out of a result row,
+# and the type a cursor's value is converted to (str, or number for numeric
+# columns) before it is sent as a parameter.
+SortKey = namedtuple('SortKey', ['expr', 'desc', 'field', 'type'], defaults=(str,))
+
+
+def number(value):
+    """A cursor value for a numeric column, as a Decimal; ValueError if it is not a finite number."""
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError(f"not a number: {value!r}")
+    try:
+        result = decimal.Decimal(str(value))
+    except decimal.InvalidOperation:
+        raise ValueError(f"not a number: {value!r}")
+    if not result.is_finite():
+        raise ValueError(f"not a finite number: {value!r}")
+    return result
+
+Page = namedtuple('Page', ['items', 'next_cursor', 'prev_cursor'])
+
+
+def encode_cursor(tag, values, backwards=False):
+    """Return an opaque, URL-safe cursor for the position at `values`."""
+    payload = json.dumps({'t': tag, 'v': list(values), 'b': backwards}, default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, tag, num_keys):
+    """Return (values, backwards) for a cursor, or None if it is missing or unusable.
+
+    A cursor made for a different sort (`tag`) is ignored, so changing the sort
+    order starts again from the first page instead of failing.
+    """
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values, backwards = payload['v'], bool(payload['b'])
+        if payload['t'] != tag or len(values) != num_keys:
+            return None
+    except (ValueError, KeyError, TypeError):
+        return None
+    return values, backwards
+
+
+def get_per_page(args):
+    """Read `per_page` from the request args, clamped to 1..MAX_PER_PAGE."""
+    per_page = args.get('per_page', DEFAULT_PER_PAGE, type=int)
+    return max(1, min(per_page, MAX_PER_PAGE))
+
+
+def order_by_sql(keys, backwards=False):
+    """Return the ORDER BY list for `keys`; reversed when walking backwards."""
+    terms = []
+    for key in keys:
+        desc = key.desc != backwards
+        terms.append(f"{key.expr} {'DESC' if desc else 'ASC'}")
+    return ', '.join(terms)
+
+
+def _same_direction(keys, backwards):
+    directions = {key.desc != backwards for key in keys}
+    return directions.pop() if len(directions) == 1 else None
+
+
+def after_sql(keys, backwards=False):
+    """Return the condition selecting rows past a cursor, with one %s per parameter.
+
+    The text depends only on the keys and direction, never on the cursor's
+    values, so it can be prepared once and reused (see queries.py).
+    """
+    desc = _same_direction(keys, backwards)
+    if desc is not None:
+        # All keys sort the same way: a row comparison, which an index on
+        # the same columns can serve directly.
+        exprs = ', '.join(key.expr for key in keys)
+        marks = ', '.join(['%s'] * len(keys))
+        return f"({exprs}) {'<' if desc else '>'} ({marks})"
+    # Mixed directions: (k1 > v1) OR (k1 = v1 AND k2 < v2) OR ...
+    clauses = []
+    for i, key in enumerate(keys):
+        terms = [f"{k.expr} = %s" for k in keys[:i]]
+        op = '<' if key.desc != backwards else '>'
+        terms.append(f"{key.expr} {op} %s")
+        clauses.append('(' + ' AND '.join(terms) + ')')
+    return '(' + ' OR '.join(clauses) + ')'
+
+
+def after_params(keys, backwards, values):
+    """Return the parameters for after_sql(keys, backwards) at the cursor `values`."""
+    if _same_direction(keys, backwards) is not None:
+        return list(values)
+    params = []
+    for i in range(len(keys)):
+        params.extend(values[:i + 1])
+    return params
+
+
+class Keyset:
+    """Keyset (cursor) pagination over a fixed, fully ordered list of sort keys.
+
+    Instead of OFFSET, each page is fetched with a WHERE condition that starts
+    right after (or before) the last row the client saw, so page 1000 costs
+    the same as page 1. The last sort key must make the order unique (e.g. the
+    primary key).
+
+    Usage:
+        ks = Keyset('name-asc', keys, request.args.get('cursor'), per_page)
+        cond, cond_params = ks.where()    # None when on the first page
+        sql = f"... WHERE {cond} ORDER BY {ks.order_by()} LIMIT %s"    # with ks.limit
+        page = ks.page(cur.fetchall())
+    """
+
+    def __init__(self, tag, keys, cursor, per_page):
+        self.tag = tag
+        self.keys = keys
+        self.per_page = per_page
+        self.limit = per_page + 1    # one extra row tells us whether another page exists
+        decoded = decode_cursor(cursor, tag, len(keys))
+        self.values, self.backwards = decoded if decoded else (None, False)
+        if self.values is not None:
+            try:
+                self.values = [None if v is None else key.type(v) for key, v in zip(keys, self.values)]
+            except (ValueError, TypeError):
+                # A tampered cursor is ignored like an unusable one, instead of
+                # failing in the database on a value of the wrong type
+                self.values, self.backwards = None, False
+
+    @property
+    def direction(self):
+        """None on the first page, else 'next' or 'prev': the shape of where()'s SQL."""
+        if self.values is None:
+            return None
+        return 'prev' if self.backwards else 'next'
+
+    def order_by(self):
+        """Return the ORDER BY list; reversed when walking backwards."""
+        return order_by_sql(self.keys, self.backwards)
+
+    def where(self):
+        """Return (sql, params) selecting rows past the cursor, or (None, []) on page one."""
+        if self.values is None:
+            return None, []
+        return after_sql(self.keys, self.backwards), after_params(self.keys, self.backwards, self.values)
+
+    def _cursor_for(self, row, backwards):
+        return encode_cursor(self.tag, [row[key.field] for key in self.keys], backwards)
+
+    def page(self, rows):
+        """Turn the fetched rows (at most `limit`) into a Page in display order."""
+        rows = list(rows)
+        has_more = len(rows) > self.per_page
+        items = rows[:self.per_page]
+        if self.backwards:
+            items.reverse()
+        if not items:
+            return Page(items, None, None)
+        if self.backwards:
+            # We came here from a later page, so there is always a next page.
+            next_cursor = self._cursor_for(items[-1], False)
+            prev_cursor = self._cursor_for(items[0], True) if has_more else None
+        else:
+            next_cursor = self._cursor_for(items[-1], False) if has_more else None
+            prev_cursor = self._cursor_for(items[0], True) if self.values is not None else None
+        return Page(items, next_cursor, prev_cursor)
@@ -0,0 +1,155 @@
+"""Password hashing off the request threads.
+
+scrypt and pbkdf2 are slow on purpose, and they hold the GIL, so a burst of
+logins hashed inline stalls every other request in the worker. Hashes are
+computed in a small process pool instead; at most PASSWORD_HASH_QUEUE of
+them may be waiting or running at once, and past that hash_password() and
+verify_password() raise HashingBusy right away, so the view can answer 503
+instead of queueing more work.
+
+    PASSWORD_HASH_METHOD   werkzeug method and cost, e.g. scrypt:32768:8:1 or pbkdf2:sha256:1000000
+                           (default scrypt:32768:8:1)
+    PASSWORD_HASH_WORKERS  processes in the pool (default: CPU count; 0 hashes inline)
+    PASSWORD_HASH_QUEUE    hashes waiting or running before new ones are refused (default 4 per worker)
+    PASSWORD_HASH_TIMEOUT  seconds to wait for one hash before giving up with HashingBusy (default 10)
+
+needs_rehash() tells whether a stored hash was made with other parameters;
+login uses it to upgrade the stored hash after a successful check.
+
+    flask --app app passwords bench --seconds 5
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import click
+from flask.cli import AppGroup
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from utilities import env_int, env_float
+
+passwords_cli = AppGroup('passwords', help='Password hashing tools.')
+
+
+class HashingBusy(Exception):
+    """Raised when too many hashes are already waiting or running."""
+
+
+def canonical_method(method):
+    """Spell out werkzeug's defaults, e.g. 'scrypt' -> 'scrypt:32768:8:1', as stored hashes do."""
+    name, *args = method.split(':')
+    if name == 'scrypt' and not args:
+        return 'scrypt:32768:8:1'
+    if name == 'pbkdf2' and len(args) < 2:
+        return f"pbkdf2:{args[0] if args else 'sha256'}:{DEFAULT_PBKDF2_ITERATIONS}"
+    return method
+
+
+PASSWORD_HASH_METHOD = canonical_method(os.environ.get('PASSWORD_HASH_METHOD', 'scrypt'))
+PASSWORD_HASH_WORKERS = env_int('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+PASSWORD_HASH_QUEUE = env_int('PASSWORD_HASH_QUEUE', 4 * max(PASSWORD_HASH_WORKERS, 1))
+PASSWORD_HASH_TIMEOUT = env_float('PASSWORD_HASH_TIMEOUT', 10.0)
+
+# Created on first use, like the connection pool
+_executor = None
+_lock = threading.Lock()
+_in_flight = 0
+_rejected = 0
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                # spawn, not fork: the app process has threads and open sockets
+                _executor = ProcessPoolExecutor(PASSWORD_HASH_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def _release(future=None):
+    global _in_flight
+    with _lock:
+        _in_flight -= 1
+
+
+def _run(fn, *args):
+    global _in_flight, _rejected
+    if PASSWORD_HASH_WORKERS <= 0:
+        return fn(*args)
+    with _lock:
+        if _in_flight >= PASSWORD_HASH_QUEUE:
+            _rejected += 1
+            raise HashingBusy(f"{_in_flight} password hashes already queued")
+        _in_flight += 1
+    try:
+        future = _get_executor().submit(fn, *args)
+    except BaseException:
+        _release()
+        raise
+    # The slot is freed when the hash is done, not when the caller stops
+    # waiting: a timed-out hash still occupies a worker process.
+    future.add_done_callback(_release)
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except TimeoutError:
+        future.cancel()    # only succeeds if it had not started yet
+        with _lock:
+            _rejected += 1
+        raise HashingBusy(f"password hash took longer than {PASSWORD_HASH_TIMEOUT}s")
+
+
+def hash_password(password, method=None):
+    """Return a werkzeug hash of `password` made with `method` (default PASSWORD_HASH_METHOD)."""
+    return _run(generate_password_hash, password, method or PASSWORD_HASH_METHOD)
+
+
+def verify_password(stored_hash, password):
+    """Return True if `password` matches `stored_hash`."""
+    return _run(check_password_hash, stored_hash, password)
+
+
+def needs_rehash(stored_hash):
+    """True if `stored_hash` was made with a method or cost other than PASSWORD_HASH_METHOD."""
+    return stored_hash.split('$', 1)[0] != PASSWORD_HASH_METHOD
+
+
+def get_hashing_stats():
+    """Return the pool's settings and counters."""
+    with _lock:
+        return {'method': PASSWORD_HASH_METHOD, 'workers': PASSWORD_HASH_WORKERS, 'queue': PASSWORD_HASH_QUEUE,
+                'in_flight': _in_flight, 'rejected': _rejected}
+
+
+def _rate(check, seconds):
+    # Checks per second, running `check` back to back for about `seconds`
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        check()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+@passwords_cli.command('bench')
+@click.option('--method', default=None, help=f'Hash method and cost (default {PASSWORD_HASH_METHOD}).')
+@click.option('--seconds', default=3.0, show_default=True, help='How long to run each measurement.')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='Processes for the parallel run.')
+def bench_command(method, seconds, workers):
+    """Measure password checks (logins) per second, on one core and across a process pool."""
+    method = canonical_method(method or PASSWORD_HASH_METHOD)
+    stored = generate_password_hash('correct horse battery staple', method)
+    single = _rate(lambda: check_password_hash(stored, 'correct horse battery staple'), seconds)
+    click.echo(f"{method}: {1000 / single:.1f} ms per check, {single:.1f} logins/s on one core")
+
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        list(pool.map(check_password_hash, [stored] * workers, ['warm-up'] * workers))
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            # keep every worker busy: one batch of checks per worker at a time
+            list(pool.map(check_password_hash, [stored] * workers * 4, ['correct horse battery staple'] * workers * 4))
+            count += workers * 4
+        parallel = count / (time.perf_counter() - start)
+    click.echo(f"{workers} worker process(es): {parallel:.1f} logins/s, {parallel / workers:.1f} per core")
@@ -0,0 +1,262 @@
+"""Query-plan regression checks for the named queries in queries.py.
+
+    flask --app app datagen --employees 200000 --assignments 2000000
+    flask --app app plans record       # write plan_baseline.json from this data set
+    flask --app app plans check        # exit status 1 on any failure
+
+`check` runs EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) for every variant of
+every registered query, inside a transaction that is rolled back. Each plan
+must satisfy the shape rules in PLAN_RULES: indexes the README promises must
+be used, and certain sequential scans must not come back. If a baseline file
+exists, a variant also fails when its estimated cost or its buffer count
+grows past the tolerance.
+
+Plans on a few hundred rows say little, so the data set should first be
+scaled with `flask datagen`. `check` refuses to run on fewer than
+--min-employees employees.
+"""
+import json
+import os
+from collections import namedtuple
+import click
+from flask.cli import AppGroup
+import psycopg
+import queries
+from pagination import after_params
+from utilities import get_db_connection
+
+plans_cli = AppGroup('plans', help='Check that the hot queries keep their expected plans.')
+
+BASELINE_FILE = 'plan_baseline.json'
+LIMIT = 51    # a typical page (per_page + 1)
+
+# A shape rule for the variants of `query` whose options match `where`:
+# `uses_index` must appear in the plan, and `no_seq_scan` must not be
+# scanned sequentially.
+PlanRule = namedtuple('PlanRule', ['query', 'where', 'uses_index', 'no_seq_scan'], defaults=({}, None, None))
+
+PLAN_RULES = [
+    # The name sort pages through idx_employee_name instead of sorting the table.
+    PlanRule('overview_page', {'sort_by': 'name', 'dept': False, 'q': False}, no_seq_scan='employee'),
+    # Name search goes through the trigram index.
+    PlanRule('overview_page', {'q': True}, uses_index='idx_employee_search_name'),
+    PlanRule('overview_count', {'q': True}, uses_index='idx_employee_search_name'),
+    # A project's assignments are found by Pno, which the Works_On primary key
+    # (Essn, Pno) can't serve.
+    PlanRule('project_assignments', uses_index='idx_workson_pno', no_seq_scan='works_on'),
+    PlanRule('project_name', no_seq_scan='project'),
+    # The employees list pages through idx_employee_name instead of sorting the table.
+    PlanRule('employee_page', uses_index='idx_employee_name', no_seq_scan='employee'),
+    # The employee picker reads one page from an index, never the whole table.
+    PlanRule('employee_lookup', {'by': 'name', 'dept': False}, uses_index='idx_employee_sort_name',
+             no_seq_scan='employee'),
+    PlanRule('employee_lookup', {'by': 'name', 'dept': True}, uses_index='idx_employee_dept_sort_name',
+             no_seq_scan='employee'),
+    PlanRule('employee_lookup', {'by': 'ssn'}, no_seq_scan='employee'),
+    # The batch API reads its keys through the primary keys
+    PlanRule('employees_by_ssn', uses_index='employee_pkey', no_seq_scan='employee'),
+    PlanRule('projects_by_number', uses_index='project_pkey', no_seq_scan='project'),
+    PlanRule('assignments_by_project', uses_index='idx_workson_pno', no_seq_scan='works_on'),
+    PlanRule('app_user', no_seq_scan='app_user'),
+    # The type-ahead search (search.py)
+    PlanRule('employee_search', uses_index='idx_employee_search_name'),
+]
+
+
+def sample_values(conn):
+    """Pick parameter values from the data: a busy department, a project, a mid-table employee."""
+    with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
+        cur.execute("SELECT Dno FROM Employee GROUP BY Dno ORDER BY COUNT(*) DESC LIMIT 1")
+        dno = cur.fetchone()['dno']
+        cur.execute("SELECT Pno FROM Works_On GROUP BY Pno ORDER BY COUNT(*) DESC LIMIT 1")
+        pno = cur.fetchone()['pno']
+        cur.execute("SELECT COUNT(*) AS n FROM Employee")
+        employees = cur.fetchone()['n']
+        # A row from the middle of the overview, as a keyset cursor would point at
+        cur.execute(
+            "SELECT e.ssn, e.fname, e.minit, e.lname, COALESCE(s.total_hours, 0) AS total_hours "
+            "FROM employee e LEFT JOIN employee_stats s ON e.ssn = s.ssn ORDER BY e.ssn OFFSET %s LIMIT 1",
+            (employees // 2,))
+        cursor_row = cur.fetchone()
+        # ... and one from the middle of the employee picker's order
+        cur.execute(f"SELECT {queries.SORT_NAME_EXPR} AS sort_name, e.ssn FROM employee e "
+                    "ORDER BY 1, 2 OFFSET %s LIMIT 1", (employees // 2,))
+        lookup_row = cur.fetchone()
+        cur.execute("SELECT MIN(id) AS id FROM app_user")
+        user_id = cur.fetchone()['id'] or 1
+    return {'dno': dno, 'pno': pno, 'pattern': '%smith%', 'cursor_row': cursor_row, 'lookup_row': lookup_row,
+            'user_id': user_id, 'employees': employees}
+
+
+def variant_params(name, variant, samples):
+    """Return the parameters to EXPLAIN one variant of a named query with."""
+    if name in ('overview_page', 'overview_count', 'overview_export'):
+        params = []
+        if variant['dept']:
+            params.append(samples['dno'])
+        if variant['q']:
+            params.append(samples['pattern'])
+        if name == 'overview_page':
+            if variant['cursor']:
+                keys = queries.overview_sort_keys(variant['sort_by'], variant['order'])
+                values = [samples['cursor_row'][key.field] for key in keys]
+                params.extend(after_params(keys, variant['cursor'] == 'prev', values))
+            params.append(LIMIT)
+        return params
+    if name == 'employee_page':
+        params = []
+        if variant['cursor']:
+            row = samples['cursor_row']
+            params.extend(after_params(queries.EMPLOYEE_LIST_KEYS, variant['cursor'] == 'prev',
+                                       [row['lname'], row['fname'], row['ssn']]))
+        params.append(LIMIT)
+        return params
+    if name == 'employee_lookup':
+        params = []
+        if variant['dept']:
+            params.append(samples['dno'])
+        if variant['q']:
+            params.extend(['100000000', '100099999'] if variant['by'] == 'ssn' else ['smi', 'smj'])
+        if variant['exclude']:
+            params.append(samples['pno'])
+        if variant['cursor']:
+            params.extend(samples['lookup_row'][key.field] for key in queries.employee_lookup_keys(variant['by']))
+        params.append(21)    # a picker page (limit + 1)
+        return params
+    if name == 'employees_by_ssn':
+        return [[samples['cursor_row']['ssn'], samples['lookup_row']['ssn'], '000000000']]
+    if name in ('projects_by_number', 'assignments_by_project'):
+        return [[samples['pno'], samples['pno'] + 1, -1]]
+    if name in ('project_name', 'project_assignments'):
+        return [samples['pno']]
+    if name == 'app_user':
+        return [samples['user_id']]
+    if name == 'employee_search':
+        return [samples['pattern'], 'smith%', 'smith', 10]
+    return []
+
+
+def variant_key(name, variant):
+    """A stable id for one variant, e.g. overview_page[cursor=next,dept=False,...]."""
+    return name + '[' + ','.join(f"{k}={v}" for k, v in sorted(variant.items())) + ']'
+
+
+def walk(node):
+    """Yield every node of an EXPLAIN JSON plan tree."""
+    yield node
+    for child in node.get('Plans', ()):
+        yield from walk(child)
+
+
+def explain(conn, sql, params):
+    """Return the top plan node of EXPLAIN (ANALYZE, BUFFERS) for `sql`; nothing is kept."""
+    with conn.cursor() as cur:
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+        plan = cur.fetchone()[0][0]['Plan']
+    conn.rollback()
+    return plan
+
+
+def measure(plan):
+    """Return {cost, buffers} of a plan: estimated total cost and shared blocks hit + read."""
+    return {'cost': plan['Total Cost'],
+            'buffers': plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0)}
+
+
+def shape_failures(name, variant, plan):
+    """Return the PLAN_RULES violations of one variant's plan, as messages."""
+    nodes = list(walk(plan))
+    failures = []
+    for rule in PLAN_RULES:
+        if rule.query != name or any(variant.get(k) != v for k, v in rule.where.items()):
+            continue
+        if rule.uses_index and not any(n.get('Index Name') == rule.uses_index for n in nodes):
+            failures.append(f"does not use {rule.uses_index}")
+        if rule.no_seq_scan and any(n['Node Type'] == 'Seq Scan' and n.get('Relation Name') == rule.no_seq_scan
+                                    for n in nodes):
+            failures.append(f"sequential scan on {rule.no_seq_scan}")
+    return failures
+
+
+def regressions(measured, baseline, tolerance):
+    """Return messages for each of cost/buffers that grew more than `tolerance` over the baseline."""
+    failures = []
+    for metric, floor in (('cost', 1.0), ('buffers', 8)):
+        old, new = baseline.get(metric), measured[metric]
+        # `floor` keeps tiny plans from failing on noise (e.g. 2 -> 3 buffers)
+        if old is not None and new > old * (1 + tolerance) and new - old > floor:
+            failures.append(f"{metric} {old:g} -> {new:g} (+{(new - old) / old * 100 if old else 100:.0f}%)")
+    return failures
+
+
+def run_all(conn):
+    """EXPLAIN every variant of every named query; yields (key, name, variant, plan)."""
+    samples = sample_values(conn)
+    conn.rollback()
+    for name in queries.query_names():
+        named = queries.get_query(name)
+        for variant in named.variants():
+            plan = explain(conn, named.sql(**variant), variant_params(name, variant, samples))
+            yield variant_key(name, variant), name, variant, plan
+
+
+def _table_rows(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM Employee")
+        employees = cur.fetchone()[0]
+        cur.execute("SELECT COUNT(*) FROM Works_On")
+        works_on = cur.fetchone()[0]
+    conn.rollback()
+    return {'employee': employees, 'works_on': works_on}
+
+
+def _check_size(rows, min_employees):
+    if rows['employee'] < min_employees:
+        raise click.ClickException(
+            f"only {rows['employee']} employees; scale the data first (flask --app app datagen) "
+            f"or lower --min-employees")
+
+
+@plans_cli.command('check')
+@click.option('--baseline', default=BASELINE_FILE, show_default=True, help='Baseline written by `plans record`.')
+@click.option('--tolerance', default=0.25, show_default=True, help='Allowed growth of cost and buffers (0.25 = 25%).')
+@click.option('--min-employees', default=100000, show_default=True, help='Refuse to run on less data than this.')
+@click.option('--verbose', is_flag=True, help='Also list the variants that pass.')
+def check_command(baseline, tolerance, min_employees, verbose):
+    """Check every query variant's plan against the shape rules and the baseline."""
+    recorded = {}
+    if os.path.exists(baseline):
+        with open(baseline) as f:
+            recorded = json.load(f)
+    with get_db_connection() as conn:
+        rows = _table_rows(conn)
+        _check_size(rows, min_employees)
+        if recorded.get('table_rows') and recorded['table_rows'] != rows:
+            click.echo(f"note: baseline was recorded on {recorded['table_rows']}, this data set has {rows}")
+        failed = 0
+        for key, name, variant, plan in run_all(conn):
+            failures = shape_failures(name, variant, plan)
+            if key in recorded.get('variants', {}):
+                failures += regressions(measure(plan), recorded['variants'][key], tolerance)
+            if failures:
+                failed += 1
+                click.echo(f"FAIL {key}: {'; '.join(failures)}")
+            elif verbose:
+                click.echo(f"ok   {key}")
+    click.echo(f"{failed} variant(s) failed" if failed else "all plans ok")
+    if failed:
+        raise SystemExit(1)
+
+
+@plans_cli.command('record')
+@click.option('--baseline', default=BASELINE_FILE, show_default=True, help='File to write.')
+@click.option('--min-employees', default=100000, show_default=True, help='Refuse to run on less data than this.')
+def record_command(baseline, min_employees):
+    """Write the current cost and buffer counts of every query variant as the baseline."""
+    with get_db_connection() as conn:
+        rows = _table_rows(conn)
+        _check_size(rows, min_employees)
+        variants = {key: measure(plan) for key, _, _, plan in run_all(conn)}
+    with open(baseline, 'w') as f:
+        json.dump({'table_rows': rows, 'variants': variants}, f, indent=2, sort_keys=True)
+    click.echo(f"recorded {len(variants)} variants in {baseline}")
@@ -1,12 +1,42 @@
 from flask import Blueprint
+import math
 import os
-from utilities import get_db_connection
-from flask import render_template, request, redirect, url_for, flash, g, Response
-import csv
-import io
+from utilities import get_db, read_only
+from versions import conditional
+from batch import QueryBatch
+from exports import export_response, get_export_format
+import export_jobs
+import queries
+import resultcache
+import async_db
+from async_db import Query
+from flask import render_template, request, redirect, url_for, flash, g, jsonify, current_app
 
 bp = Blueprint('projects', __name__, url_prefix='/projects')
 
+# Works_On write for each assignment mode; parameters are (Essn, Pno, Hours)
+# for add/set and (Essn, Pno) for remove. Each returns the affected Essn and
+# the resulting hours.
+ASSIGNMENT_SQL = {
+    # add hours to an existing assignment, or create it
+    'add': (
+        "INSERT INTO Works_On (Essn, Pno, Hours) VALUES (%s, %s, %s) "
+        "ON CONFLICT (Essn, Pno) DO UPDATE SET Hours = Works_On.Hours + EXCLUDED.Hours "
+        "RETURNING Essn, Hours"
+    ),
+    # replace the hours of an existing assignment, or create it
+    'set': (
+        "INSERT INTO Works_On (Essn, Pno, Hours) VALUES (%s, %s, %s) "
+        "ON CONFLICT (Essn, Pno) DO UPDATE SET Hours = EXCLUDED.Hours "
+        "RETURNING Essn, Hours"
+    ),
+    # take the employee off the project
+    'remove': "DELETE FROM Works_On WHERE Essn = %s AND Pno = %s RETURNING Essn, Hours",
+}
+# Largest value Works_On.Hours (DECIMAL(4,1)) can hold
+MAX_HOURS = 999.9
+
+
 @bp.before_request
 def require_login():
     # Protect all routes in this blueprint: only authenticated users may access
@@ -14,173 +44,285 @@ def require_login():
         return redirect(url_for('auth.login'))
 
 @bp.route('/')
+@read_only
+@conditional('project', 'department', 'works_on')
 def list_projects():
     """List all projects."""
-    # Whitelist sorting options — map allowed keys to fixed column names
+    # Whitelist sorting options; each one is a fixed variant of 'project_list' in queries.py
     sort_by = request.args.get('sort_by', type=str)
     order = request.args.get('order', 'asc').lower()
     if order not in ('asc', 'desc'):
         order = 'asc'
 
-    ALLOWED_SORT = {
-        'headcount': 'headcount',
-        'total_hours': 'total_hours',
-    }
-    sort_col = ALLOWED_SORT.get(sort_by)
-
-    # Main SQL query to get project details
-    # We use CASE WHEN to handle NULLs for headcount and total_hours
-    sql = (
-        "SELECT p.Pnumber AS pnumber, p.Pname AS project_name, d.Dname AS department_name, "                # project info
-        "CASE WHEN COUNT(DISTINCT w.Essn) IS NULL THEN 0 ELSE COUNT(DISTINCT w.Essn) END AS headcount, "    # headcount
-        "CASE WHEN SUM(w.Hours) IS NULL THEN 0 ELSE SUM(w.Hours) END AS total_hours "                       # total hours
-        "FROM Project p "                                                                                   # from Project
-        "LEFT JOIN Department d ON p.Dnum = d.Dnumber "                                                     # join Department
-        "LEFT JOIN Works_On w ON p.Pnumber = w.Pno "                                                        # join Works_On    
-        "GROUP BY p.Pnumber, p.Pname, d.Dname"                                                              # group by project and department    
-    )
-    # Append ORDER BY if a whitelisted sort column was provided
-    if sort_col:
-        sql = sql + f" ORDER BY {sort_col} {order}"
-
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql)
-            rows = cur.fetchall()
-            # rows are tuples; map to dicts for template
-            projects = []
-            for r in rows:
-                projects.append({
-                    'pnumber': r[0],
-                    'project_name': r[1],
-                    'department_name': r[2],
-                    'headcount': int(r[3]) if r[3] is not None else 0,
-                    'total_hours': float(r[4]) if r[4] is not None else 0.0,
-                })
-    finally:
-        conn.close()
+    ALLOWED_SORT = ('headcount', 'total_hours')
+    sort_col = sort_by if sort_by in ALLOWED_SORT else None
+
+    # Headcount and total hours per project (see queries.py; cached, see resultcache.py)
+    conn = get_db()
+    rows = resultcache.fetchall(conn, 'project_list', sort=sort_col, order=order)
+    # rows are tuples; map to dicts for template
+    projects = []
+    for r in rows:
+        projects.append({
+            'pnumber': r[0],
+            'project_name': r[1],
+            'department_name': r[2],
+            'headcount': int(r[3]) if r[3] is not None else 0,
+            'total_hours': float(r[4]) if r[4] is not None else 0.0,
+        })
 
     return render_template('projects.html', projects=projects)
 
+# (JSON key, CSV column title) for each exported column, in row order
+EXPORT_FIELDS = [
+    ('pnumber', 'Pnumber'),
+    ('project_name', 'Project Name'),
+    ('department', 'Department'),
+    ('headcount', 'Headcount'),
+    ('total_hours', 'Total Hours'),
+]
+
+def export_query(sort, order):
+    """Return the projects export's named query as (name, params, variant)."""
+    return 'project_list', None, dict(sort=sort, order=order)
+
+def export_row(r):
+    """Turn a project_list row into the EXPORT_FIELDS values."""
+    return (r[0], r[1], r[2], int(r[3] or 0), float(r[4] or 0.0))
+
+export_jobs.register('projects', 'projects_export', EXPORT_FIELDS, ('project', 'department', 'works_on'),
+                     export_query, export_row)
+
 @bp.route('/export')
+@read_only
+@conditional('project', 'department', 'works_on')
 def export_projects():
-    """Export the current filtered/sorted projects list as CSV."""
+    """Export the current filtered/sorted projects list as CSV, NDJSON or JSON (`format`).
+
+    `background=1` builds the file in a background job (see export_jobs.py).
+    """
+    fmt = get_export_format(request.args)
     # Reuse same sorting whitelist logic
     sort_by = request.args.get('sort_by', type=str)
     order = request.args.get('order', 'asc').lower()
     if order not in ('asc', 'desc'):
         order = 'asc'
 
-    ALLOWED_SORT = {
-        'headcount': 'headcount',
-        'total_hours': 'total_hours',
-    }
-    sort_col = ALLOWED_SORT.get(sort_by)
-
-    sql = (
-        "SELECT p.Pnumber AS pnumber, p.Pname AS project_name, d.Dname AS department_name, "
-        "COALESCE(COUNT(DISTINCT w.Essn),0) AS headcount, COALESCE(SUM(w.Hours),0) AS total_hours "
-        "FROM Project p "
-        "LEFT JOIN Department d ON p.Dnum = d.Dnumber "
-        "LEFT JOIN Works_On w ON p.Pnumber = w.Pno "
-        "GROUP BY p.Pnumber, p.Pname, d.Dname"
-    )
-    if sort_col:
-        sql = sql + f" ORDER BY {sort_col} {order}"
-
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql)
-            rows = cur.fetchall()
-    finally:
-        conn.close()
-
-    # Build CSV in memory
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Pnumber', 'Project Name', 'Department', 'Headcount', 'Total Hours'])
-    for r in rows:
-        writer.writerow([r[0], r[1], r[2] or '', int(r[3] or 0), float(r[4] or 0.0)])
+    ALLOWED_SORT = ('headcount', 'total_hours')
+    sort_col = sort_by if sort_by in ALLOWED_SORT else None
 
-    csv_data = output.getvalue()
-    output.close()
+    options = {'sort': sort_col, 'order': order}
+    if request.args.get('background'):
+        # Build the file in a background job instead (see export_jobs.py)
+        return export_jobs.submit_response('projects', fmt, options)
 
-    headers = {
-        'Content-Type': 'text/csv',
-        'Content-Disposition': 'attachment; filename="projects_export.csv"'
-    }
-    return Response(csv_data, headers=headers)
+    # Stream from a server-side cursor instead of building the file in memory
+    name, params, variant = export_query(**options)
+    rows = queries.stream('export_projects', name, params, **variant)
+    out_rows = (export_row(r) for r in rows)
+    return export_response('projects_export', EXPORT_FIELDS, out_rows, fmt, source=rows)
 
 @bp.route('/<int:project_id>', methods=('GET','POST'))
+@conditional('project', 'works_on', 'employee')
 def project_detail(project_id):
     """Show details for a specific project."""
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            # Verify project exists and get project name
-            cur.execute("SELECT Pname FROM Project WHERE Pnumber = %s", (project_id,))
-            proj = cur.fetchone()
-            if proj is None:
-                return render_template('project_detail.html', error='Project not found', project_id=project_id), 404
-            project_name = proj[0]
-
-            # Handle form submission (Upsert)
-            if request.method == 'POST':
-                # Enforce admin-only for modifications
-                if g.get('user') is None or g.get('user').get('role') != 'admin':
-                    flash('You do not have permission to modify project assignments.')
-                    return redirect(url_for('.project_detail', project_id=project_id))
-                emp_ssn = request.form.get('employee_ssn')
-                hours = request.form.get('hours')
-                try:
-                    hours_val = float(hours)
-                    if hours_val < 0:
-                        raise ValueError('Hours must be non-negative')
-                except Exception as e:
-                    flash(f'Invalid hours value: {e}')
-                    return redirect(url_for('.project_detail', project_id=project_id))
-
-                if not emp_ssn:
-                    flash('Please select an employee')
-                    return redirect(url_for('.project_detail', project_id=project_id))
-
-                # Perform atomic upsert: add hours if exists, insert if not
-                upsert_sql = (
-                    "INSERT INTO Works_On (Essn, Pno, Hours) VALUES (%s, %s, %s) "
-                    "ON CONFLICT (Essn, Pno) DO UPDATE SET Hours = Works_On.Hours + EXCLUDED.Hours"
-                )
-                cur.execute(upsert_sql, (emp_ssn, project_id, hours_val))
-                conn.commit()
-                flash('Assignment updated')
-                return redirect(url_for('.project_detail', project_id=project_id))
-
-            # GET: fetch assigned employees
-            cur.execute(
-                "SELECT e.Ssn, e.Fname, e.Minit, e.Lname, w.Hours "
-                "FROM Works_On w JOIN Employee e ON w.Essn = e.Ssn "
-                "WHERE w.Pno = %s ORDER BY e.Lname, e.Fname",
-                (project_id,)
-            )
-            assigned = cur.fetchall()
-
-            # Fetch all employees for dropdown
-            cur.execute("SELECT Ssn, Fname, Minit, Lname FROM Employee ORDER BY Lname, Fname")
-            all_emps = cur.fetchall()
-
-    finally:
-        conn.close()
+    conn = get_db()
+    if request.method == 'GET' and current_app.config.get('DB_ASYNC'):
+        # Async mode: the project and its assignments are fetched at the same time
+        proj_rows, assigned = async_db.gather(
+            Query(queries.sql('project_name'), (project_id,)),
+            Query(queries.sql('project_assignments'), (project_id,)),
+        )
+        if not proj_rows:
+            return render_template('project_detail.html', error='Project not found', project_id=project_id), 404
+        return _render_project_detail(project_id, proj_rows[0][0], assigned)
+
+    # Verify project exists and get project name. A GET fetches everything the
+    # page shows in the same round trip.
+    batch = QueryBatch(conn)
+    proj = queries.add(batch, 'project_name', (project_id,))
+    if request.method == 'GET':
+        assigned = queries.add(batch, 'project_assignments', (project_id,))
+    batch.run()
+    if proj.first() is None:
+        return render_template('project_detail.html', error='Project not found', project_id=project_id), 404
+    project_name = proj.first()[0]
+
+    # Handle form submission (Upsert)
+    if request.method == 'POST':
+        # Enforce admin-only for modifications
+        if g.get('user') is None or g.get('user').get('role') != 'admin':
+            flash('You do not have permission to modify project assignments.')
+            return redirect(url_for('.project_detail', project_id=project_id))
+        emp_ssn = request.form.get('employee_ssn')
+        hours = request.form.get('hours')
+        try:
+            hours_val = float(hours)
+            if not math.isfinite(hours_val) or hours_val < 0:
+                raise ValueError('Hours must be a non-negative number')
+        except Exception as e:
+            flash(f'Invalid hours value: {e}')
+            return redirect(url_for('.project_detail', project_id=project_id))
+
+        if not emp_ssn:
+            flash('Please select an employee')
+            return redirect(url_for('.project_detail', project_id=project_id))
+
+        # Perform atomic upsert: add hours if exists, insert if not.
+        # The upsert and its commit go out together.
+        batch.add(ASSIGNMENT_SQL['add'], (emp_ssn, project_id, hours_val))
+        batch.run(commit=True)
+        resultcache.invalidate()
+        flash('Assignment updated')
+        return redirect(url_for('.project_detail', project_id=project_id))
 
+    return _render_project_detail(project_id, project_name, assigned.value)
+
+
+def _render_project_detail(project_id, project_name, assigned):
     # Map rows into dicts for template convenience, formatting names
     assigned_list = [
         {'ssn': r[0], 'full_name': f"{r[1]} {r[2]} {r[3]}".replace('  ', ' '), 'hours': float(r[4])}
         for r in assigned
     ]
-    employees = [
-        {'ssn': r[0], 'full_name': f"{r[1]} {r[2]} {r[3]}".replace('  ', ' ')}
-        for r in all_emps
-    ]
 
+    # The employee picker loads its options from employees.lookup_employees as the user types
     return render_template('project_detail.html', project_id=project_id, project_name=project_name,
-                           assigned=assigned_list, employees=employees)
+                           assigned=assigned_list)
+
+
+def _assignment_rows():
+    """Read (mode, [(employee_ssn, hours), ...]) from a JSON or form request.
+
+    JSON: {"mode": "add", "rows": [{"employee_ssn": "...", "hours": 5}, ...]}
+    Form: `mode` plus either repeated `employee_ssn`/`hours` fields or a
+    `rows` textarea with one "ssn,hours" pair per line.
+
+    A JSON row that is not an object comes back as None. Raises ValueError
+    if a JSON body does not have that shape.
+    """
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise ValueError('The JSON body must be an object.')
+        mode = data.get('mode', 'add')
+        raw_rows = data.get('rows') or []
+        if not isinstance(mode, str) or not isinstance(raw_rows, list):
+            raise ValueError('"mode" must be a string and "rows" a list.')
+        rows = [
+            (str(r.get('employee_ssn') or '').strip(), r.get('hours')) if isinstance(r, dict) else None
+            for r in raw_rows
+        ]
+        return mode, rows
+    mode = request.form.get('mode', 'add')
+    text = request.form.get('rows')
+    if text:
+        rows = []
+        for line in text.splitlines():
+            if line.strip():
+                ssn, _, hours = line.partition(',')
+                rows.append((ssn.strip(), hours.strip() or None))
+        return mode, rows
+    ssns = request.form.getlist('employee_ssn')
+    hours = request.form.getlist('hours')
+    hours += [None] * (len(ssns) - len(hours))
+    return mode, [(ssn.strip(), h) for ssn, h in zip(ssns, hours)]
+
+
+@bp.route('/<int:project_id>/assignments', methods=('POST',))
+def bulk_assign(project_id):
+    """Apply many assignment changes to one project in a single transaction.
+
+    `mode` is `add` (add hours, the same as the single-row form), `set`
+    (replace the hours) or `remove` (delete the assignment; hours ignored).
+    Rows that fail validation are reported and skipped; the valid rows are
+    written with one executemany() and committed together. JSON requests get
+    per-row results as JSON; form posts get a summary flash and a redirect.
+    """
+    def fail(message, status):
+        if request.is_json:
+            return jsonify(error=message), status
+        flash(message)
+        return redirect(url_for('.project_detail', project_id=project_id))
+
+    if g.get('user') is None or g.get('user').get('role') != 'admin':
+        return fail('You do not have permission to modify project assignments.', 403)
+
+    try:
+        mode, rows = _assignment_rows()
+    except ValueError as e:
+        return fail(str(e), 400)
+    if mode not in ASSIGNMENT_SQL:
+        return fail(f"Unknown mode {mode!r}; use add, set or remove.", 400)
+
+    conn = get_db()
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM Project WHERE Pnumber = %s", (project_id,))
+        if cur.fetchone() is None:
+            return fail('Project not found', 404)
+        # One lookup for every SSN in the batch instead of one per row
+        cur.execute("SELECT Ssn FROM Employee WHERE Ssn = ANY(%s)", ([row[0] for row in rows if row and row[0]],))
+        known = {r[0] for r in cur.fetchall()}
+
+    # Validate each row; keep the index so results come back in request order
+    results = []
+    todo = []
+    for i, row in enumerate(rows):
+        if row is None:
+            results.append({'employee_ssn': '', 'status': 'error',
+                            'error': 'Malformed row: expected an object with employee_ssn and hours'})
+            continue
+        ssn, hours = row
+        result = {'employee_ssn': ssn, 'status': 'ok'}
+        results.append(result)
+        hours_val = None
+        if mode != 'remove':
+            try:
+                # JSON true/false would otherwise pass as 1 and 0
+                if isinstance(hours, bool):
+                    raise ValueError('must be a number')
+                hours_val = float(hours)
+                # float() accepts "nan" and "inf", and NaN passes any comparison
+                if not math.isfinite(hours_val) or hours_val < 0 or hours_val > MAX_HOURS:
+                    raise ValueError(f'Hours must be between 0 and {MAX_HOURS}')
+            except (TypeError, ValueError) as e:
+                result.update(status='error', error=f'Invalid hours value: {e}')
+                continue
+        if not ssn:
+            result.update(status='error', error='Missing employee_ssn')
+        elif ssn not in known:
+            result.update(status='error', error='Employee not found')
+        else:
+            params = (ssn, project_id) if mode == 'remove' else (ssn, project_id, hours_val)
+            todo.append((i, params))
+
+    if todo:
+        try:
+            with conn.cursor() as cur:
+                cur.executemany(ASSIGNMENT_SQL[mode], [params for _, params in todo], returning=True)
+                for i, _ in todo:
+                    row = cur.fetchone()
+                    if row is None:
+                        results[i].update(status='not_assigned')
+                    elif mode != 'remove':
+                        results[i]['hours'] = float(row[1])
+                    cur.nextset()
+            conn.commit()
+            resultcache.invalidate()
+        except Exception as e:
+            conn.rollback()
+            sqlstate = getattr(e, 'sqlstate', None)
+            if sqlstate == '22003':
+                # numeric_value_out_of_range: an added total went past MAX_HOURS
+                message = f'A resulting total would exceed {MAX_HOURS} hours; nothing was changed.'
+            else:
+                message = 'An error occurred while updating assignments; nothing was changed.'
+            return fail(message, 400)
+
+    applied = sum(1 for r in results if r['status'] == 'ok')
+    if request.is_json:
+        return jsonify(project_id=project_id, mode=mode, applied=applied, results=results)
+    failed = [f"{r['employee_ssn'] or '(blank)'}: {r.get('error', 'not assigned')}"
+              for r in results if r['status'] != 'ok']
+    flash(f'{applied} of {len(results)} assignment(s) updated.' + (' Skipped: ' + '; '.join(failed) if failed else ''))
+    return redirect(url_for('.project_detail', project_id=project_id))
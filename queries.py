@@ -0,0 +1,415 @@
+"""Named SQL queries shared by the views.
+
+Each query is registered under a name with a fixed set of variants (sort
+column, order, which filters are present, ...). The SQL text for a variant is
+built once and reused, and anything outside the whitelist is rejected, so no
+request input ever reaches the SQL text.
+
+Queries are executed as server-side prepared statements (prepare=True):
+psycopg prepares a statement the first time a connection runs it and reuses
+the plan on that connection afterwards. query_stats() reports, per query,
+how many executions found their statement already prepared. Set
+DB_PREPARE=0 to turn preparing off (e.g. behind a pooler in transaction
+mode, where prepared statements don't survive).
+
+    cur = conn.cursor()
+    queries.execute(cur, 'project_list', sort='headcount', order='desc')
+    rows = cur.fetchall()
+"""
+import itertools
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from pagination import SortKey, order_by_sql, after_sql, number
+from exports import iter_query
+
+PREPARE = os.environ.get('DB_PREPARE', '1') != '0'
+
+_queries = {}
+_stats = {}
+_stats_lock = threading.Lock()
+# connection -> SQL texts it has prepared, most recently used last
+_prepared = weakref.WeakKeyDictionary()
+
+
+class NamedQuery:
+    """A query's SQL builder plus the values each of its variant options may take."""
+
+    def __init__(self, name, build, options):
+        self.name = name
+        self.build = build
+        self.options = options
+        self._sql = {}
+
+    def sql(self, **variant):
+        """Return the SQL text for one variant, building it on first use."""
+        if set(variant) != set(self.options):
+            raise ValueError(f"query {self.name!r} takes options {sorted(self.options)}, got {sorted(variant)}")
+        for option, value in variant.items():
+            if value not in self.options[option]:
+                raise ValueError(f"query {self.name!r}: {value!r} is not an allowed {option}")
+        key = tuple(sorted(variant.items()))
+        text = self._sql.get(key)
+        if text is None:
+            text = self._sql[key] = self.build(**variant)
+        return text
+
+    def variants(self):
+        """Every allowed combination of options, as dicts."""
+        names = sorted(self.options)
+        for values in itertools.product(*(self.options[n] for n in names)):
+            yield dict(zip(names, values))
+
+
+def query(name, **options):
+    """Register the decorated function as the SQL builder for query `name`.
+
+    Each keyword names one variant option and lists its allowed values; the
+    builder is called with one value per option.
+    """
+    def register(build):
+        _queries[name] = NamedQuery(name, build, options)
+        _stats[name] = {'executions': 0, 'prepared_hits': 0}
+        return build
+    return register
+
+
+def query_names():
+    """Return the names of all registered queries, sorted."""
+    return sorted(_queries)
+
+
+def get_query(name):
+    """Return the NamedQuery registered as `name`."""
+    return _queries[name]
+
+
+def sql(name, **variant):
+    """Return the SQL text of one variant of a named query."""
+    return _queries[name].sql(**variant)
+
+
+def _note_execution(conn, name, text):
+    seen = _prepared.get(conn)
+    if seen is None:
+        seen = _prepared[conn] = OrderedDict()
+    hit = text in seen
+    seen[text] = True
+    seen.move_to_end(text)
+    # psycopg keeps at most prepared_max statements per connection, evicting
+    # the least recently used; mirror that so the hit count stays honest.
+    while len(seen) > (conn.prepared_max or 0):
+        seen.popitem(last=False)
+    with _stats_lock:
+        stats = _stats[name]
+        stats['executions'] += 1
+        stats['prepared_hits'] += hit
+
+
+def execute(cur, name, params=None, **variant):
+    """Run one variant of a named query on `cur` as a prepared statement."""
+    text = sql(name, **variant)
+    if PREPARE:
+        _note_execution(cur.connection, name, text)
+    return cur.execute(text, params, prepare=PREPARE)
+
+
+def add(batch, name, params=None, row_factory=None, then=None, **variant):
+    """Queue one variant of a named query on a QueryBatch as a prepared statement."""
+    text = sql(name, **variant)
+    if PREPARE:
+        _note_execution(batch.conn, name, text)
+    return batch.add(text, params, row_factory, then=then, prepare=PREPARE)
+
+
+def stream(cursor_name, name, params=None, **variant):
+    """iter_query() for a named query. Server-side cursors are not prepared."""
+    return iter_query(cursor_name, sql(name, **variant), params)
+
+
+def query_stats():
+    """Return {name: {executions, prepared_hits, hit_rate, variants_built}} for every query."""
+    with _stats_lock:
+        report = {}
+        for name, stats in _stats.items():
+            runs = stats['executions']
+            report[name] = dict(stats, hit_rate=round(stats['prepared_hits'] / runs, 3) if runs else None,
+                                variants_built=len(_queries[name]._sql))
+        return report
+
+
+# --- Employee overview (home page and its export) ---------------------------
+
+# Lower-cased "First M Last" used for name search. The trigram index
+# idx_employee_search_name in team_setup.sql is built on exactly this
+# expression, so any query that filters on it (with alias `e` for Employee)
+# can use the index instead of scanning the table.
+NAME_SEARCH_EXPR = "LOWER(e.Fname || ' ' || COALESCE(e.Minit, '') || ' ' || e.Lname)"
+
+
+def overview_sort_keys(sort_by, order):
+    """Return the whitelisted ORDER BY keys for the overview.
+
+    Ssn is always the last key so the order is total, which keyset
+    pagination needs to page without skipping or repeating rows.
+    """
+    desc = order == "desc"
+    if sort_by == "total_hours":
+        # Sort by hours then last name then first name
+        return [
+            SortKey("COALESCE(s.total_hours, 0)", desc, "total_hours", number),
+            SortKey("e.lname", False, "lname"),
+            SortKey("e.fname", False, "fname"),
+            SortKey("e.ssn", False, "ssn"),
+        ]
+    # Sort by last name, then first name, then minit
+    return [
+        SortKey("e.lname", desc, "lname"),
+        SortKey("e.fname", desc, "fname"),
+        SortKey("e.minit", desc, "minit"),
+        SortKey("e.ssn", desc, "ssn"),
+    ]
+
+
+def _overview_where(dept, q, extra=None):
+    # Parameters, in order: Dno if dept, the name pattern if q, then extra's.
+    clauses = []
+    if dept:
+        clauses.append("e.dno = %s")
+    if q:
+        # served by the trigram index
+        clauses.append(f"{NAME_SEARCH_EXPR} LIKE %s")
+    if extra:
+        clauses.append(extra)
+    return "WHERE " + " AND ".join(clauses) if clauses else ""
+
+
+# The per-employee counts come from employee_stats, which triggers keep in
+# sync with Dependent and Works_On (see team_setup.sql).
+_OVERVIEW_SELECT = """
+    SELECT
+        e.ssn,
+        e.fname,
+        e.minit,
+        e.lname,
+        d.dname AS department_name,
+        COALESCE(s.num_dependents, 0) AS num_dependents,
+        COALESCE(s.num_projects, 0)   AS num_projects,
+        COALESCE(s.total_hours, 0)    AS total_hours
+    FROM employee e
+    LEFT JOIN department d ON e.dno = d.dnumber
+    LEFT JOIN employee_stats s ON e.ssn = s.ssn
+"""
+
+_SORTS = ('name', 'total_hours')
+_ORDERS = ('asc', 'desc')
+_FLAGS = (False, True)
+
+
+@query('overview_page', sort_by=_SORTS, order=_ORDERS, dept=_FLAGS, q=_FLAGS, cursor=(None, 'next', 'prev'))
+def _overview_page(sort_by, order, dept, q, cursor):
+    # Parameters: the filters', the keyset cursor's (pagination.after_params), then the LIMIT.
+    keys = overview_sort_keys(sort_by, order)
+    backwards = cursor == 'prev'
+    where = _overview_where(dept, q, after_sql(keys, backwards) if cursor else None)
+    return f"{_OVERVIEW_SELECT} {where} ORDER BY {order_by_sql(keys, backwards)} LIMIT %s"
+
+
+@query('overview_count', dept=_FLAGS, q=_FLAGS)
+def _overview_count(dept, q):
+    return f"SELECT COUNT(*) AS n FROM employee e {_overview_where(dept, q)}"
+
+
+@query('overview_export', sort_by=_SORTS, order=_ORDERS, dept=_FLAGS, q=_FLAGS)
+def _overview_export(sort_by, order, dept, q):
+    keys = overview_sort_keys(sort_by, order)
+    return f"{_OVERVIEW_SELECT} {_overview_where(dept, q)} ORDER BY {order_by_sql(keys)}"
+
+
+# --- Projects ----------------------------------------------------------------
+
+# Headcount and total hours come from project_stats, which triggers keep in
+# sync with Works_On (see team_setup.sql), so there is no aggregate here.
+@query('project_list', sort=(None, 'headcount', 'total_hours'), order=_ORDERS)
+def _project_list(sort, order):
+    sql = (
+        "SELECT p.Pnumber AS pnumber, p.Pname AS project_name, d.Dname AS department_name, "   # project info
+        "COALESCE(ps.headcount, 0) AS headcount, "                                             # headcount
+        "COALESCE(ps.total_hours, 0) AS total_hours "                                          # total hours
+        "FROM Project p "                                                                      # from Project
+        "LEFT JOIN Department d ON p.Dnum = d.Dnumber "                                        # join Department
+        "LEFT JOIN project_stats ps ON ps.pnumber = p.Pnumber"                                 # join rollup
+    )
+    # Append ORDER BY if a sort column was asked for
+    if sort:
+        sql = sql + f" ORDER BY {sort} {order}"
+    return sql
+
+
+@query('project_name')
+def _project_name():
+    return "SELECT Pname FROM Project WHERE Pnumber = %s"
+
+
+@query('project_assignments')
+def _project_assignments():
+    return (
+        "SELECT e.Ssn, e.Fname, e.Minit, e.Lname, w.Hours "
+        "FROM Works_On w JOIN Employee e ON w.Essn = e.Ssn "
+        "WHERE w.Pno = %s ORDER BY e.Lname, e.Fname"
+    )
+
+
+# --- Employees list (admin) ----------------------------------------------------
+
+# Last name, first name; Ssn makes the order total for keyset paging.
+# The fields are the row indexes in employee_page's SELECT list.
+EMPLOYEE_LIST_KEYS = [SortKey("Lname", False, 3), SortKey("Fname", False, 1), SortKey("Ssn", False, 0)]
+
+
+@query('employee_page', cursor=(None, 'next', 'prev'))
+def _employee_page(cursor):
+    # Parameters: the keyset cursor's (pagination.after_params), then the LIMIT.
+    backwards = cursor == 'prev'
+    where = f" WHERE {after_sql(EMPLOYEE_LIST_KEYS, backwards)}" if cursor else ""
+    return (
+        "SELECT Ssn, Fname, Minit, Lname, Address, Sex, Salary, Super_ssn, Dno"
+        f" FROM Employee{where} ORDER BY {order_by_sql(EMPLOYEE_LIST_KEYS, backwards)} LIMIT %s"
+    )
+
+
+@query('employee_count')
+def _employee_count():
+    return "SELECT COUNT(*) FROM Employee"
+
+
+# --- Employee picker ---------------------------------------------------------
+
+# "lname fname", lower-cased, in byte order. idx_employee_sort_name and
+# idx_employee_dept_sort_name in team_setup.sql are built on exactly this
+# expression, so a name-prefix range on it and the keyset order both come
+# straight from the index.
+SORT_NAME_EXPR = "(LOWER(e.Lname || ' ' || e.Fname) COLLATE \"C\")"
+
+
+def employee_lookup_keys(by):
+    """Return the keyset sort keys of the employee picker, by name or by SSN."""
+    if by == 'ssn':
+        return [SortKey("e.Ssn", False, "ssn")]
+    return [SortKey(SORT_NAME_EXPR, False, "sort_name"), SortKey("e.Ssn", False, "ssn")]
+
+
+@query('employee_lookup', by=('name', 'ssn'), q=_FLAGS, dept=_FLAGS, exclude=_FLAGS, cursor=(None, 'next'))
+def _employee_lookup(by, q, dept, exclude, cursor):
+    # Parameters, in order: Dno if dept; the prefix's range (low, high) if q;
+    # the project to leave out if exclude; the cursor's values; the LIMIT.
+    keys = employee_lookup_keys(by)
+    clauses = []
+    if dept:
+        clauses.append("e.Dno = %s")
+    if q and by == 'ssn':
+        clauses.append("e.Ssn BETWEEN %s AND %s")
+    elif q:
+        clauses.append(f"{SORT_NAME_EXPR} >= %s AND {SORT_NAME_EXPR} < %s")
+    if exclude:
+        clauses.append("NOT EXISTS (SELECT 1 FROM Works_On w WHERE w.Essn = e.Ssn AND w.Pno = %s)")
+    if cursor:
+        clauses.append(after_sql(keys))
+    where = "WHERE " + " AND ".join(clauses) if clauses else ""
+    return (
+        f"SELECT e.Ssn AS ssn, e.Fname AS fname, e.Minit AS minit, e.Lname AS lname, "
+        f"d.Dname AS department_name, {SORT_NAME_EXPR} AS sort_name "
+        f"FROM Employee e LEFT JOIN Department d ON e.Dno = d.Dnumber "
+        f"{where} ORDER BY {order_by_sql(keys)} LIMIT %s"
+    )
+
+
+# --- Employee search (search.py) ---------------------------------------------
+
+@query('employee_search')
+def _employee_search():
+    # Parameters: the substring pattern, the prefix pattern, the lower-cased
+    # text for similarity(), the LIMIT.
+    return (
+        "SELECT e.Ssn, e.Fname, e.Minit, e.Lname, d.Dname "
+        "FROM Employee e "
+        "LEFT JOIN Department d ON e.Dno = d.Dnumber "
+        f"WHERE {NAME_SEARCH_EXPR} LIKE %s "
+        f"ORDER BY {NAME_SEARCH_EXPR} LIKE %s DESC, "
+        f"similarity({NAME_SEARCH_EXPR}, %s) DESC, e.Lname, e.Fname, e.Ssn "
+        "LIMIT %s"
+    )
+
+
+# --- Batch reads by key (api.py) ----------------------------------------------
+
+# One parameter each: the list of keys, matched with = ANY(%s) on the primary key
+@query('employees_by_ssn')
+def _employees_by_ssn():
+    return (
+        "SELECT e.Ssn AS ssn, e.Fname AS fname, e.Minit AS minit, e.Lname AS lname, e.Address AS address, "
+        "e.Sex AS sex, e.Salary AS salary, e.Super_ssn AS super_ssn, e.Dno AS dno, d.Dname AS department_name, "
+        "e.BDate AS bdate, e.EmpDate AS empdate, COALESCE(s.num_dependents, 0) AS num_dependents, "
+        "COALESCE(s.num_projects, 0) AS num_projects, COALESCE(s.total_hours, 0) AS total_hours "
+        "FROM Employee e "
+        "LEFT JOIN Department d ON e.Dno = d.Dnumber "
+        "LEFT JOIN employee_stats s ON s.ssn = e.Ssn "
+        "WHERE e.Ssn = ANY(%s)"
+    )
+
+
+@query('projects_by_number')
+def _projects_by_number():
+    return (
+        "SELECT p.Pnumber AS pnumber, p.Pname AS pname, p.Plocation AS plocation, p.Dnum AS dnum, "
+        "d.Dname AS department_name, COALESCE(ps.headcount, 0) AS headcount, "
+        "COALESCE(ps.total_hours, 0) AS total_hours "
+        "FROM Project p "
+        "LEFT JOIN Department d ON p.Dnum = d.Dnumber "
+        "LEFT JOIN project_stats ps ON ps.pnumber = p.Pnumber "
+        "WHERE p.Pnumber = ANY(%s)"
+    )
+
+
+@query('assignments_by_project')
+def _assignments_by_project():
+    return (
+        "SELECT w.Pno AS pno, e.Ssn AS ssn, e.Fname AS fname, e.Minit AS minit, e.Lname AS lname, w.Hours AS hours "
+        "FROM Works_On w JOIN Employee e ON w.Essn = e.Ssn "
+        "WHERE w.Pno = ANY(%s) ORDER BY w.Pno, e.Lname, e.Fname"
+    )
+
+
+# --- Departments -------------------------------------------------------------
+
+# Employee counts and hours come from department_stats, which triggers keep
+# in sync with Employee and Works_On (see team_setup.sql).
+# Coalesce used to return NULL if no value associated
+@query('department_list')
+def _department_list():
+    return (
+        "SELECT "
+        "CONCAT(d.Dname, ' (', d.Dnumber, ')') AS dept_name_num, "
+        "COALESCE(NULLIF(CONCAT_WS(' ', m.Fname, m.Minit, m.Lname), ''), 'None') AS manager_name, "
+        "COALESCE(ds.employee_count, 0) AS employee_count, "
+        "COALESCE(ds.total_hours, 0) AS total_hours "
+        "FROM Department d "
+        "LEFT JOIN Employee m ON d.Mgr_ssn = m.Ssn "
+        "LEFT JOIN department_stats ds ON ds.dnumber = d.Dnumber "
+        "ORDER BY d.Dname"
+    )
+
+
+# The department dropdown (cached; see refdata.py)
+@query('department_names')
+def _department_names():
+    return "SELECT dnumber, dname FROM department ORDER BY dname"
+
+
+# --- Users -------------------------------------------------------------------
+
+# Only the fields the views and templates need; never the password hash.
+@query('app_user')
+def _app_user():
+    return "SELECT id, username, role FROM app_user WHERE id = %s"
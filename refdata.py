@@ -0,0 +1,84 @@
+import os
+import threading
+import psycopg
+from cache import TTLCache
+from batch import resolved
+import queries
+
+# Reference data for pick-lists (the department dropdown). The lists change
+# rarely but are read on almost every page, so they are cached per process.
+# Entries expire after REFDATA_CACHE_TTL seconds, which bounds how long a
+# department added or renamed elsewhere takes to show up. The app has no view
+# that writes Department; one that does should call bump_version(), which makes
+# every cached list stale immediately in this process. (The employee picker
+# pages through /employees/lookup instead.)
+refdata_cache = TTLCache(maxsize=16, ttl=float(os.environ.get('REFDATA_CACHE_TTL', 60)), name='refdata')
+_version = 0
+_version_lock = threading.Lock()
+
+
+def bump_version():
+    """Invalidate the cached lists after a write to Department."""
+    global _version
+    with _version_lock:
+        _version += 1
+    refdata_cache.clear()
+
+
+def _cached(name, conn, load):
+    # The version is part of the key, so a reader that started before a bump
+    # can't store its (possibly stale) result where later readers will find it.
+    key = (name, _version)
+    value = refdata_cache.get(key)
+    if value is None:
+        value = load(conn)
+        refdata_cache.set(key, value)
+    return value
+
+
+def _queue_cached(name, batch, query_name, row_factory, build):
+    # Like _cached, but on a miss the query joins `batch` instead of running now.
+    key = (name, _version)
+    value = refdata_cache.get(key)
+    if value is not None:
+        return resolved(value)
+
+    def store(rows):
+        value = build(rows)
+        refdata_cache.set(key, value)
+        return value
+    return queries.add(batch, query_name, row_factory=row_factory, then=store)
+
+
+def _load_departments(conn):
+    with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
+        queries.execute(cur, 'department_names')
+        return cur.fetchall()
+
+
+def get_departments(conn):
+    """Return [{'dnumber', 'dname'}, ...] ordered by name."""
+    return _cached('departments', conn, _load_departments)
+
+
+def queue_departments(batch):
+    """get_departments() for a QueryBatch: returns a BatchResult, queueing the query on a miss."""
+    return _queue_cached('departments', batch, 'department_names', psycopg.rows.dict_row, list)
+
+
+def lookup_departments():
+    """Return (key, departments) for a caller that runs the query itself (async_db.gather).
+
+    departments is None on a miss: the caller then runs the 'department_names'
+    query with dict rows and passes them to store(key, rows).
+    """
+    key = ('departments', _version)
+    return key, refdata_cache.get(key)
+
+
+def store(key, rows):
+    """Cache the rows of a miss returned by lookup_departments(), and return them."""
+    value = list(rows)
+    refdata_cache.set(key, value)
+    return value
+
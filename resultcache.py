@@ -0,0 +1,187 @@
+"""Result cache for the overview and project-list queries.
+
+Dashboards reload the home page and the project list with the same few
+filter and sort combinations. The rows of those queries are cached per
+process, keyed by the query name, its (whitelisted) variant, its parameters
+and the data_version of every table it reads (see versions.py). Any write to
+one of those tables, from any worker or from psql, bumps a version, so the
+next request misses and reads fresh rows. Write paths in this app also call
+invalidate(), which frees the stale entries right away.
+
+    RESULT_CACHE_TTL        seconds an entry lives (default 30; 0 turns the cache off)
+    RESULT_CACHE_MAX_BYTES  memory budget, by pickled size (default 32 MiB)
+    RESULT_CACHE_FILE       optional SQLite file shared by the workers on this host
+
+Concurrent misses on one key are coalesced: the first request runs the query
+and the others wait (up to RESULT_CACHE_WAIT seconds) for its rows.
+"""
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from flask import g
+from cache import TTLCache
+from batch import resolved
+from utilities import env_float, env_int
+from versions import get_versions
+import queries
+
+# Queries whose results may be cached, and the tables each one reads
+CACHED_QUERIES = {
+    'overview_page': ('employee', 'department', 'works_on', 'dependent'),
+    'overview_count': ('employee', 'department', 'works_on', 'dependent'),
+    'project_list': ('project', 'department', 'works_on'),
+}
+
+RESULT_CACHE_TTL = env_float('RESULT_CACHE_TTL', 30.0)
+RESULT_CACHE_WAIT = env_float('RESULT_CACHE_WAIT', 5.0)
+RESULT_CACHE_FILE = os.environ.get('RESULT_CACHE_FILE')
+
+result_cache = TTLCache(maxsize=4096, ttl=RESULT_CACHE_TTL, name='results',
+                        maxbytes=env_int('RESULT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+# Returned by lookup() when the caller has to run the query itself
+MISSING = object()
+
+# key -> Event set when the request loading that key is done
+_inflight = {}
+_inflight_lock = threading.Lock()
+_local = threading.local()
+
+
+def _versions(conn, tables):
+    # @conditional has usually read them already for this request
+    known = g.setdefault('data_versions', {})
+    missing = [t for t in tables if t not in known]
+    if missing:
+        known.update(get_versions(conn, missing))
+    return tuple(known.get(t, (None,))[0] for t in tables)
+
+
+def _shared_db():
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = _local.db = sqlite3.connect(RESULT_CACHE_FILE, timeout=1.0)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, expires REAL, value BLOB)")
+    return db
+
+
+def _shared_key(key):
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def _shared_get(key):
+    try:
+        row = _shared_db().execute("SELECT value FROM results WHERE key = ? AND expires > ?",
+                                   (_shared_key(key), time.time())).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+def _shared_set(key, blob):
+    try:
+        with _shared_db() as db:
+            now = time.time()
+            db.execute("DELETE FROM results WHERE expires <= ?", (now,))
+            db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                       (_shared_key(key), now + RESULT_CACHE_TTL, blob))
+    except sqlite3.Error:
+        pass    # the shared store is only an optimization
+
+
+def _get(key):
+    value = result_cache.get(key, MISSING)
+    if value is MISSING and RESULT_CACHE_FILE:
+        blob = _shared_get(key)
+        if blob is not None:
+            value = pickle.loads(blob)
+            result_cache.set(key, value, len(blob))
+    return value
+
+
+def lookup(conn, name, params=None, **variant):
+    """Return (key, rows) for one variant of a named query.
+
+    rows is MISSING on a miss: the caller then runs the query and passes the
+    rows to store(key, rows). key is None if the query is not cacheable.
+    """
+    if RESULT_CACHE_TTL <= 0 or name not in CACHED_QUERIES:
+        return None, MISSING
+    queries.sql(name, **variant)    # reject anything outside the whitelist
+    key = (name, tuple(sorted(variant.items())), tuple(params or ()), _versions(conn, CACHED_QUERIES[name]))
+    while True:
+        value = _get(key)
+        if value is not MISSING:
+            return key, value
+        with _inflight_lock:
+            event = _inflight.get(key)
+            if event is None:
+                # Nobody is loading this key: this request does
+                _inflight[key] = threading.Event()
+                g.setdefault('result_cache_loading', []).append(key)
+                return key, MISSING
+        if not event.wait(RESULT_CACHE_WAIT):
+            return None, MISSING
+
+
+def _done(key):
+    with _inflight_lock:
+        event = _inflight.pop(key, None)
+    if event is not None:
+        event.set()
+
+
+def store(key, rows):
+    """Cache the rows of a miss returned by lookup(), and return them."""
+    if key is None:
+        return rows
+    blob = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+    result_cache.set(key, rows, len(blob))
+    if RESULT_CACHE_FILE:
+        _shared_set(key, blob)
+    _done(key)
+    return rows
+
+
+def release(e=None):
+    """Wake the waiters of keys this request claimed but never stored (e.g. after an error)."""
+    for key in g.pop('result_cache_loading', ()):
+        _done(key)
+
+
+def fetchall(conn, name, params=None, row_factory=None, **variant):
+    """Run one variant of a named query (see queries.execute) and return its rows, cached."""
+    key, rows = lookup(conn, name, params, **variant)
+    if rows is MISSING:
+        with conn.cursor(row_factory=row_factory) as cur:
+            queries.execute(cur, name, params, **variant)
+            rows = store(key, cur.fetchall())
+    return rows
+
+
+def add(batch, name, params=None, row_factory=None, **variant):
+    """queries.add() through the cache: returns a BatchResult, queueing the query on a miss."""
+    key, rows = lookup(batch.conn, name, params, **variant)
+    if rows is not MISSING:
+        return resolved(rows)
+    return queries.add(batch, name, params, row_factory, then=lambda rows: store(key, rows), **variant)
+
+
+def invalidate():
+    """Drop every cached result after a write through this app."""
+    result_cache.clear()
+    if RESULT_CACHE_FILE:
+        try:
+            with _shared_db() as db:
+                db.execute("DELETE FROM results")
+        except sqlite3.Error:
+            pass
+
+
+def init_app(app):
+    """Release unfinished single-flight claims at the end of each request."""
+    app.teardown_appcontext(release)
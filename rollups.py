@@ -0,0 +1,78 @@
+"""Maintenance commands for the trigger-maintained summary tables.
+
+The tables, their triggers, and the matching `<name>_drift` views and
+`<name>_rebuild()` functions live in team_setup.sql. Usage:
+
+    flask --app app rollups verify            # exit status 1 if any table drifted
+    flask --app app rollups rebuild employee_stats
+"""
+import click
+from flask.cli import AppGroup
+from utilities import get_db_connection
+from versions import bump_all
+
+rollups_cli = AppGroup('rollups', help='Verify or rebuild the summary tables kept by triggers.')
+
+# Summary table name -> (rebuild function, drift view)
+ROLLUPS = {
+    'employee_stats': ('employee_stats_rebuild', 'employee_stats_drift'),
+    'project_stats': ('project_stats_rebuild', 'project_stats_drift'),
+    'department_stats': ('department_stats_rebuild', 'department_stats_drift'),
+}
+
+
+def find_drift(conn, name, limit=20):
+    """Return (column names, up to `limit` drifted rows) for one summary table."""
+    _, drift_view = ROLLUPS[name]
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT * FROM {drift_view} LIMIT %s", (limit,))
+        return [col.name for col in cur.description], cur.fetchall()
+
+
+def rebuild(conn, name):
+    """Recompute one summary table from the base tables and commit."""
+    rebuild_fn, _ = ROLLUPS[name]
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT {rebuild_fn}()")
+    # Pages showing the old (drifted) numbers must not be answered with 304
+    bump_all(conn)
+    conn.commit()
+
+
+def _selected(names):
+    unknown = [n for n in names if n not in ROLLUPS]
+    if unknown:
+        raise click.BadParameter(f"unknown summary table(s): {', '.join(unknown)}; "
+                                 f"choose from {', '.join(ROLLUPS)}")
+    return names or tuple(ROLLUPS)
+
+
+@rollups_cli.command('verify')
+@click.argument('names', nargs=-1)
+@click.option('--limit', default=20, show_default=True, help='Drifted rows to show per table.')
+def verify_command(names, limit):
+    """Compare summary tables with the base tables and report drift."""
+    drifted = False
+    with get_db_connection() as conn:
+        for name in _selected(names):
+            columns, rows = find_drift(conn, name, limit)
+            if not rows:
+                click.echo(f"{name}: ok")
+                continue
+            drifted = True
+            click.echo(f"{name}: DRIFT ({len(rows)}{'+' if len(rows) == limit else ''} rows)")
+            click.echo('  ' + ', '.join(columns))
+            for row in rows:
+                click.echo('  ' + ', '.join('' if v is None else str(v) for v in row))
+    if drifted:
+        raise SystemExit(1)
+
+
+@rollups_cli.command('rebuild')
+@click.argument('names', nargs=-1)
+def rebuild_command(names):
+    """Recompute summary tables from the base tables."""
+    with get_db_connection() as conn:
+        for name in _selected(names):
+            rebuild(conn, name)
+            click.echo(f"{name}: rebuilt")
@@ -0,0 +1,57 @@
+from flask import Blueprint, request, g, jsonify, redirect, url_for
+from utilities import get_db, read_only
+from versions import conditional
+import queries
+
+bp = Blueprint('search', __name__, url_prefix='/search')
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+
+@bp.before_request
+def require_login():
+    # Protect all routes in this blueprint: only authenticated users may access
+    if g.get('user') is None:
+        return redirect(url_for('auth.login'))
+
+
+def name_pattern(q):
+    """Return the LIKE pattern for a case-insensitive substring match on `q`."""
+    return f"%{q.lower()}%"
+
+
+@bp.route('/employees')
+@read_only
+@conditional('employee', 'department')
+def search_employees():
+    """Ranked type-ahead search over employee names.
+
+    Query parameters:
+        q      text to look for anywhere in the full name (case-insensitive)
+        limit  maximum number of results (default 10, at most 50)
+
+    Names that start with `q` come first, then the closest trigram matches.
+    """
+    q = (request.args.get('q') or '').strip()
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    limit = max(1, min(limit, MAX_LIMIT))
+    if not q:
+        return jsonify(q=q, results=[])
+
+    # The SQL is 'employee_search' in queries.py
+    params = [name_pattern(q), f"{q.lower()}%", q.lower(), limit]
+    conn = get_db()
+    with conn.cursor() as cur:
+        queries.execute(cur, 'employee_search', params)
+        rows = cur.fetchall()
+
+    results = [
+        {
+            'ssn': r[0],
+            'full_name': f"{r[1]} {r[2] or ''} {r[3]}".replace('  ', ' ').strip(),
+            'department_name': r[4],
+        }
+        for r in rows
+    ]
+    return jsonify(q=q, results=results)
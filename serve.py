@@ -0,0 +1,132 @@
+"""Production server: the app under gunicorn, warmed up before it takes traffic.
+
+    python serve.py --bind 0.0.0.0:8000 --pid serve.pid
+    python serve.py --workers 4 --threads 8
+    kill -HUP $(cat serve.pid)          # graceful reload
+
+Requires gunicorn (in requirements.txt), which runs on Linux/macOS only.
+
+The master process builds the app with create_app() and compiles every
+Jinja template before it forks the workers, so they all start with the
+compiled templates (--preload, the default). Each worker then opens its
+database pools and waits for their first connections before it accepts a
+request, so the first requests after a deploy don't pay for either. The log
+reports how long the app took to build and how long each worker took to be
+ready, counted from launch (or from the last reload).
+
+    SERVE_BIND      address to listen on (default 127.0.0.1:8000)
+    SERVE_WORKERS   worker processes (default: CPU count)
+    SERVE_THREADS   threads per worker (default 4; 1 uses gunicorn's sync worker)
+
+Each worker has its own connection pool (up to DB_POOL_MAX_SIZE connections,
+plus DB_ASYNC_POOL_MAX_SIZE with DB_MODE=async) and, unless
+PASSWORD_HASH_WORKERS is set, an equal share of the CPUs for password hashing.
+
+On SIGHUP gunicorn starts new workers and stops the old ones once their
+requests are done (--graceful-timeout). With --preload the new workers are
+forked from the master and so run the code it loaded: to deploy new code,
+either start with --no-preload (every worker then builds the app itself) or
+send SIGUSR2 to start a new master next to the old one, then SIGTERM the old.
+"""
+import time
+_started = time.monotonic()
+
+import os
+import click
+from gunicorn.app.base import BaseApplication
+from utilities import env_int, warm_pools
+
+# How long create_app() and the template compilation took, and how many templates there are
+_build = {}
+
+
+def compile_templates(app):
+    """Load and compile every template now instead of on its first render. Returns how many."""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def on_reload(server):
+    # Workers forked after this count their time to ready from the reload
+    global _started
+    _started = time.monotonic()
+
+
+def when_ready(server):
+    cfg = server.cfg
+    per_worker = env_int("DB_POOL_MAX_SIZE", 10)
+    if os.environ.get('DB_MODE', 'sync').lower() == 'async':
+        per_worker += env_int("DB_ASYNC_POOL_MAX_SIZE", 4)
+    server.log.info("%d worker(s) x %d thread(s); up to %d database connections per server",
+                    cfg.workers, cfg.threads, cfg.workers * per_worker)
+    if cfg.threads > env_int("DB_POOL_MAX_SIZE", 10):
+        server.log.warning("more threads than DB_POOL_MAX_SIZE: some requests will wait for a connection")
+
+
+def post_worker_init(worker):
+    # Runs in each worker after the app is loaded and before it accepts requests
+    app = worker.wsgi
+    connections = warm_pools()
+    if app.config.get('DB_ASYNC'):
+        import async_db
+        async_db.warm_up()
+    worker.log.info("Worker ready in %.2fs (app built in %.2fs, %d templates compiled; connections: %s)",
+                    time.monotonic() - _started, _build.get('seconds', 0), _build.get('templates', 0),
+                    ', '.join(f"{name}={count}" for name, count in connections.items()))
+
+
+class Server(BaseApplication):
+    """gunicorn application that builds the app with create_app()."""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # In the master with --preload, otherwise in each worker
+        start = time.monotonic()
+        from app import create_app
+        app = create_app()
+        _build['templates'] = compile_templates(app)
+        _build['seconds'] = time.monotonic() - start
+        return app
+
+
+@click.command()
+@click.option('--bind', default=os.environ.get('SERVE_BIND', '127.0.0.1:8000'), show_default=True,
+              help='Address to listen on.')
+@click.option('--workers', type=int, default=env_int('SERVE_WORKERS', os.cpu_count() or 1), show_default=True,
+              help='Worker processes.')
+@click.option('--threads', type=int, default=env_int('SERVE_THREADS', 4), show_default=True,
+              help='Threads per worker.')
+@click.option('--preload/--no-preload', default=True, show_default=True,
+              help='Build the app once in the master instead of in every worker.')
+@click.option('--graceful-timeout', default=30, show_default=True,
+              help='Seconds a worker may finish its requests on reload or shutdown.')
+@click.option('--pid', default=None, help='File to write the master process id to.')
+def main(bind, workers, threads, preload, graceful_timeout, pid):
+    """Serve the app with gunicorn."""
+    # One hashing pool per worker; share the CPUs instead of each taking all of them
+    os.environ.setdefault('PASSWORD_HASH_WORKERS', str(max(1, (os.cpu_count() or 1) // workers)))
+    Server({
+        'bind': bind,
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'preload_app': preload,
+        'graceful_timeout': graceful_timeout,
+        'pidfile': pid,
+        'on_reload': on_reload,
+        'when_ready': when_ready,
+        'post_worker_init': post_worker_init,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,4 +6,406 @@ CREATE TABLE app_user(
 );
 
 CREATE INDEX idx_employee_name ON Employee (Lname, Fname);
-CREATE INDEX idx_workson_pno ON Works_On (Pno);
\ No newline at end of file
+CREATE INDEX idx_workson_pno ON Works_On (Pno);
+
+-- Tell running app processes to drop their cached copy of a user whose role
+-- changed or whose account was removed (see auth._listen_for_user_changes).
+CREATE OR REPLACE FUNCTION notify_app_user_changed() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('app_user_changed', OLD.id::text);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER app_user_changed
+  AFTER UPDATE OR DELETE ON app_user
+  FOR EACH ROW EXECUTE FUNCTION notify_app_user_changed();
+
+
+-- Per-employee rollup read by the Home overview (A2) and its export.
+-- Kept current by the triggers below so the page does not have to join
+-- Dependent and Works_On (and aggregate the fan-out) on every request.
+CREATE TABLE employee_stats(
+  ssn CHAR(9) PRIMARY KEY,
+  num_dependents INT NOT NULL DEFAULT 0,
+  num_projects INT NOT NULL DEFAULT 0,
+  total_hours DECIMAL(10,1) NOT NULL DEFAULT 0
+);
+
+-- Add deltas to one employee's row. Deltas (instead of recounting) keep
+-- concurrent writers correct: each UPDATE applies on top of the latest row.
+CREATE OR REPLACE FUNCTION employee_stats_bump(p_ssn CHAR(9), d_dependents INT, d_projects INT, d_hours DECIMAL)
+RETURNS void AS $$
+  UPDATE employee_stats
+     SET num_dependents = num_dependents + d_dependents,
+         num_projects = num_projects + d_projects,
+         total_hours = total_hours + d_hours
+   WHERE ssn = p_ssn;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION employee_stats_employee_trg() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO employee_stats (ssn) VALUES (NEW.ssn) ON CONFLICT DO NOTHING;
+  ELSIF TG_OP = 'DELETE' THEN
+    DELETE FROM employee_stats WHERE ssn = OLD.ssn;
+  ELSIF NEW.ssn <> OLD.ssn THEN
+    -- Works_On/Dependent rows follow the Ssn via ON UPDATE CASCADE and their
+    -- triggers skip renames, so the totals just move to the new key.
+    UPDATE employee_stats SET ssn = NEW.ssn WHERE ssn = OLD.ssn;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION employee_stats_works_on_trg() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    PERFORM employee_stats_bump(NEW.essn, 0, 1, NEW.hours);
+  ELSIF TG_OP = 'DELETE' THEN
+    PERFORM employee_stats_bump(OLD.essn, 0, -1, -OLD.hours);
+  ELSIF NEW.essn = OLD.essn THEN
+    PERFORM employee_stats_bump(NEW.essn, 0, 0, NEW.hours - OLD.hours);
+  ELSIF EXISTS (SELECT 1 FROM Employee WHERE Ssn = OLD.essn) THEN
+    -- Assignment moved to another employee (not a cascaded Ssn rename).
+    PERFORM employee_stats_bump(OLD.essn, 0, -1, -OLD.hours);
+    PERFORM employee_stats_bump(NEW.essn, 0, 1, NEW.hours);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION employee_stats_dependent_trg() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    PERFORM employee_stats_bump(NEW.essn, 1, 0, 0);
+  ELSIF TG_OP = 'DELETE' THEN
+    PERFORM employee_stats_bump(OLD.essn, -1, 0, 0);
+  ELSIF NEW.essn <> OLD.essn AND EXISTS (SELECT 1 FROM Employee WHERE Ssn = OLD.essn) THEN
+    PERFORM employee_stats_bump(OLD.essn, -1, 0, 0);
+    PERFORM employee_stats_bump(NEW.essn, 1, 0, 0);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER employee_stats_employee
+  AFTER INSERT OR DELETE OR UPDATE OF Ssn ON Employee
+  FOR EACH ROW EXECUTE FUNCTION employee_stats_employee_trg();
+
+CREATE TRIGGER employee_stats_works_on
+  AFTER INSERT OR DELETE OR UPDATE ON Works_On
+  FOR EACH ROW EXECUTE FUNCTION employee_stats_works_on_trg();
+
+CREATE TRIGGER employee_stats_dependent
+  AFTER INSERT OR DELETE OR UPDATE OF Essn ON Dependent
+  FOR EACH ROW EXECUTE FUNCTION employee_stats_dependent_trg();
+
+-- What employee_stats should contain, computed from the base tables.
+CREATE OR REPLACE VIEW employee_stats_expected AS
+SELECT e.Ssn AS ssn,
+       (SELECT COUNT(*) FROM Dependent dep WHERE dep.Essn = e.Ssn)::INT AS num_dependents,
+       (SELECT COUNT(*) FROM Works_On w WHERE w.Essn = e.Ssn)::INT AS num_projects,
+       (SELECT COALESCE(SUM(w.Hours), 0) FROM Works_On w WHERE w.Essn = e.Ssn) AS total_hours
+FROM Employee e;
+
+-- Rows where employee_stats disagrees with the base tables (empty when in sync).
+CREATE OR REPLACE VIEW employee_stats_drift AS
+SELECT COALESCE(x.ssn, s.ssn) AS ssn,
+       x.num_dependents AS expected_dependents, s.num_dependents AS actual_dependents,
+       x.num_projects AS expected_projects, s.num_projects AS actual_projects,
+       x.total_hours AS expected_hours, s.total_hours AS actual_hours
+FROM employee_stats_expected x
+FULL JOIN employee_stats s ON s.ssn = x.ssn
+WHERE x.ssn IS NULL OR s.ssn IS NULL
+   OR (x.num_dependents, x.num_projects, x.total_hours)
+      IS DISTINCT FROM (s.num_dependents, s.num_projects, s.total_hours);
+
+-- Recompute employee_stats from scratch; blocks writers while it runs.
+CREATE OR REPLACE FUNCTION employee_stats_rebuild() RETURNS void AS $$
+BEGIN
+  LOCK TABLE employee_stats IN EXCLUSIVE MODE;
+  DELETE FROM employee_stats;
+  INSERT INTO employee_stats (ssn, num_dependents, num_projects, total_hours)
+  SELECT ssn, num_dependents, num_projects, total_hours FROM employee_stats_expected;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT employee_stats_rebuild();
+
+
+-- Case-insensitive substring search on employee names (Home "Name" filter and
+-- /search/employees). A trigram GIN index can serve LIKE '%x%'; the btree
+-- idx_employee_name cannot. The expression must match queries.NAME_SEARCH_EXPR.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX idx_employee_search_name ON Employee
+  USING GIN (LOWER(Fname || ' ' || COALESCE(Minit, '') || ' ' || Lname) gin_trgm_ops);
+
+
+-- Per-project and per-department rollups read by the Projects (A3) and
+-- Managers pages, maintained the same way as employee_stats: rows are created
+-- and removed with their Project/Department and the triggers below apply
+-- deltas from Works_On and Employee changes.
+CREATE TABLE project_stats(
+  pnumber INT PRIMARY KEY,
+  headcount INT NOT NULL DEFAULT 0,
+  total_hours DECIMAL(12,1) NOT NULL DEFAULT 0
+);
+
+CREATE TABLE department_stats(
+  dnumber INT PRIMARY KEY,
+  employee_count INT NOT NULL DEFAULT 0,
+  total_hours DECIMAL(12,1) NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION project_stats_bump(p_pnumber INT, d_headcount INT, d_hours DECIMAL)
+RETURNS void AS $$
+  UPDATE project_stats
+     SET headcount = headcount + d_headcount,
+         total_hours = total_hours + d_hours
+   WHERE pnumber = p_pnumber;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION department_stats_bump(p_dnumber INT, d_employees INT, d_hours DECIMAL)
+RETURNS void AS $$
+  UPDATE department_stats
+     SET employee_count = employee_count + d_employees,
+         total_hours = total_hours + d_hours
+   WHERE dnumber = p_dnumber;
+$$ LANGUAGE sql;
+
+-- Department of an employee. FOR SHARE makes an assignment change wait for a
+-- concurrent move of the same employee to another department (and vice versa),
+-- so the hours are always credited to the department the employee ends up in.
+CREATE OR REPLACE FUNCTION department_of(p_ssn CHAR(9)) RETURNS INT AS $$
+  SELECT Dno FROM Employee WHERE Ssn = p_ssn FOR SHARE;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION project_stats_project_trg() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO project_stats (pnumber) VALUES (NEW.pnumber) ON CONFLICT DO NOTHING;
+  ELSIF TG_OP = 'DELETE' THEN
+    DELETE FROM project_stats WHERE pnumber = OLD.pnumber;
+  ELSIF NEW.pnumber <> OLD.pnumber THEN
+    UPDATE project_stats SET pnumber = NEW.pnumber WHERE pnumber = OLD.pnumber;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION department_stats_department_trg() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO department_stats (dnumber) VALUES (NEW.dnumber) ON CONFLICT DO NOTHING;
+  ELSIF TG_OP = 'DELETE' THEN
+    DELETE FROM department_stats WHERE dnumber = OLD.dnumber;
+  ELSIF NEW.dnumber <> OLD.dnumber THEN
+    UPDATE department_stats SET dnumber = NEW.dnumber WHERE dnumber = OLD.dnumber;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION project_stats_works_on_trg() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    PERFORM project_stats_bump(NEW.pno, 1, NEW.hours);
+  ELSIF TG_OP = 'DELETE' THEN
+    PERFORM project_stats_bump(OLD.pno, -1, -OLD.hours);
+  ELSIF NEW.pno = OLD.pno THEN
+    PERFORM project_stats_bump(NEW.pno, 0, NEW.hours - OLD.hours);
+  ELSIF EXISTS (SELECT 1 FROM Project WHERE Pnumber = OLD.pno) THEN
+    -- Assignment moved to another project (not a cascaded Pnumber rename).
+    PERFORM project_stats_bump(OLD.pno, -1, -OLD.hours);
+    PERFORM project_stats_bump(NEW.pno, 1, NEW.hours);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION department_stats_works_on_trg() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    PERFORM department_stats_bump(department_of(NEW.essn), 0, NEW.hours);
+  ELSIF TG_OP = 'DELETE' THEN
+    PERFORM department_stats_bump(department_of(OLD.essn), 0, -OLD.hours);
+  ELSIF NEW.essn <> OLD.essn AND EXISTS (SELECT 1 FROM Employee WHERE Ssn = OLD.essn) THEN
+    -- Assignment moved to another employee (not a cascaded Ssn rename).
+    PERFORM department_stats_bump(department_of(OLD.essn), 0, -OLD.hours);
+    PERFORM department_stats_bump(department_of(NEW.essn), 0, NEW.hours);
+  ELSIF NEW.hours <> OLD.hours THEN
+    PERFORM department_stats_bump(department_of(NEW.essn), 0, NEW.hours - OLD.hours);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION department_stats_employee_trg() RETURNS trigger AS $$
+DECLARE
+  hours DECIMAL;
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    PERFORM department_stats_bump(NEW.dno, 1, 0);
+  ELSIF TG_OP = 'DELETE' THEN
+    -- Works_On rows must already be gone (ON DELETE RESTRICT).
+    PERFORM department_stats_bump(OLD.dno, -1, 0);
+  ELSIF NEW.dno <> OLD.dno AND EXISTS (SELECT 1 FROM Department WHERE Dnumber = OLD.dno) THEN
+    -- Employee moved to another department (not a cascaded Dnumber rename):
+    -- move the head and all of their hours. Both Ssns are summed in case the
+    -- same statement also renamed the employee and Works_On hasn't followed yet.
+    SELECT COALESCE(SUM(w.Hours), 0) INTO hours FROM Works_On w WHERE w.Essn IN (OLD.ssn, NEW.ssn);
+    PERFORM department_stats_bump(OLD.dno, -1, -hours);
+    PERFORM department_stats_bump(NEW.dno, 1, hours);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER project_stats_project
+  AFTER INSERT OR DELETE OR UPDATE OF Pnumber ON Project
+  FOR EACH ROW EXECUTE FUNCTION project_stats_project_trg();
+
+CREATE TRIGGER department_stats_department
+  AFTER INSERT OR DELETE OR UPDATE OF Dnumber ON Department
+  FOR EACH ROW EXECUTE FUNCTION department_stats_department_trg();
+
+CREATE TRIGGER project_stats_works_on
+  AFTER INSERT OR DELETE OR UPDATE ON Works_On
+  FOR EACH ROW EXECUTE FUNCTION project_stats_works_on_trg();
+
+CREATE TRIGGER department_stats_works_on
+  AFTER INSERT OR DELETE OR UPDATE ON Works_On
+  FOR EACH ROW EXECUTE FUNCTION department_stats_works_on_trg();
+
+CREATE TRIGGER department_stats_employee
+  AFTER INSERT OR DELETE OR UPDATE OF Dno ON Employee
+  FOR EACH ROW EXECUTE FUNCTION department_stats_employee_trg();
+
+CREATE OR REPLACE VIEW project_stats_expected AS
+SELECT p.Pnumber AS pnumber,
+       (SELECT COUNT(*) FROM Works_On w WHERE w.Pno = p.Pnumber)::INT AS headcount,
+       (SELECT COALESCE(SUM(w.Hours), 0) FROM Works_On w WHERE w.Pno = p.Pnumber) AS total_hours
+FROM Project p;
+
+CREATE OR REPLACE VIEW department_stats_expected AS
+SELECT d.Dnumber AS dnumber,
+       (SELECT COUNT(*) FROM Employee e WHERE e.Dno = d.Dnumber)::INT AS employee_count,
+       (SELECT COALESCE(SUM(w.Hours), 0) FROM Employee e JOIN Works_On w ON w.Essn = e.Ssn
+         WHERE e.Dno = d.Dnumber) AS total_hours
+FROM Department d;
+
+CREATE OR REPLACE VIEW project_stats_drift AS
+SELECT COALESCE(x.pnumber, s.pnumber) AS pnumber,
+       x.headcount AS expected_headcount, s.headcount AS actual_headcount,
+       x.total_hours AS expected_hours, s.total_hours AS actual_hours
+FROM project_stats_expected x
+FULL JOIN project_stats s ON s.pnumber = x.pnumber
+WHERE x.pnumber IS NULL OR s.pnumber IS NULL
+   OR (x.headcount, x.total_hours) IS DISTINCT FROM (s.headcount, s.total_hours);
+
+CREATE OR REPLACE VIEW department_stats_drift AS
+SELECT COALESCE(x.dnumber, s.dnumber) AS dnumber,
+       x.employee_count AS expected_employees, s.employee_count AS actual_employees,
+       x.total_hours AS expected_hours, s.total_hours AS actual_hours
+FROM department_stats_expected x
+FULL JOIN department_stats s ON s.dnumber = x.dnumber
+WHERE x.dnumber IS NULL OR s.dnumber IS NULL
+   OR (x.employee_count, x.total_hours) IS DISTINCT FROM (s.employee_count, s.total_hours);
+
+CREATE OR REPLACE FUNCTION project_stats_rebuild() RETURNS void AS $$
+BEGIN
+  LOCK TABLE project_stats IN EXCLUSIVE MODE;
+  DELETE FROM project_stats;
+  INSERT INTO project_stats (pnumber, headcount, total_hours)
+  SELECT pnumber, headcount, total_hours FROM project_stats_expected;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION department_stats_rebuild() RETURNS void AS $$
+BEGIN
+  LOCK TABLE department_stats IN EXCLUSIVE MODE;
+  DELETE FROM department_stats;
+  INSERT INTO department_stats (dnumber, employee_count, total_hours)
+  SELECT dnumber, employee_count, total_hours FROM department_stats_expected;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT project_stats_rebuild();
+SELECT department_stats_rebuild();
+
+
+-- One version stamp per base table, bumped once per writing transaction, so
+-- a view can tell whether anything it shows has changed with one small read
+-- (see versions.py).
+--
+-- The bump happens at commit, not at each write. Bumping in every statement
+-- would lock the table's data_version row from the first write until the
+-- commit, and serialize all writers to that table behind a long import or
+-- bulk update. Instead, the first write to a table in a transaction files one
+-- row in data_version_pending (later writes see the transaction-local flag and
+-- skip it). A deferred constraint trigger on that row does the UPDATE when the
+-- transaction commits, so the row lock is held only while committing.
+CREATE TABLE data_version(
+  table_name TEXT PRIMARY KEY,
+  version BIGINT NOT NULL DEFAULT 0,
+  changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+INSERT INTO data_version (table_name)
+VALUES ('employee'), ('works_on'), ('dependent'), ('department'), ('project');
+
+-- Always empty outside of a writing transaction
+CREATE UNLOGGED TABLE data_version_pending(
+  table_name TEXT NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION data_version_mark() RETURNS trigger AS $$
+BEGIN
+  IF COALESCE(current_setting('data_version.' || TG_TABLE_NAME, true), '') <> 'on' THEN
+    -- is_local: the flag is gone when the transaction (or savepoint) ends
+    PERFORM set_config('data_version.' || TG_TABLE_NAME, 'on', true);
+    INSERT INTO data_version_pending VALUES (TG_TABLE_NAME);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION data_version_bump() RETURNS trigger AS $$
+BEGIN
+  UPDATE data_version SET version = version + 1, changed_at = clock_timestamp()
+  WHERE table_name = NEW.table_name;
+  DELETE FROM data_version_pending WHERE ctid = NEW.ctid;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE CONSTRAINT TRIGGER data_version_bump
+  AFTER INSERT ON data_version_pending
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW EXECUTE FUNCTION data_version_bump();
+
+CREATE TRIGGER data_version_employee
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Employee
+  FOR EACH STATEMENT EXECUTE FUNCTION data_version_mark();
+CREATE TRIGGER data_version_works_on
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Works_On
+  FOR EACH STATEMENT EXECUTE FUNCTION data_version_mark();
+CREATE TRIGGER data_version_dependent
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Dependent
+  FOR EACH STATEMENT EXECUTE FUNCTION data_version_mark();
+CREATE TRIGGER data_version_department
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Department
+  FOR EACH STATEMENT EXECUTE FUNCTION data_version_mark();
+CREATE TRIGGER data_version_project
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Project
+  FOR EACH STATEMENT EXECUTE FUNCTION data_version_mark();
+
+-- Employee picker (/employees/lookup, see queries.employee_lookup).
+-- Names are matched by prefix and paged in "lname fname" order, with and
+-- without a department filter. The "C" collation orders by bytes, so a
+-- prefix becomes a plain range (>= 'smi' AND < 'smj') on the index.
+CREATE INDEX idx_employee_sort_name
+    ON Employee ((LOWER(Lname || ' ' || Fname) COLLATE "C"), Ssn);
+CREATE INDEX idx_employee_dept_sort_name
+    ON Employee (Dno, (LOWER(Lname || ' ' || Fname) COLLATE "C"), Ssn);
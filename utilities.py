@@ -1,16 +1,44 @@
+import contextlib
+import itertools
+import logging
 import os
+import threading
+import time
+from flask import g, current_app, request, session, has_request_context
 try:
     import psycopg
 except Exception:
     psycopg = None
+try:
+    from psycopg_pool import ConnectionPool, PoolTimeout
+except Exception:
+    ConnectionPool = PoolTimeout = None
+if psycopg is not None:
+    from batch import RoundTripConnection, RoundTripCursor
 
-def get_db_connection():
-    """Return a new psycopg connection using the DATABASE_URL env var.
+logger = logging.getLogger(__name__)
 
-    Raises ValueError if psycopg is not installed or DATABASE_URL is not set.
+# Process-wide connection pool, created lazily on first use so that importing
+# this module (or forking workers) never opens database connections.
+_pool = None
+_pool_lock = threading.Lock()
+
+# Read replicas (DATABASE_REPLICA_URLS): one pool each, created on first use,
+# and the time until which each one is skipped after failing.
+_replica_pools = None
+_replica_down_until = {}
+_replica_turn = itertools.count()
+# Replica pool name -> connections this process has borrowed and not yet
+# released, to tell a busy replica from one that is down
+_replica_lent = {}
+_replica_lent_lock = threading.Lock()
+
+
+def get_database_url():
+    """Return the DATABASE_URL env var with any surrounding quotes removed.
+
+    Raises ValueError if DATABASE_URL is not set.
     """
-    if psycopg is None:
-        raise ValueError("psycopg is not installed; install requirements.txt")
     database_url = os.environ.get("DATABASE_URL", "")
     if not database_url:
         raise ValueError("DATABASE_URL environment variable is not set")
@@ -18,4 +46,308 @@ def get_db_connection():
     # strip surrounding single or double quotes so it actually works.
     database_url = database_url.strip()
     database_url = database_url.strip('"\'')
-    return psycopg.connect(database_url)
\ No newline at end of file
+    return database_url
+
+
+def get_replica_urls():
+    """Return the comma-separated DATABASE_REPLICA_URLS as a list (empty if unset)."""
+    urls = os.environ.get("DATABASE_REPLICA_URLS", "")
+    return [url.strip().strip('"\'') for url in urls.split(",") if url.strip().strip('"\'')]
+
+
+def get_db_connection():
+    """Return a new psycopg connection using the DATABASE_URL env var.
+
+    Views should use get_db() instead; this is for scripts and CLI commands
+    that need a dedicated connection outside of a request.
+
+    Raises ValueError if psycopg is not installed or DATABASE_URL is not set.
+    """
+    if psycopg is None:
+        raise ValueError("psycopg is not installed; install requirements.txt")
+    return psycopg.connect(get_database_url())
+
+
+def env_int(name, default):
+    """Return the environment variable `name` as an int, or `default` if unset."""
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def env_float(name, default):
+    """Return the environment variable `name` as a float, or `default` if unset."""
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use.
+
+    Pool sizing is read from the environment:
+        DB_POOL_MIN_SIZE  connections kept open (default 2)
+        DB_POOL_MAX_SIZE  upper bound on open connections (default 10)
+        DB_POOL_MAX_IDLE  seconds before a surplus idle connection is closed (default 300)
+        DB_POOL_TIMEOUT   seconds a request waits for a free connection (default 10)
+
+    Connections are health-checked when they are handed out, so a connection
+    dropped by the server is replaced instead of failing the request.
+    """
+    global _pool
+    if _pool is not None:
+        return _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _make_pool(get_database_url(), "app")
+    return _pool
+
+
+def _make_pool(conninfo, name, configure=None):
+    if psycopg is None:
+        raise ValueError("psycopg is not installed; install requirements.txt")
+    if ConnectionPool is None:
+        raise ValueError("psycopg_pool is not installed; install requirements.txt")
+    return ConnectionPool(
+        conninfo,
+        min_size=env_int("DB_POOL_MIN_SIZE", 2),
+        max_size=env_int("DB_POOL_MAX_SIZE", 10),
+        max_idle=env_float("DB_POOL_MAX_IDLE", 300.0),
+        timeout=env_float("DB_POOL_TIMEOUT", 10.0),
+        check=ConnectionPool.check_connection,
+        configure=configure,
+        connection_class=RoundTripConnection,
+        kwargs={"cursor_factory": RoundTripCursor},
+        name=name,
+        open=True,
+    )
+
+
+def _configure_replica(conn):
+    # Replica transactions are read-only, so a view marked read_only by
+    # mistake fails loudly instead of writing somewhere it shouldn't.
+    conn.read_only = True
+
+
+def get_replica_pools():
+    """Return one pool per DATABASE_REPLICA_URLS entry, creating them on first use."""
+    global _replica_pools
+    if _replica_pools is not None:
+        return _replica_pools
+    with _pool_lock:
+        if _replica_pools is None:
+            _replica_pools = [_make_pool(url, f"replica-{i}", configure=_configure_replica)
+                              for i, url in enumerate(get_replica_urls())]
+    return _replica_pools
+
+
+def _replica_load(pool):
+    stats = pool.get_stats()
+    return stats.get("pool_size", 0) - stats.get("pool_available", 0) + stats.get("requests_waiting", 0)
+
+
+def _replica_order(pools):
+    """The healthy replicas' indexes in the order to try them.
+
+    DB_REPLICA_SELECTION=round_robin (the default) takes turns;
+    least_busy prefers the replica with the fewest connections in use.
+    """
+    now = time.monotonic()
+    healthy = [i for i in range(len(pools)) if _replica_down_until.get(i, 0) <= now]
+    if not healthy:
+        return []
+    # Rotate first, so round_robin takes turns and least_busy breaks ties fairly
+    start = next(_replica_turn) % len(healthy)
+    healthy = healthy[start:] + healthy[:start]
+    if os.environ.get("DB_REPLICA_SELECTION", "round_robin") == "least_busy":
+        healthy.sort(key=lambda i: _replica_load(pools[i]))
+    return healthy
+
+
+def _replica_saturated(pool):
+    # Every connection the pool may have is lent out. (The pool's own
+    # pool_size also counts connections it is still trying to open.)
+    with _replica_lent_lock:
+        return _replica_lent.get(pool.name, 0) >= pool.max_size
+
+
+def _lend(pool, n):
+    with _replica_lent_lock:
+        _replica_lent[pool.name] = _replica_lent.get(pool.name, 0) + n
+
+
+def _replica_conn():
+    """Borrow a connection from a healthy replica, or return None.
+
+    A replica that fails to connect (or to pass the pool's connection check)
+    within DB_REPLICA_TIMEOUT seconds (default 1) is skipped for
+    DB_REPLICA_RETRY seconds (default 30). One whose connections are all busy
+    is only passed over for this request.
+    """
+    pools = get_replica_pools()
+    for i in _replica_order(pools):
+        try:
+            conn = pools[i].getconn(timeout=env_float("DB_REPLICA_TIMEOUT", 1.0))
+        except PoolTimeout:
+            if _replica_saturated(pools[i]):
+                logger.info("Replica %s has no free connection; trying the next server", pools[i].name)
+                continue
+            # Short of connections and couldn't open one: it is down
+            logger.warning("Replica %s is unavailable; using the primary", pools[i].name)
+            _replica_down_until[i] = time.monotonic() + env_float("DB_REPLICA_RETRY", 30.0)
+            continue
+        except psycopg.OperationalError:
+            logger.warning("Replica %s is unavailable; using the primary", pools[i].name)
+            _replica_down_until[i] = time.monotonic() + env_float("DB_REPLICA_RETRY", 30.0)
+            continue
+        conn.pool = pools[i]
+        _lend(pools[i], 1)
+        return conn
+    return None
+
+
+def read_only(view):
+    """Mark a view as read-only, so its connection may come from a replica.
+
+    With DATABASE_REPLICA_URLS set, get_db() in a read-only view (and in the
+    before_request hooks that run for it) borrows from a replica, unless the
+    session wrote something in the last DB_STICKY_SECONDS.
+    """
+    view.read_only = True
+    return view
+
+
+def _use_replica():
+    if not has_request_context() or not get_replica_urls():
+        return False
+    view = current_app.view_functions.get(request.endpoint)
+    if not getattr(view, "read_only", False):
+        return False
+    # Read-your-writes: stay on the primary for a while after a commit
+    return session.get("db_primary_until", 0) <= time.time()
+
+
+def get_db():
+    """Return the connection borrowed for the current request.
+
+    The first call in a request takes a connection from the pool (a
+    replica's, for read-only views; see read_only()) and stores it on
+    flask.g; later calls reuse it. close_db() gives it back at teardown.
+    """
+    if "db" not in g:
+        conn = _replica_conn() if _use_replica() else None
+        if conn is None:
+            conn = get_pool().getconn()
+            conn.pool = get_pool()
+        g.db = conn
+    return g.db
+
+
+@contextlib.contextmanager
+def borrow_db(read_only=False):
+    """Borrow a pooled connection outside of a request, e.g. for a background job.
+
+    With read_only, the connection comes from a healthy replica if there is
+    one. It goes back to its pool when the block ends.
+    """
+    conn = _replica_conn() if read_only and get_replica_urls() else None
+    if conn is None:
+        conn = get_pool().getconn()
+        conn.pool = get_pool()
+    try:
+        yield conn
+    finally:
+        release_db(conn)
+
+
+def release_db(conn):
+    """Give a borrowed connection back to the pool it came from.
+
+    Read-only views never commit, so any transaction still open here is
+    rolled back before the connection goes back to the pool.
+    """
+    status = conn.info.transaction_status
+    if status in (psycopg.pq.TransactionStatus.INTRANS, psycopg.pq.TransactionStatus.INERROR):
+        conn.rollback()
+    if conn.pool.name in _replica_lent:
+        _lend(conn.pool, -1)
+    conn.pool.putconn(conn)
+
+
+def close_db(e=None):
+    """Return the request's connection (if any) to the pool."""
+    conn = g.pop("db", None)
+    if conn is not None:
+        release_db(conn)
+
+
+def detach_db():
+    """Take the request's connection off flask.g so it can outlive the request.
+
+    Used by streaming responses, which keep reading after the view returns
+    (and after teardown has run). The caller must release_db() it when done.
+    """
+    conn = get_db()
+    g.pop("db")
+    return conn
+
+
+def warm_pools(timeout=None):
+    """Open the primary and replica pools and wait for their first connections.
+
+    For a server process that is about to take traffic (see serve.py), so
+    its first requests don't pay for connecting. Returns {pool name: idle
+    connections ready}. A pool still short of DB_POOL_MIN_SIZE after `timeout`
+    seconds (default DB_POOL_TIMEOUT) is logged and keeps connecting in the
+    background; a replica is also skipped as if a request had failed on it.
+    """
+    if timeout is None:
+        timeout = env_float("DB_POOL_TIMEOUT", 10.0)
+    opened = {}
+    for i, pool in [(None, get_pool())] + list(enumerate(get_replica_pools())):
+        try:
+            pool.wait(timeout)
+        except psycopg.OperationalError:
+            logger.warning("Pool %s could not open its connections in %ss", pool.name, timeout)
+            if i is not None:
+                _replica_down_until[i] = time.monotonic() + env_float("DB_REPLICA_RETRY", 30.0)
+        opened[pool.name] = pool.get_stats().get("pool_available", 0)
+    return opened
+
+
+def get_pool_stats():
+    """Return the pool's counters, or None if the pool has not been created yet."""
+    if _pool is None:
+        return None
+    return _pool.get_stats()
+
+
+def get_replica_stats():
+    """Return each replica pool's counters and whether it is being skipped, or None if there are none."""
+    if not _replica_pools:
+        return None
+    now = time.monotonic()
+    return [dict(pool.get_stats(), healthy=_replica_down_until.get(i, 0) <= now)
+            for i, pool in enumerate(_replica_pools)]
+
+
+def stick_to_primary(response):
+    """After a commit, keep this session's reads on the primary for DB_STICKY_SECONDS (default 5)."""
+    if g.pop("db_committed", False) and get_replica_urls():
+        session["db_primary_until"] = time.time() + env_float("DB_STICKY_SECONDS", 5.0)
+    return response
+
+
+def add_debug_headers(response):
+    """With DB_DEBUG on, report the request's database round trips (and server) in headers."""
+    if current_app.config.get("DB_DEBUG"):
+        response.headers["X-DB-Round-Trips"] = str(g.get("db_round_trips", 0))
+        if "db" in g:
+            response.headers["X-DB-Pool"] = g.db.pool.name
+    return response
+
+
+def init_app(app):
+    """Register the per-request connection teardown and debug headers on the Flask app."""
+    app.config.setdefault("DB_DEBUG", os.environ.get("DB_DEBUG", "") not in ("", "0"))
+    app.after_request(stick_to_primary)
+    app.after_request(add_debug_headers)
+    app.teardown_appcontext(close_db)
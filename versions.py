@@ -0,0 +1,74 @@
+"""Conditional GET (ETag / 304) from the data_version table.
+
+Triggers in team_setup.sql bump a table's row in data_version whenever a
+transaction that wrote to it commits. A read view decorated with @conditional('employee',
+'works_on', ...) reads those versions first, derives an ETag from them plus
+the endpoint, view arguments, request args and the logged-in user, and
+answers 304 Not Modified when the client already has that ETag, without
+running the view's queries or rendering its template.
+
+There is no Last-Modified / If-Modified-Since: a date can't tell two users,
+or two query strings, apart the way the ETag does, so a browser shared by
+two accounts could get a 304 for the other user's page.
+"""
+import functools
+import hashlib
+import os
+import time
+from flask import g, request, session, make_response, Response
+from utilities import get_db
+
+# Part of every ETag, so a deploy (new templates or code) changes them all.
+# Defaults to the process start time.
+APP_BUILD = os.environ.get('APP_BUILD') or str(time.time())
+
+
+def get_versions(conn, tables):
+    """Return {table: (version, changed_at)} for the given tables."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT table_name, version, changed_at FROM data_version WHERE table_name = ANY(%s)",
+                    (list(tables),))
+        return {name: (version, changed_at) for name, version, changed_at in cur.fetchall()}
+
+
+def bump_all(conn):
+    """Mark every table as changed, e.g. after the summary tables were rebuilt. Does not commit."""
+    with conn.cursor() as cur:
+        cur.execute("UPDATE data_version SET version = version + 1, changed_at = clock_timestamp()")
+
+
+def _etag(tables, versions, kwargs):
+    user = g.get('user') or {}
+    parts = [APP_BUILD, request.endpoint, repr(sorted(kwargs.items())),
+             repr(sorted(request.args.items(multi=True))), str(user.get('id')), str(user.get('role'))]
+    parts += [f"{t}={versions.get(t, (None,))[0]}" for t in tables]
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+
+def conditional(*tables):
+    """Decorate a read view whose output depends only on `tables` and the request.
+
+    Only applies to logged-in GET/HEAD requests without pending flashed
+    messages (a 304 would swallow them).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or g.get('user') is None or session.get('_flashes'):
+                return view(*args, **kwargs)
+            versions = get_versions(get_db(), tables)
+            # Kept for the view, e.g. to key resultcache entries without reading them again
+            g.data_versions = versions
+            etag = _etag(tables, versions, kwargs)
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            # Let the browser keep the page, but have it ask every time.
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapped
+    return decorator